@@ -1,7 +1,14 @@
 __version__ = "0.0.1"
 
-from ._widget import ADSplugin
-
 __all__ = (
     "ADSplugin"
 )
+
+
+def __getattr__(name):
+    # The widget is only imported when it is used, so the computing modules (and the headless pipeline) can be
+    # imported without napari or Qt
+    if name == "ADSplugin":
+        from ._widget import ADSplugin
+        return ADSplugin
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
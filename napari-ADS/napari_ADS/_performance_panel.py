@@ -0,0 +1,131 @@
+"""
+The Performance panel, showing the profiles of the plugin operations (see profiling.py).
+"""
+import threading
+
+from qtpy import QtCore
+from qtpy.QtCore import Signal
+from qtpy.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QComboBox, QPushButton, QTableWidget, \
+    QTableWidgetItem, QFileDialog, QLabel
+
+from . import profiling
+
+
+class Profiler(QtCore.QObject):
+    """
+    Creates the runs of the plugin operations, and keeps the last finished ones.
+    """
+    # Emits each run once it is finished, possibly from another thread
+    run_finished_signal = Signal(object)
+
+    def __init__(self, max_runs=profiling.MAX_RUNS):
+        super().__init__()
+        self.max_runs = max_runs
+        self.runs = []
+        self._lock = threading.Lock()
+
+    def start_run(self, name, image_name=None):
+        """
+        :return: A new run, added to the profiler when it is finished
+        :rtype: ProfileRun
+        """
+        return profiling.ProfileRun(name, image_name, on_finished=self._on_run_finished)
+
+    def _on_run_finished(self, run):
+        with self._lock:
+            self.runs.append(run)
+            del self.runs[:-self.max_runs]
+        print("Profile of " + run.get_title())
+        self.run_finished_signal.emit(run)
+
+    def clear(self):
+        with self._lock:
+            self.runs.clear()
+
+
+class PerformancePanel(QWidget):
+    """
+    Dockable panel showing the stages of the runs of a Profiler, with their export.
+    """
+    COLUMNS = ("Stage", "Duration (ms)", "Read (MB)", "Written (MB)", "Peak RSS (MB)")
+
+    def __init__(self, profiler):
+        super().__init__()
+        self.profiler = profiler
+        self.run_selection_combobox = QComboBox()
+        self.run_selection_combobox.currentIndexChanged.connect(self._on_run_selected)
+        self.stages_table = QTableWidget(0, len(self.COLUMNS))
+        self.stages_table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.stages_table.verticalHeader().setVisible(False)
+        self.notes_label = QLabel()
+        self.notes_label.setWordWrap(True)
+        export_json_button = QPushButton("Export JSON")
+        export_json_button.clicked.connect(self._on_export_json_button_click)
+        export_trace_button = QPushButton("Export Chrome trace")
+        export_trace_button.clicked.connect(self._on_export_trace_button_click)
+        clear_button = QPushButton("Clear")
+        clear_button.clicked.connect(self._on_clear_button_click)
+
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addWidget(export_json_button)
+        buttons_layout.addWidget(export_trace_button)
+        buttons_layout.addWidget(clear_button)
+        self.setLayout(QVBoxLayout())
+        self.layout().addWidget(self.run_selection_combobox)
+        self.layout().addWidget(self.stages_table)
+        self.layout().addWidget(self.notes_label)
+        self.layout().addLayout(buttons_layout)
+
+        self.profiler.run_finished_signal.connect(self._on_run_finished)
+        for run in self.profiler.runs:
+            self.run_selection_combobox.insertItem(0, run.get_title(), run)
+        self.run_selection_combobox.setCurrentIndex(0)
+
+    def _on_run_finished(self, run):
+        self.run_selection_combobox.insertItem(0, run.get_title(), run)
+        while self.run_selection_combobox.count() > self.profiler.max_runs:
+            self.run_selection_combobox.removeItem(self.run_selection_combobox.count() - 1)
+        self.run_selection_combobox.setCurrentIndex(0)
+
+    def get_selected_run(self):
+        return self.run_selection_combobox.currentData()
+
+    def _on_run_selected(self, index):
+        self.show_run(self.get_selected_run())
+
+    def show_run(self, run):
+        self.stages_table.setRowCount(0)
+        self.notes_label.setText("")
+        if run is None:
+            return
+        self.notes_label.setText("\n".join(name + ": " + text for name, text in sorted(run.notes.items())))
+        for stage in run.get_sorted_stages():
+            row = self.stages_table.rowCount()
+            self.stages_table.insertRow(row)
+            texts = ["    " * stage.depth + stage.name, str(round(stage.duration * 1000, 1))]
+            for value in (stage.bytes_read, stage.bytes_written, stage.peak_rss):
+                texts.append("" if value is None else str(round(value / 2 ** 20, 1)))
+            for column, text in enumerate(texts):
+                self.stages_table.setItem(row, column, QTableWidgetItem(text))
+        self.stages_table.resizeColumnsToContents()
+
+    def _on_export_json_button_click(self):
+        self.export_selected_run(profiling.write_json, profiling.JSON_FILTER, "_profile.json")
+
+    def _on_export_trace_button_click(self):
+        self.export_selected_run(profiling.write_chrome_trace, profiling.CHROME_TRACE_FILTER, "_trace.json")
+
+    def export_selected_run(self, write_function, file_filter, suffix):
+        run = self.get_selected_run()
+        if run is None:
+            return
+        default_name = run.name.lower().replace(" ", "_") + suffix
+        file_name, _ = QFileDialog.getSaveFileName(self, caption="Select where to export the profile",
+                                                   directory=default_name, filter=file_filter)
+        if file_name == "":
+            return
+        write_function([run], file_name)
+
+    def _on_clear_button_click(self):
+        self.profiler.clear()
+        self.run_selection_combobox.clear()
@@ -0,0 +1,338 @@
+"""
+The background threads of the plugin.
+
+They run the work of the computing modules (batch, saving, backends, resolution, pyramids, parallel_morphometrics)
+without blocking the napari event loop. They are kept out of those modules, so that the headless pipeline and the
+worker processes import them without Qt or napari.
+"""
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from qtpy import QtCore
+from qtpy.QtCore import Signal
+
+from . import backends, inference, profiling, saving
+
+
+class BatchSegmentationThread(QtCore.QThread):
+    """
+    Segments a list of BatchJobs. The next images are loaded while the current ones are segmented.
+    """
+    # Emits the index of the job that just finished (successfully or not)
+    job_finished_signal = Signal(int)
+    batch_finished_signal = Signal()
+
+    def __init__(self):
+        super().__init__()
+        # Those values must not be None before calling run()
+        self.jobs = None
+        self.model_cache = None
+        self.path_model = None
+        # If save_masks is True, the masks are written next to the images. Otherwise, they are kept in the jobs.
+        self.settings = None
+        self.summary_path = None
+        self.session = None
+        # Why the PyTorch model was used instead of the backend of the settings, empty if it wasn't
+        self.backend_message = ""
+        self._cancel_event = threading.Event()
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    def is_cancelled(self):
+        return self._cancel_event.is_set()
+
+    def run(self):
+        self._cancel_event.clear()
+        self.backend_message = ""
+        try:
+            # Set before the workers start, with every patch worker of every image
+            inference.share_cpu_threads(self.settings.n_batch_workers * self.settings.n_cpu_workers)
+            self.session, self.settings.backend, self.backend_message = backends.load_session(
+                self.path_model, gpu_id=self.settings.gpu_id, backend=self.settings.backend,
+                model_cache=self.model_cache)
+        except Exception:
+            traceback.print_exc()
+            for job in self.jobs:
+                job.status = "failed"
+                job.error = "Couldn't load the model"
+            self.finish()
+            return
+
+        # Keep a bounded number of images loaded in advance so the memory use doesn't grow with the batch
+        n_workers = self.settings.n_batch_workers
+        lookahead = n_workers + 1
+        with ThreadPoolExecutor(max_workers=1) as loader, ThreadPoolExecutor(max_workers=n_workers) as workers:
+            job_indexes = deque(range(len(self.jobs)))
+            loading = deque()
+            running = {}
+            while job_indexes or loading or running:
+                if self.is_cancelled():
+                    break
+                while job_indexes and len(loading) + len(running) < lookahead:
+                    index = job_indexes.popleft()
+                    loading.append((index, loader.submit(self.jobs[index].load)))
+                while loading and len(running) < n_workers and loading[0][1].done():
+                    index, load_future = loading.popleft()
+                    if load_future.exception() is not None:
+                        self.fail_job(index, load_future.exception())
+                        continue
+                    running[workers.submit(self.segment_job, self.jobs[index])] = index
+                waited_futures = list(running)
+                if loading and len(running) < n_workers:
+                    waited_futures.append(loading[0][1])
+                done_futures, _ = wait(waited_futures, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    if future not in running:
+                        continue
+                    index = running.pop(future)
+                    if future.exception() is not None:
+                        self.fail_job(index, future.exception())
+                    else:
+                        self.job_finished_signal.emit(index)
+
+            if self.is_cancelled():
+                # Jobs that already started are finished, the others are dropped
+                for future, index in running.items():
+                    if future.exception() is not None:
+                        self.fail_job(index, future.exception())
+                    else:
+                        self.job_finished_signal.emit(index)
+                for job in self.jobs:
+                    if job.status == "pending":
+                        job.status = "cancelled"
+                        job.image = None
+        self.session = None
+        self.finish()
+
+    def segment_job(self, job):
+        job.run(self.session, self.settings)
+
+    def fail_job(self, index, error):
+        job = self.jobs[index]
+        job.status = "failed"
+        job.error = str(error)
+        job.image = None
+        print("Couldn't segment " + job.name + ": " + repr(error))
+        self.job_finished_signal.emit(index)
+
+    def finish(self):
+        from . import batch
+        print(batch.get_summary_string(self.jobs))
+        if self.summary_path is not None:
+            try:
+                batch.write_summary(self.jobs, self.summary_path)
+            except IOError:
+                traceback.print_exc()
+        self.batch_finished_signal.emit()
+
+
+class SaveSegmentationThread(QtCore.QThread):
+    """
+    Writes the masks of a segmentation without blocking the napari event loop.
+    """
+    # Emits an error message, empty if the masks were saved
+    save_finished_signal = Signal(str)
+
+    def __init__(self):
+        super().__init__()
+        # Those values must not be None before calling run()
+        self.axon_data = None
+        self.myelin_data = None
+        self.save_directory = None
+        self.image_name = None
+        self.save_format = saving.PNG_FORMAT
+        self.pixel_size = None
+        # ProfileRun receiving the stages of the saving
+        self.profile_run = None
+
+    def run(self):
+        try:
+            with profiling.stage("saving as " + self.save_format, self.profile_run):
+                saving.save_segmentation(self.axon_data, self.myelin_data, self.save_directory, self.image_name,
+                                         self.save_format, self.pixel_size)
+        except Exception as error:
+            traceback.print_exc()
+            self.save_finished_signal.emit("Couldn't save the segmentation: " + str(error))
+        else:
+            self.save_finished_signal.emit("")
+        finally:
+            self.axon_data = None
+            self.myelin_data = None
+
+
+class BackendCheckThread(QtCore.QThread):
+    """
+    Runs backends.check_backend_accuracy without blocking the napari event loop.
+    """
+    # Emits the results of the check, or an error message
+    check_finished_signal = Signal(str)
+
+    def __init__(self):
+        super().__init__()
+        # Those values must not be None before calling run()
+        self.path_model = None
+        self.backend = None
+        self.image = None
+        self.pixel_size = None
+        self.zoom_factor = 1.0
+        self.overlap_value = (48, 48)
+        self.rgb = False
+        self.model_cache = None
+
+    def run(self):
+        try:
+            results = backends.check_backend_accuracy(self.path_model, self.backend, self.image, self.pixel_size,
+                                                      zoom_factor=self.zoom_factor,
+                                                      overlap_value=self.overlap_value, rgb=self.rgb,
+                                                      model_cache=self.model_cache)
+        except (ImportError, OSError) as error:
+            traceback.print_exc()
+            self.check_finished_signal.emit("Couldn't check " + str(self.backend) + ": " +
+                                            backends.get_backend_error_message(self.backend, error))
+        except Exception as error:
+            traceback.print_exc()
+            self.check_finished_signal.emit("Couldn't check " + str(self.backend) + ": " + str(error))
+        else:
+            self.check_finished_signal.emit(
+                self.backend + " against " + backends.PYTORCH_BACKEND + ": axon Dice " +
+                str(round(results["axon_dice"], 4)) + ", myelin Dice " + str(round(results["myelin_dice"], 4)) + ", " +
+                str(round(results["backend_time"], 2)) + " s instead of " + str(round(results["reference_time"], 2)) +
+                " s. " + backends.PYTORCH_BACKEND + " in memory against AxonDeepSeg: axon Dice " +
+                str(round(results["ads_axon_dice"], 4)) + ", myelin Dice " + str(round(results["ads_myelin_dice"], 4))
+            )
+        finally:
+            self.image = None
+
+
+class PixelSizeScanThread(QtCore.QThread):
+    """
+    Finds the pixel size of a list of images without blocking the napari event loop.
+    """
+    scan_finished_signal = Signal()
+
+    def __init__(self, resolver):
+        super().__init__()
+        self.resolver = resolver
+        # Must not be None before calling run()
+        self.image_paths = None
+        # Results of the scan: pixel size of each image (None if it has none), by path
+        self.pixel_sizes = {}
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def run(self):
+        self._cancelled = False
+        self.pixel_sizes = self.resolver.scan(self.image_paths, is_cancelled=lambda: self._cancelled)
+        self.scan_finished_signal.emit()
+
+
+class PyramidThread(QtCore.QThread):
+    """
+    Builds the queued pyramids one after the other, without blocking the napari event loop.
+    """
+    # Emits the Pyramid whose levels were built
+    pyramid_built_signal = Signal(object)
+
+    def __init__(self):
+        super().__init__()
+        # Queued (pyramid, cache, cache key)
+        self._queue = []
+        self._queue_lock = threading.Lock()
+
+    def add(self, pyramid, cache=None, cache_key=None):
+        """
+        Queues a pyramid, and starts the thread if needed.
+        :param cache: The PyramidCache of the pyramid, or None to build it without a cache
+        """
+        with self._queue_lock:
+            self._queue.append((pyramid, cache, cache_key))
+        if not self.isRunning():
+            self.start()
+
+    def has_queued_pyramids(self):
+        with self._queue_lock:
+            return len(self._queue) > 0
+
+    def clear(self):
+        with self._queue_lock:
+            self._queue.clear()
+
+    def run(self):
+        while True:
+            with self._queue_lock:
+                if len(self._queue) == 0:
+                    return
+                pyramid, cache, cache_key = self._queue.pop(0)
+            try:
+                pyramid.build(cache, cache_key)
+            except Exception as error:
+                # The coarse levels keep being read from the base
+                print("Couldn't build the multiscale pyramid: " + str(error))
+                continue
+            self.pyramid_built_signal.emit(pyramid)
+
+
+class MorphometricsThread(QtCore.QThread):
+    """
+    Computes the morphometrics of an image and saves them, without blocking the napari event loop. The first
+    measure of the live morphometrics uses it without saving.
+    """
+    # Emits (number of tiles done, total number of tiles)
+    progress_signal = Signal(int, int)
+    # Emits an error message, empty if the morphometrics were computed
+    morphometrics_finished_signal = Signal(str)
+
+    def __init__(self):
+        # Imported here so the other threads can be created without pandas
+        from . import morphometrics_export, parallel_morphometrics
+        super().__init__()
+        # Those values must not be None before calling run()
+        self.axon_data = None
+        self.myelin_data = None
+        self.pixel_size = None
+        # The morphometrics are only computed if None
+        self.file_name = None
+        self.axon_shape = "circle"
+        # If True, the results keep the seed columns used by the live morphometrics
+        self.keep_seeds = False
+        self.n_workers = parallel_morphometrics.DEFAULT_N_WORKERS
+        # CSV file, or Parquet dataset receiving the rows of the image with the given partition values
+        self.export_format = morphometrics_export.CSV_FORMAT
+        self.partition_values = {}
+        # ProfileRun receiving the stages of the computation
+        self.profile_run = None
+        # Result of the computation
+        self.stats_dataframe = None
+
+    def run(self):
+        from . import morphometrics_export, parallel_morphometrics
+        self.stats_dataframe = None
+        try:
+            with profiling.stage("morphometrics computation", self.profile_run):
+                self.stats_dataframe = parallel_morphometrics.compute_morphometrics(
+                    self.axon_data, self.myelin_data, self.pixel_size, axon_shape=self.axon_shape,
+                    n_workers=self.n_workers, progress_callback=self.progress_signal.emit, keep_seeds=self.keep_seeds)
+        except Exception as error:
+            traceback.print_exc()
+            self.morphometrics_finished_signal.emit("Couldn't compute the morphometrics: " + str(error))
+            return
+        finally:
+            self.axon_data = None
+            self.myelin_data = None
+        if self.file_name is None:
+            self.morphometrics_finished_signal.emit("")
+            return
+        try:
+            with profiling.stage(self.export_format + " export", self.profile_run):
+                morphometrics_export.save_morphometrics(self.stats_dataframe, self.file_name, self.export_format,
+                                                        **self.partition_values)
+        except (IOError, ImportError) as error:
+            traceback.print_exc()
+            self.morphometrics_finished_signal.emit("Cannot save morphometrics: " + str(error))
+            return
+        self.morphometrics_finished_signal.emit("")
@@ -1,25 +1,61 @@
 from typing import TYPE_CHECKING
 
 import os, sys
+import traceback
+import weakref
 from pathlib import Path
 
-import AxonDeepSeg
-import config
 import numpy as np
 import qtpy.QtCore
 from qtpy import QtWidgets, QtCore
 from qtpy.QtWidgets import QVBoxLayout, QPushButton, QWidget, QComboBox, QFileDialog, QLabel, QPlainTextEdit, \
-    QInputDialog, QMessageBox
+    QInputDialog, QMessageBox, QProgressBar
 from qtpy.QtCore import QStringListModel, QObject, Signal
 from qtpy.QtGui import QPixmap
 
-from AxonDeepSeg import ads_utils, segment, postprocessing, params
-import AxonDeepSeg.morphometrics.compute_morphometrics as compute_morphs
-from config import axonmyelin_suffix, axon_suffix, myelin_suffix
-
 import napari
 from napari.utils.notifications import show_info
 from .settings_menu_ui import Ui_Settings_menu_ui
+# These modules only import numpy, scipy, napari and Qt, which the widget needs anyway. The modules importing
+# AxonDeepSeg, torch, pandas or pyarrow (segmentation of a folder, morphometrics, sessions, ...) are imported when they
+# are used, so that the widget is shown without waiting for them.
+from . import inference, backends, regions, saving, masks, result_cache, profiling, resolution, pyramids, \
+    associations, _threads, _performance_panel
+
+# Minimum time between two refreshes of the mask layers during a progressive segmentation
+PREVIEW_REFRESH_INTERVAL_MS = 200
+# Settings saved in the sessions, with the widget of the settings menu changing each one
+SESSION_SETTING_WIDGETS = {
+    "overlap_value": "overlap_value_spinBox",
+    "zoom_factor": "zoom_factor_spinBox",
+    "axon_shape": "axon_shape_comboBox",
+    "fill_region": "fill_region_comboBox",
+    "save_format": "save_format_comboBox",
+    "no_patch": "no_patch_checkBox",
+    "in_memory": "in_memory_checkBox",
+    "tiled": "tiled_checkBox",
+    "axonmyelin_layer": "axonmyelin_layer_checkBox",
+    "progressive": "progressive_checkBox",
+    "multiscale_display": "multiscale_checkBox",
+    "cache_pyramids": "pyramid_cache_checkBox",
+    "gpu_id": "gpu_id_spinBox",
+    "n_cpu_workers": "cpu_workers_spinBox",
+    "n_batch_workers": "batch_workers_spinBox",
+    "model_cache_size": "model_cache_size_spinBox",
+    "result_cache_size_mb": "result_cache_size_spinBox",
+}
+# Metadata key of the file of the image layers added by the plugin when napari can't set their source
+IMAGE_PATH_KEY = "image_path"
+
+
+def get_layer_path(layer):
+    """
+    :return: The file of a layer, or None if it has none
+    """
+    if layer.source.path is not None:
+        return layer.source.path
+    return layer.metadata.get(IMAGE_PATH_KEY)
+
 
 class ADSsettings:
     """
@@ -37,10 +73,30 @@ class ADSsettings:
         self.zoom_factor = 1.0
         self.axon_shape = "circle"
         self._axon_shape_selection_index = 0
+        self.fill_region = "Whole image"
+        self._fill_region_selection_index = 0
+        self.save_format = saving.PNG_FORMAT
+        self._save_format_selection_index = 0
         self.no_patch = False
+        self.in_memory = True
+        self.tiled = False
+        self.axonmyelin_layer = False
+        self.progressive = False
+        # If True, large images and masks are shown with multiscale pyramids, built in the background. napari can't
+        # paint the multiscale masks, so it must be enabled by the user.
+        self.multiscale_display = False
+        self.cache_pyramids = False
         self.gpu_id = 0
-        self.n_gpus = ads_utils.check_available_gpus(None)
-        self.max_gpu_id = self.n_gpus-1 if self.n_gpus > 0 else 0
+        # Number of patches predicted at the same time when no GPU is used
+        self.n_cpu_workers = 1
+        self.model_cache_size = 2
+        self.result_cache_size_mb = result_cache.DEFAULT_MAX_SIZE_MB
+        # Inference backend of each model, by model name. The PyTorch model is used by default.
+        self.model_backends = {}
+        self.n_batch_workers = 1
+        # The GPUs are found in the background by DiscoveryThread
+        self.n_gpus = 0
+        self.max_gpu_id = 0
         self.setup_settings_menu()
 
     def setup_settings_menu(self):
@@ -52,16 +108,59 @@ class ADSsettings:
         self.ui.overlap_value_spinBox.valueChanged.connect(self._on_overlap_value_changed)
         self.ui.zoom_factor_spinBox.valueChanged.connect(self._on_zoom_factor_changed)
         self.ui.axon_shape_comboBox.currentIndexChanged.connect(self._on_axon_shape_changed)
+        self.ui.fill_region_comboBox.currentIndexChanged.connect(self._on_fill_region_changed)
+        self.ui.save_format_comboBox.currentIndexChanged.connect(self._on_save_format_changed)
         self.ui.no_patch_checkBox.stateChanged.connect(self._on_no_patch_changed)
+        self.ui.in_memory_checkBox.stateChanged.connect(self._on_in_memory_changed)
+        self.ui.tiled_checkBox.stateChanged.connect(self._on_tiled_changed)
+        self.ui.axonmyelin_layer_checkBox.stateChanged.connect(self._on_axonmyelin_layer_changed)
+        self.ui.progressive_checkBox.stateChanged.connect(self._on_progressive_changed)
+        self.ui.multiscale_checkBox.stateChanged.connect(self._on_multiscale_changed)
+        self.ui.pyramid_cache_checkBox.stateChanged.connect(self._on_pyramid_cache_changed)
         self.ui.gpu_id_spinBox.valueChanged.connect(self._on_gpu_id_changed)
+        self.ui.cpu_workers_spinBox.valueChanged.connect(self._on_cpu_workers_changed)
+        self.ui.batch_workers_spinBox.valueChanged.connect(self._on_batch_workers_changed)
+        self.ui.model_cache_size_spinBox.valueChanged.connect(self._on_model_cache_size_changed)
+        self.ui.release_memory_button.clicked.connect(self._on_release_memory_button_click)
+        self.ui.result_cache_size_spinBox.valueChanged.connect(self._on_result_cache_size_changed)
+        self.ui.clear_result_cache_button.clicked.connect(self._on_clear_result_cache_button_click)
+        self.ui.backend_comboBox.currentIndexChanged.connect(self._on_backend_changed)
+        self.ui.check_backend_button.clicked.connect(self._on_check_backend_button_click)
+        self.backend_check_thread = _threads.BackendCheckThread()
+        self.backend_check_thread.check_finished_signal.connect(self._on_backend_check_finished)
+
+    def set_n_gpus(self, n_gpus):
+        self.n_gpus = n_gpus
+        self.max_gpu_id = self.n_gpus-1 if self.n_gpus > 0 else 0
+        self.ui.gpu_id_spinBox.setMaximum(self.max_gpu_id)
 
     def create_settings_menu(self):
         self.ui.overlap_value_spinBox.setValue(self.overlap_value)
         self.ui.zoom_factor_spinBox.setValue(self.zoom_factor)
         self.ui.axon_shape_comboBox.setCurrentIndex(self._axon_shape_selection_index)
+        self.ui.fill_region_comboBox.setCurrentIndex(self._fill_region_selection_index)
+        self.ui.save_format_comboBox.setCurrentIndex(self._save_format_selection_index)
         self.ui.no_patch_checkBox.setChecked(self.no_patch)
+        self.ui.in_memory_checkBox.setChecked(self.in_memory)
+        self.ui.tiled_checkBox.setChecked(self.tiled)
+        self.ui.axonmyelin_layer_checkBox.setChecked(self.axonmyelin_layer)
+        self.ui.progressive_checkBox.setChecked(self.progressive)
+        self.ui.multiscale_checkBox.setChecked(self.multiscale_display)
+        self.ui.pyramid_cache_checkBox.setChecked(self.cache_pyramids)
         self.ui.gpu_id_spinBox.setValue(self.gpu_id)
         self.ui.gpu_id_spinBox.setMaximum(self.max_gpu_id)
+        self.ui.cpu_workers_spinBox.setMaximum(os.cpu_count() or 1)
+        self.ui.cpu_workers_spinBox.setValue(self.n_cpu_workers)
+        self.ui.batch_workers_spinBox.setValue(self.n_batch_workers)
+        self.ui.model_cache_size_spinBox.setValue(self.model_cache_size)
+        self.ui.result_cache_size_spinBox.setValue(self.result_cache_size_mb)
+        self.ui.result_cache_stats_label.setText(self.ads_plugin.result_cache.get_stats_string())
+        # The backend is chosen for the model selected in the plugin
+        selected_model = self.ads_plugin.model_selection_combobox.currentText()
+        model_selected = selected_model in self.ads_plugin.available_models
+        self.ui.backend_comboBox.setCurrentIndex(backends.BACKENDS.index(self.get_backend(selected_model)))
+        self.ui.backend_comboBox.setEnabled(model_selected)
+        self.ui.check_backend_button.setEnabled(model_selected and not self.backend_check_thread.isRunning())
         self.Settings_menu_ui.show()
 
     def _on_done_button_click(self):
@@ -77,18 +176,140 @@ class ADSsettings:
         self.axon_shape = self.ui.axon_shape_comboBox.currentText()
         self._axon_shape_selection_index = self.ui.axon_shape_comboBox.currentIndex()
 
+    def _on_fill_region_changed(self):
+        self.fill_region = self.ui.fill_region_comboBox.currentText()
+        self._fill_region_selection_index = self.ui.fill_region_comboBox.currentIndex()
+
+    def _on_save_format_changed(self):
+        self.save_format = self.ui.save_format_comboBox.currentText()
+        self._save_format_selection_index = self.ui.save_format_comboBox.currentIndex()
+
     def _on_no_patch_changed(self):
         self.no_patch = self.ui.no_patch_checkBox.isChecked()
 
+    def _on_in_memory_changed(self):
+        self.in_memory = self.ui.in_memory_checkBox.isChecked()
+
+    def _on_tiled_changed(self):
+        self.tiled = self.ui.tiled_checkBox.isChecked()
+
+    def _on_axonmyelin_layer_changed(self):
+        self.axonmyelin_layer = self.ui.axonmyelin_layer_checkBox.isChecked()
+
+    def _on_progressive_changed(self):
+        self.progressive = self.ui.progressive_checkBox.isChecked()
+
+    def _on_multiscale_changed(self):
+        self.multiscale_display = self.ui.multiscale_checkBox.isChecked()
+
+    def _on_pyramid_cache_changed(self):
+        self.cache_pyramids = self.ui.pyramid_cache_checkBox.isChecked()
+
     def _on_gpu_id_changed(self):
         self.gpu_id = self.ui.gpu_id_spinBox.value()
 
+    def _on_cpu_workers_changed(self):
+        self.n_cpu_workers = self.ui.cpu_workers_spinBox.value()
+
+    def _on_batch_workers_changed(self):
+        self.n_batch_workers = self.ui.batch_workers_spinBox.value()
+
+    def _on_model_cache_size_changed(self):
+        self.model_cache_size = self.ui.model_cache_size_spinBox.value()
+        self.ads_plugin.model_cache.set_max_size(self.model_cache_size)
+
+    def _on_release_memory_button_click(self):
+        self.ads_plugin.model_cache.clear()
+        show_info("Released the loaded models. " + self.ads_plugin.model_cache.get_stats_string())
+
+    def _on_result_cache_size_changed(self):
+        self.result_cache_size_mb = self.ui.result_cache_size_spinBox.value()
+        self.ads_plugin.result_cache.set_max_size_mb(self.result_cache_size_mb)
+        self.ui.result_cache_stats_label.setText(self.ads_plugin.result_cache.get_stats_string())
+
+    def get_backend(self, model_name):
+        return self.model_backends.get(model_name, backends.PYTORCH_BACKEND)
+
+    def _on_backend_changed(self):
+        selected_model = self.ads_plugin.model_selection_combobox.currentText()
+        if selected_model in self.ads_plugin.available_models:
+            self.model_backends[selected_model] = self.ui.backend_comboBox.currentText()
+
+    def _on_check_backend_button_click(self):
+        model_path = self.ads_plugin.get_selected_model_path()
+        image_layer = self.ads_plugin.get_microscopy_image()
+        if model_path is None or image_layer is None:
+            self.ads_plugin.show_info_message("Select a model and an image to check the backend on")
+            return
+        if ("pixel_size" not in image_layer.metadata
+                and not self.ads_plugin.add_layer_pixel_size_to_metadata(image_layer)):
+            pixel_size = self.ads_plugin.get_pixel_size_with_prompt()
+            if pixel_size is None:
+                return
+            image_layer.metadata["pixel_size"] = pixel_size
+        image = image_layer.data[0] if image_layer.multiscale else image_layer.data
+        self.backend_check_thread.path_model = model_path
+        self.backend_check_thread.backend = self.ui.backend_comboBox.currentText()
+        self.backend_check_thread.image = image
+        self.backend_check_thread.pixel_size = image_layer.metadata["pixel_size"]
+        self.backend_check_thread.zoom_factor = self.zoom_factor
+        self.backend_check_thread.overlap_value = [self.overlap_value, self.overlap_value]
+        self.backend_check_thread.rgb = image_layer.rgb
+        self.backend_check_thread.model_cache = self.ads_plugin.model_cache
+        self.ui.check_backend_button.setEnabled(False)
+        self.backend_check_thread.start()
+
+    def _on_backend_check_finished(self, message):
+        self.ui.check_backend_button.setEnabled(True)
+        show_info(message)
+
+    def get_session_settings(self):
+        """
+        :return: The settings saved in a session, by name
+        :rtype: dict
+        """
+        session_settings = {name: getattr(self, name) for name in SESSION_SETTING_WIDGETS}
+        session_settings["model_backends"] = dict(self.model_backends)
+        return session_settings
+
+    def set_session_settings(self, session_settings):
+        """
+        Restores the settings of a session. They are set on the widgets of the settings menu, so they are applied like
+        the changes made by the user.
+        """
+        self.ui.cpu_workers_spinBox.setMaximum(os.cpu_count() or 1)
+        for name, value in session_settings.items():
+            if name not in SESSION_SETTING_WIDGETS:
+                continue
+            widget = getattr(self.ui, SESSION_SETTING_WIDGETS[name])
+            if isinstance(widget, QtWidgets.QCheckBox):
+                widget.setChecked(bool(value))
+            elif isinstance(widget, QtWidgets.QComboBox):
+                index = widget.findText(str(value))
+                if index >= 0:
+                    widget.setCurrentIndex(index)
+            else:
+                widget.setValue(value)
+        self.model_backends.update(session_settings.get("model_backends", {}))
+
+    def _on_clear_result_cache_button_click(self):
+        self.ads_plugin.result_cache.clear()
+        self.ui.result_cache_stats_label.setText(self.ads_plugin.result_cache.get_stats_string())
+        show_info("Cleared the segmentation results. " + self.ads_plugin.result_cache.get_stats_string())
+
 
 class ADSplugin(QWidget):
     def __init__(self, napari_viewer):
         super().__init__()
         self.viewer = napari_viewer
+        # Links between the images and their masks, kept up to date with the layers of the viewer
+        self.associations = associations.AssociationIndex(self.viewer)
         self.settings = ADSsettings(self)
+        self.model_cache = inference.ModelCache(max_size=self.settings.model_cache_size)
+        self.result_cache = result_cache.ResultCache(max_size_mb=self.settings.result_cache_size_mb)
+        # Stages of the last operations, shown in the Performance panel
+        self.profiler = _performance_panel.Profiler()
+        self.performance_panel = None
 
         citation_textbox = QPlainTextEdit(self)
         citation_textbox.setPlainText(self.get_citation_string())
@@ -100,26 +321,96 @@ class ADSplugin(QWidget):
         hyperlink_label.setText(
             '<a href="https://axondeepseg.readthedocs.io/en/latest/">Need help? Read the documentation</a>')
 
-        self.available_models = ads_utils.get_existing_models_list()
+        # The models and the GPUs are found in the background, so the widget is shown right away
+        self.available_models = []
         self.model_selection_combobox = QComboBox()
-        self.model_selection_combobox.addItems(["Select the model"] + self.available_models)
+        self.model_selection_combobox.addItems(["Select the model"])
+        self.discovery_thread = DiscoveryThread()
+        self.discovery_thread.discovery_finished_signal.connect(self._on_discovery_finished)
 
         self.apply_model_button = QPushButton("Apply ADS model")
         self.apply_model_button.clicked.connect(self._on_apply_model_button_click)
         self.apply_model_thread = ApplyModelThread()
+        self.apply_model_thread.model_cache = self.model_cache
+        self.apply_model_thread.result_cache = self.result_cache
         self.apply_model_thread.model_applied_signal.connect(self._on_model_finished_apply)
-
-        load_mask_button = QPushButton("Load mask")
-        load_mask_button.clicked.connect(self._on_load_mask_button_click)
+        self.apply_model_thread.patch_segmented_signal.connect(self._on_patch_segmented)
+        # The mask layers are refreshed at most every PREVIEW_REFRESH_INTERVAL_MS during a progressive segmentation
+        self.preview_refresh_timer = QtCore.QTimer(self)
+        self.preview_refresh_timer.setSingleShot(True)
+        self.preview_refresh_timer.timeout.connect(self.refresh_preview_layers)
+        self.viewer.camera.events.center.connect(self._on_camera_changed)
+        self.viewer.camera.events.zoom.connect(self._on_camera_changed)
+
+        self.batch_selected_images_button = QPushButton("Segment selected images")
+        self.batch_selected_images_button.clicked.connect(self._on_batch_selected_images_button_click)
+        self.batch_folder_button = QPushButton("Segment a folder")
+        self.batch_folder_button.clicked.connect(self._on_batch_folder_button_click)
+        self.cancel_batch_button = QPushButton("Cancel batch")
+        self.cancel_batch_button.clicked.connect(self._on_cancel_batch_button_click)
+        self.cancel_batch_button.setEnabled(False)
+        self.batch_progress_bar = QProgressBar()
+        self.batch_progress_bar.setVisible(False)
+        # The threads of the operations are created on their first use (see get_batch_thread)
+        self.batch_thread = None
+        self.batch_image_layers = []
+        # The pixel sizes of a folder are found in the background before its batch starts
+        self.pixel_size_resolver = resolution.PixelSizeResolver()
+        self.pixel_size_scan_thread = _threads.PixelSizeScanThread(self.pixel_size_resolver)
+        self.pixel_size_scan_thread.scan_finished_signal.connect(self._on_pixel_size_scan_finished)
+        self.scanned_folder = None
+        self.scanned_model_path = None
+        # The coarse levels of the large layers are built in the background, and the image levels can be cached
+        self.pyramid_cache = pyramids.PyramidCache()
+        self.pyramid_thread = _threads.PyramidThread()
+        self.pyramid_thread.pyramid_built_signal.connect(self._on_pyramid_built)
+        self.pyramid_thread.finished.connect(self._on_pyramid_thread_finished)
+        self.viewer.layers.events.inserted.connect(self._on_layer_inserted)
+        # Temporary folders of on-disk masks, with their arrays. A folder is removed with the last layer showing them.
+        self.temporary_directories = {}
+        self.viewer.layers.events.removed.connect(self._on_layer_removed)
+        # Bounding box of the myelin edits made since the last "Fill axons", for each myelin layer
+        self.myelin_edited_boxes = weakref.WeakKeyDictionary()
+
+        self.load_mask_button = QPushButton("Load mask")
+        self.load_mask_button.clicked.connect(self._on_load_mask_button_click)
+        self.mask_loading_thread = None
 
         fill_axons_button = QPushButton("Fill axons")
         fill_axons_button.clicked.connect(self._on_fill_axons_click)
 
-        save_segmentation_button = QPushButton("Save segmentation")
-        save_segmentation_button.clicked.connect(self._on_save_segmentation_button)
-
-        compute_morphometrics_button = QPushButton("Compute morphometrics")
-        compute_morphometrics_button.clicked.connect(self._on_compute_morphometrics_button)
+        self.save_segmentation_button = QPushButton("Save segmentation")
+        self.save_segmentation_button.clicked.connect(self._on_save_segmentation_button)
+        self.save_segmentation_thread = None
+
+        self.compute_morphometrics_button = QPushButton("Compute morphometrics")
+        self.compute_morphometrics_button.clicked.connect(self._on_compute_morphometrics_button)
+        self.morphometrics_progress_bar = QProgressBar()
+        self.morphometrics_progress_bar.setVisible(False)
+        self.morphometrics_thread = None
+        self.morphometrics_image_layer = None
+
+        self.live_morphometrics_button = QPushButton("Live morphometrics")
+        self.live_morphometrics_button.setCheckable(True)
+        self.live_morphometrics_button.toggled.connect(self._on_live_morphometrics_toggled)
+        self.live_morphometrics = None
+        # Measures the whole image when the live morphometrics start
+        self.live_morphometrics_thread = None
+        self.morphometrics_table = None
+        # Numbers of the axons shown on each image, by image name
+        self.axon_numbers = {}
+
+        self.save_session_button = QPushButton("Save session")
+        self.save_session_button.clicked.connect(self._on_save_session_button_click)
+        self.open_session_button = QPushButton("Open session")
+        self.open_session_button.clicked.connect(self._on_open_session_button_click)
+        self.session_thread = None
+        # Last morphometrics table computed, saved in the sessions
+        self.last_morphometrics = None
+        self.last_morphometrics_image_name = None
+
+        performance_button = QPushButton("Performance")
+        performance_button.clicked.connect(self._on_performance_button_click)
 
         settings_menu_button = QPushButton("Settings")
         settings_menu_button.clicked.connect(self._on_settings_menu_clicked)
@@ -132,26 +423,79 @@ class ADSplugin(QWidget):
         self.layout().addWidget(hyperlink_label)
         self.layout().addWidget(self.model_selection_combobox)
         self.layout().addWidget(self.apply_model_button)
-        self.layout().addWidget(load_mask_button)
+        self.layout().addWidget(self.batch_selected_images_button)
+        self.layout().addWidget(self.batch_folder_button)
+        self.layout().addWidget(self.cancel_batch_button)
+        self.layout().addWidget(self.batch_progress_bar)
+        self.layout().addWidget(self.load_mask_button)
         self.layout().addWidget(fill_axons_button)
-        self.layout().addWidget(save_segmentation_button)
-        self.layout().addWidget(compute_morphometrics_button)
+        self.layout().addWidget(self.save_segmentation_button)
+        self.layout().addWidget(self.compute_morphometrics_button)
+        self.layout().addWidget(self.morphometrics_progress_bar)
+        self.layout().addWidget(self.live_morphometrics_button)
+        self.layout().addWidget(self.save_session_button)
+        self.layout().addWidget(self.open_session_button)
+        self.layout().addWidget(performance_button)
         self.layout().addWidget(settings_menu_button)
         self.layout().addStretch()
+        self.discovery_thread.start()
+
+    def get_batch_thread(self):
+        if self.batch_thread is None:
+            self.batch_thread = _threads.BatchSegmentationThread()
+            self.batch_thread.model_cache = self.model_cache
+            self.batch_thread.job_finished_signal.connect(self._on_batch_job_finished)
+            self.batch_thread.batch_finished_signal.connect(self._on_batch_finished)
+        return self.batch_thread
+
+    def get_mask_loading_thread(self):
+        if self.mask_loading_thread is None:
+            from . import mask_loading
+            self.mask_loading_thread = mask_loading.MaskLoadingThread()
+            self.mask_loading_thread.mask_loaded_signal.connect(self._on_mask_loaded)
+            self.mask_loading_thread.loading_finished_signal.connect(self._on_mask_loading_finished)
+        return self.mask_loading_thread
+
+    def get_save_segmentation_thread(self):
+        if self.save_segmentation_thread is None:
+            self.save_segmentation_thread = _threads.SaveSegmentationThread()
+            self.save_segmentation_thread.save_finished_signal.connect(self._on_save_segmentation_finished)
+        return self.save_segmentation_thread
+
+    def get_morphometrics_thread(self):
+        if self.morphometrics_thread is None:
+            self.morphometrics_thread = _threads.MorphometricsThread()
+            self.morphometrics_thread.progress_signal.connect(self._on_morphometrics_progress)
+            self.morphometrics_thread.morphometrics_finished_signal.connect(self._on_morphometrics_finished)
+        return self.morphometrics_thread
+
+    def get_live_morphometrics_thread(self):
+        if self.live_morphometrics_thread is None:
+            self.live_morphometrics_thread = _threads.MorphometricsThread()
+            self.live_morphometrics_thread.keep_seeds = True
+            self.live_morphometrics_thread.morphometrics_finished_signal.connect(
+                self._on_live_morphometrics_measured)
+        return self.live_morphometrics_thread
+
+    def get_session_thread(self):
+        if self.session_thread is None:
+            from . import sessions
+            self.session_thread = sessions.SessionThread()
+            self.session_thread.session_finished_signal.connect(self._on_session_finished)
+        return self.session_thread
+
+    def _on_discovery_finished(self):
+        self.available_models = self.discovery_thread.available_models
+        self.model_selection_combobox.addItems(self.available_models)
+        self.settings.set_n_gpus(self.discovery_thread.n_gpus)
 
     def try_to_get_pixel_size_of_layer(self, layer):
-        image_path = Path(layer.source.path)
-        image_directory = image_path.parents[0]
-
-        # Check if the pixel size txt file exist in the image_directory
-        pixel_size_exists = (image_directory / "pixel_size_in_micrometer.txt").exists()
-
-        if pixel_size_exists:
-            resolution_file = open(str((image_directory / "pixel_size_in_micrometer.txt")), 'r')
-            pixel_size_float = float(resolution_file.read())
-            return pixel_size_float
-        else:
+        if get_layer_path(layer) is None:
             return None
+        return self.pixel_size_resolver.get_pixel_size(Path(get_layer_path(layer)))
+
+    def try_to_get_pixel_size_of_directory(self, image_directory):
+        return self.pixel_size_resolver.get_directory_pixel_size(image_directory)
 
     def add_layer_pixel_size_to_metadata(self, layer):
         pixel_size = self.try_to_get_pixel_size_of_layer(layer)
@@ -162,21 +506,37 @@ class ADSplugin(QWidget):
             return False
 
 
+    def get_selected_model_path(self):
+        selected_model = self.model_selection_combobox.currentText()
+        if selected_model not in self.available_models:
+            return None
+        return inference.get_ads_path() / "models" / selected_model
+
     def _on_apply_model_button_click(self):
+        from . import tiled
         selected_layers = self.viewer.layers.selection
-        selected_model = self.model_selection_combobox.currentText()
+        model_path = self.get_selected_model_path()
 
-        if selected_model not in self.available_models:
+        if model_path is None:
             self.show_info_message("No model selected")
             return
-        else:
-            ads_path = Path(AxonDeepSeg.__file__).parents[0]
-            model_path = ads_path / "models" / selected_model
         if len(selected_layers) != 1:
             self.show_info_message("No single image selected")
             return
         selected_layer = selected_layers.active
-        image_directory = Path(selected_layer.source.path).parents[0]
+        if not self.settings.in_memory and not self.settings.tiled and get_layer_path(selected_layer) is None:
+            self.show_info_message("The selected image has no file. Enable in-memory segmentation in the Settings menu")
+            return
+        # The patches can't overlap more than their size, which is only known by the configuration of the model
+        try:
+            patch_length = min(inference.get_model_config(model_path)["default_model"]["length_2D"])
+        except (OSError, KeyError, ValueError) as error:
+            self.show_info_message("Couldn't read the configuration of the model: " + str(error))
+            return
+        if not self.settings.no_patch and self.settings.overlap_value >= patch_length:
+            self.show_info_message("The overlap value must be smaller than the patch size of the model (" +
+                                   str(patch_length) + "). Change it in the Settings menu")
+            return
 
         # Check if the pixel size txt file exist in the imageDirPath
         if "pixel_size" not in selected_layer.metadata.keys():
@@ -188,41 +548,444 @@ class ADSplugin(QWidget):
 
         self.apply_model_button.setEnabled(False)
         self.apply_model_thread.selected_layer = selected_layer
-        self.apply_model_thread.image_directory = image_directory
-        self.apply_model_thread.path_testing_image = Path(selected_layer.source.path)
+        self.apply_model_thread.in_memory = self.settings.in_memory
+        self.apply_model_thread.tiled = self.settings.tiled
+        self.apply_model_thread.axonmyelin_layer = self.settings.axonmyelin_layer
+        if not self.settings.in_memory and not self.settings.tiled:
+            self.apply_model_thread.image_directory = Path(get_layer_path(selected_layer)).parents[0]
+            self.apply_model_thread.path_testing_image = Path(get_layer_path(selected_layer))
         self.apply_model_thread.path_model = model_path
         self.apply_model_thread.overlap_value = [self.settings.overlap_value, self.settings.overlap_value]
         self.apply_model_thread.zoom_factor = self.settings.zoom_factor
         self.apply_model_thread.no_patch = self.settings.no_patch
         self.apply_model_thread.gpu_id = self.settings.gpu_id
+        self.apply_model_thread.n_cpu_workers = self.settings.n_cpu_workers
+        self.apply_model_thread.backend = self.settings.get_backend(model_path.name)
+        self.apply_model_thread.progressive = (self.settings.progressive and self.settings.in_memory
+                                               and not self.settings.tiled and not self.settings.no_patch)
+        if self.apply_model_thread.progressive:
+            # The masks are shown empty, and filled as the patches are segmented, starting with the current view
+            image_shape = tiled.get_image_shape(selected_layer.data[0] if selected_layer.multiscale
+                                                else selected_layer.data, selected_layer.rgb)
+            self.add_class_map_layers(selected_layer, np.zeros(image_shape, dtype=np.uint8))
+            self.apply_model_thread.set_priority_box(regions.get_viewport_box(self.viewer, selected_layer))
+        self.apply_model_thread.profile_run = self.profiler.start_run("Apply model", selected_layer.name)
         show_info("Applying ADS model... This can take a few seconds. Check the console for more information.")
         self.apply_model_thread.start()
 
+    def _on_camera_changed(self, event=None):
+        if self.apply_model_thread.isRunning() and self.apply_model_thread.progressive:
+            self.apply_model_thread.set_priority_box(
+                regions.get_viewport_box(self.viewer, self.apply_model_thread.selected_layer))
+
+    def get_preview_layers(self):
+        """
+        :return: The mask layers filled by the progressive segmentation (only one layer if both masks are in it)
+        :rtype: list
+        """
+        mask_layers = self.associations.get_mask_layers(self.apply_model_thread.selected_layer)
+        if associations.AXONMYELIN_MASK in mask_layers:
+            return [mask_layers[associations.AXONMYELIN_MASK]]
+        layers = [mask_layers.get(associations.AXON_MASK), mask_layers.get(associations.MYELIN_MASK)]
+        return [layer for layer in layers if layer is not None]
+
+    def _on_patch_segmented(self, result):
+        from . import tiled
+        box, class_map = result
+        layers = self.get_preview_layers()
+        if len(layers) == 1 and masks.is_axonmyelin_layer(layers[0]):
+            tiled.write_class_map(box, class_map, class_output=pyramids.get_base_data(layers[0]))
+        elif len(layers) == 2:
+            tiled.write_class_map(box, class_map, axon_output=pyramids.get_base_data(layers[0]),
+                                  myelin_output=pyramids.get_base_data(layers[1]))
+        for layer in layers:
+            pyramids.update_layer(layer, box)
+        if not self.preview_refresh_timer.isActive():
+            self.preview_refresh_timer.start(PREVIEW_REFRESH_INTERVAL_MS)
+
+    def refresh_preview_layers(self):
+        for layer in self.get_preview_layers():
+            layer.refresh()
+
 
     def _on_model_finished_apply(self):
+        profile_run = self.apply_model_thread.profile_run
+        try:
+            self.add_model_result_layers(profile_run)
+        finally:
+            profile_run.finish()
+
+    def add_model_result_layers(self, profile_run):
+        from . import mask_loading
+        from config import axonmyelin_suffix
         self.apply_model_button.setEnabled(True)
+        self.handle_backend_fallback(self.apply_model_thread.path_model, self.apply_model_thread.backend_message)
+        if self.apply_model_thread.progressive:
+            # The masks were filled patch by patch
+            self.preview_refresh_timer.stop()
+            with profiling.stage("preview refresh", profile_run):
+                self.refresh_preview_layers()
         if not self.apply_model_thread.task_finished_successfully:
-            self.show_info_message("Couldn't apply the ADS model. Check the console for more information")
+            if self.apply_model_thread.progressive:
+                # The masks shown while the patches were segmented are incomplete
+                for layer in self.get_preview_layers():
+                    self.viewer.layers.remove(layer)
+            if self.apply_model_thread.mask_directory is not None:
+                from . import tiled
+                tiled.remove_temporary_directory(self.apply_model_thread.mask_directory)
+            profile_run.finish()
+            self.show_info_message(self.apply_model_thread.error_message or
+                                   "Couldn't apply the ADS model. Check the console for more information")
             return
 
         selected_layer = self.apply_model_thread.selected_layer
-        image_directory = self.apply_model_thread.image_directory
         image_name_no_extension = selected_layer.name
-        axon_mask_path = image_directory / (image_name_no_extension + str(axon_suffix))
-        axon_mask_name = image_name_no_extension + axon_suffix.stem
-        myelin_mask_path = image_directory / (image_name_no_extension + str(myelin_suffix))
-        myelin_mask_name = image_name_no_extension + myelin_suffix.stem
-
-        axon_data = ads_utils.imread(axon_mask_path).astype(bool)
-        self.viewer.add_labels(axon_data, color={1: 'blue'}, name=axon_mask_name,
-                               metadata={"associated_image_name": image_name_no_extension})
-        myelin_data = ads_utils.imread(myelin_mask_path).astype(bool)
-        self.viewer.add_labels(myelin_data, color={1: 'red'}, name=myelin_mask_name,
-                               metadata={"associated_image_name": image_name_no_extension})
-        selected_layer.metadata["associated_axon_mask_name"] = axon_mask_name
-        selected_layer.metadata["associated_myelin_mask_name"] = myelin_mask_name
+        # Kept with the morphometrics exported to a dataset
+        selected_layer.metadata["model"] = Path(self.apply_model_thread.path_model).name
+        selected_layer.metadata["zoom_factor"] = self.apply_model_thread.zoom_factor
+        if self.apply_model_thread.progressive:
+            return
+
+        if self.apply_model_thread.in_memory or self.apply_model_thread.tiled:
+            # The predicted masks are added as they are: in memory, or as on-disk arrays loaded lazily by napari
+            class_map = self.apply_model_thread.class_map
+            axon_data = self.apply_model_thread.axon_data
+            myelin_data = self.apply_model_thread.myelin_data
+            self.apply_model_thread.class_map = None
+            self.apply_model_thread.axon_data = None
+            self.apply_model_thread.myelin_data = None
+            with profiling.stage("layer creation", profile_run):
+                if class_map is not None:
+                    self.add_class_map_layers(selected_layer, class_map)
+                else:
+                    self.add_mask_layers(selected_layer, axon_data, myelin_data)
+            if self.apply_model_thread.mask_directory is not None:
+                self.temporary_directories[self.apply_model_thread.mask_directory] = [
+                    data for data in (class_map, axon_data, myelin_data) if data is not None]
+        else:
+            image_directory = self.apply_model_thread.image_directory
+            axonmyelin_mask_path = image_directory / (image_name_no_extension + str(axonmyelin_suffix))
+            from AxonDeepSeg import ads_utils
+            with profiling.stage("mask imread", profile_run):
+                mask_image = ads_utils.imread(axonmyelin_mask_path)
+            with profiling.stage("mask decoding", profile_run):
+                if self.settings.axonmyelin_layer:
+                    masks_data = mask_loading.decode_axonmyelin_image(mask_image,
+                                                                      lookup_tables=(mask_loading.CLASS_LUT,))
+                else:
+                    masks_data = mask_loading.decode_axonmyelin_image(mask_image)
+            with profiling.stage("layer creation", profile_run):
+                if self.settings.axonmyelin_layer:
+                    self.add_axonmyelin_layer(selected_layer, *masks_data)
+                else:
+                    self.add_mask_layers(selected_layer, *masks_data)
+
+    def add_mask_layers(self, image_layer, axon_data, myelin_data):
+        from config import axon_suffix, myelin_suffix
+        axon_mask_name = image_layer.name + axon_suffix.stem
+        myelin_mask_name = image_layer.name + myelin_suffix.stem
+        axon_layer = self.viewer.add_labels(self.get_display_data(axon_data, labels=True),
+                                            color={1: masks.MASK_COLORS["axon"]}, name=axon_mask_name,
+                                            metadata={"associated_image_name": image_layer.name})
+        myelin_layer = self.viewer.add_labels(self.get_display_data(myelin_data, labels=True),
+                                              color={1: masks.MASK_COLORS["myelin"]},
+                                              name=myelin_mask_name,
+                                              metadata={"associated_image_name": image_layer.name})
+        myelin_layer.events.paint.connect(self._on_myelin_layer_painted)
+        self.connect_pyramid_updates(axon_layer)
+        self.connect_pyramid_updates(myelin_layer)
+        self.associations.associate(image_layer, axon_layer, associations.AXON_MASK)
+        self.associations.associate(image_layer, myelin_layer, associations.MYELIN_MASK)
+
+    def add_axonmyelin_layer(self, image_layer, class_map):
+        """
+        Adds a single Labels layer containing both masks (0: background, 1: myelin, 2: axon).
+        """
+        from config import axonmyelin_suffix
+        axonmyelin_mask_name = image_layer.name + axonmyelin_suffix.stem
+        colors = {masks.MASK_LABELS[kind]: color for kind, color in masks.MASK_COLORS.items()}
+        axonmyelin_layer = self.viewer.add_labels(self.get_display_data(class_map, labels=True), color=colors,
+                                                  name=axonmyelin_mask_name,
+                                                  metadata={"associated_image_name": image_layer.name,
+                                                            "mask_type": masks.AXONMYELIN_MASK_TYPE})
+        axonmyelin_layer.events.paint.connect(self._on_myelin_layer_painted)
+        self.connect_pyramid_updates(axonmyelin_layer)
+        self.associations.associate(image_layer, axonmyelin_layer, associations.AXONMYELIN_MASK)
+
+    def add_class_map_layers(self, image_layer, class_map):
+        """
+        Adds the masks of a class map, as a single layer or as two layers depending on the settings.
+        """
+        if self.settings.axonmyelin_layer:
+            self.add_axonmyelin_layer(image_layer, class_map)
+        else:
+            axon_data, myelin_data = inference.split_class_map(class_map)
+            self.add_mask_layers(image_layer, axon_data, myelin_data)
+
+    def get_display_data(self, data, labels=False, rgb=False, cache_key=None):
+        """
+        :param data: The data of a new layer
+        :param cache_key: The key of the pyramid in the pyramid cache, or None to build it without the cache
+        :return: The multiscale data of a large layer, whose coarse levels are built in the background, or the data
+                 itself
+        """
+        if not self.settings.multiscale_display or not pyramids.needs_pyramid(tuple(data.shape), rgb):
+            return data
+        pyramid = pyramids.Pyramid(data, labels=labels, rgb=rgb)
+        self.pyramid_thread.add(pyramid, self.pyramid_cache if cache_key is not None else None, cache_key)
+        return pyramid.get_data()
+
+    def connect_pyramid_updates(self, mask_layer):
+        if pyramids.get_pyramid(mask_layer) is not None:
+            mask_layer.events.paint.connect(self._on_mask_layer_painted)
+
+    def _on_mask_layer_painted(self, event):
+        mask_layer = event.source
+        event_box = regions.get_paint_event_bounding_box(event, pyramids.get_base_data(mask_layer).shape)
+        if event_box is not None:
+            # The paint event can be sent before the data is modified
+            QtCore.QTimer.singleShot(0, lambda: self.update_pyramid(mask_layer, event_box))
+
+    @staticmethod
+    def update_pyramid(mask_layer, box):
+        pyramids.update_layer(mask_layer, box)
+        mask_layer.refresh()
+
+    def _on_layer_inserted(self, event):
+        layer = event.value
+        if (self.settings.multiscale_display and layer.__class__ == napari.layers.image.image.Image
+                and not layer.multiscale and pyramids.needs_pyramid(tuple(layer.data.shape), layer.rgb)):
+            # The layers can't be replaced while the layer list sends its events
+            QtCore.QTimer.singleShot(0, lambda: self.show_multiscale_image(layer))
+
+    def _on_layer_removed(self, event):
+        self.remove_unused_temporary_directories()
+
+    def remove_unused_temporary_directories(self):
+        from . import tiled
+        shown_data = [pyramids.get_base_data(layer) for layer in self.viewer.layers
+                      if isinstance(layer, (napari.layers.Image, napari.layers.Labels))]
+        for directory, arrays in list(self.temporary_directories.items()):
+            if not any(shown is array for shown in shown_data for array in arrays):
+                del self.temporary_directories[directory]
+                tiled.remove_temporary_directory(directory)
+
+    def show_multiscale_image(self, image_layer):
+        """
+        Replaces a large image layer by a multiscale layer showing the same image, with the same properties.
+        """
+        if image_layer not in self.viewer.layers or image_layer.multiscale:
+            return
+        if self.apply_model_thread.isRunning() and self.apply_model_thread.selected_layer is image_layer:
+            # The segmentation reads the layer, so it is replaced once the segmentation is done
+            QtCore.QTimer.singleShot(1000, lambda: self.show_multiscale_image(image_layer))
+            return
+        source_path = get_layer_path(image_layer)
+        cache_key = None
+        if self.settings.cache_pyramids and source_path is not None:
+            try:
+                cache_key = pyramids.get_cache_key(source_path, rgb=image_layer.rgb)
+            except OSError:
+                # The file was moved or removed since it was opened
+                cache_key = None
+        data = self.get_display_data(image_layer.data, rgb=image_layer.rgb, cache_key=cache_key)
+        index = self.viewer.layers.index(image_layer)
+        selected = image_layer in self.viewer.layers.selection
+        display_properties = {"contrast_limits": image_layer.contrast_limits, "opacity": image_layer.opacity,
+                              "blending": image_layer.blending, "visible": image_layer.visible,
+                              "scale": image_layer.scale, "translate": image_layer.translate}
+        if not image_layer.rgb:
+            display_properties.update(colormap=image_layer.colormap, gamma=image_layer.gamma)
+        self.viewer.layers.remove(image_layer)
+        multiscale_layer = self.add_image_with_path(data, source_path, reader_plugin=image_layer.source.reader_plugin,
+                                                    name=image_layer.name, metadata=image_layer.metadata,
+                                                    rgb=image_layer.rgb, multiscale=True, **display_properties)
+        self.viewer.layers.move(len(self.viewer.layers) - 1, index)
+        self.associations.replace_layer(image_layer, multiscale_layer)
+        if selected:
+            self.viewer.layers.selection.active = multiscale_layer
+        show_info(image_layer.name + " is shown as a multiscale image (see the Settings menu)")
+
+    def add_image_with_path(self, data, path, reader_plugin=None, **kwargs):
+        """
+        Adds an image layer that keeps the file it was read from, as the AxonDeepSeg segmentation reads it.
+        :param kwargs: The arguments of viewer.add_image
+        :return: The image layer
+        """
+        try:
+            # Private API of napari, which may change
+            from napari.layers._source import layer_source
+        except ImportError:
+            layer_source = None
+        if layer_source is None or path is None:
+            metadata = dict(kwargs.pop("metadata", None) or {})
+            if path is not None:
+                metadata[IMAGE_PATH_KEY] = str(path)
+            return self.viewer.add_image(data, metadata=metadata, **kwargs)
+        with layer_source(path=str(path), reader_plugin=reader_plugin):
+            return self.viewer.add_image(data, **kwargs)
+
+    def _on_pyramid_built(self, pyramid):
+        # The image levels were read with a stride until they were built
+        for layer in self.viewer.layers:
+            if pyramids.get_pyramid(layer) is pyramid:
+                layer.refresh()
+
+    def _on_pyramid_thread_finished(self):
+        # A pyramid can be queued while the thread is stopping
+        if self.pyramid_thread.has_queued_pyramids():
+            self.pyramid_thread.start()
+
+    def _on_batch_selected_images_button_click(self):
+        from . import batch
+        model_path = self.get_selected_model_path()
+        if model_path is None:
+            self.show_info_message("No model selected")
+            return
+        image_layers = [layer for layer in self.viewer.layers.selection
+                        if layer.__class__ == napari.layers.image.image.Image]
+        if len(image_layers) == 0:
+            self.show_info_message("No image selected")
+            return
+
+        # Ask for the missing pixel sizes once before starting, so the batch never waits on a prompt
+        missing_layers = [layer for layer in image_layers if "pixel_size" not in layer.metadata.keys()
+                          and not self.add_layer_pixel_size_to_metadata(layer)]
+        if len(missing_layers) > 0:
+            pixel_size = self.get_pixel_size_with_prompt(
+                "Enter the pixel size in micrometers of the " + str(len(missing_layers)) + " images without one")
+            if pixel_size is None:
+                return
+            for layer in missing_layers:
+                layer.metadata["pixel_size"] = pixel_size
+
+        jobs = [batch.BatchJob(layer.name, layer.metadata["pixel_size"], image=pyramids.get_base_data(layer),
+                               rgb=layer.rgb)
+                for layer in image_layers]
+        self.batch_image_layers = image_layers
+        self.start_batch(model_path, jobs, save_masks=False, summary_path=None)
+
+    def _on_batch_folder_button_click(self):
+        from . import batch
+        model_path = self.get_selected_model_path()
+        if model_path is None:
+            self.show_info_message("No model selected")
+            return
+        folder = QFileDialog.getExistingDirectory(self, "Select the folder to segment")
+        if folder == "":
+            return
+        folder = Path(folder)
+        image_paths = batch.get_images_in_folder(folder)
+        if len(image_paths) == 0:
+            self.show_info_message("No image found in the folder")
+            return
+
+        # The metadata of the images are read in the background, then the batch starts
+        self.scanned_folder = folder
+        self.scanned_model_path = model_path
+        self.pixel_size_scan_thread.image_paths = image_paths
+        self.set_batch_running(True)
+        self.batch_progress_bar.setMaximum(0)
+        show_info("Reading the pixel sizes of " + str(len(image_paths)) + " images...")
+        self.pixel_size_scan_thread.start()
+
+    def _on_pixel_size_scan_finished(self):
+        from . import batch
+        pixel_sizes = self.pixel_size_scan_thread.pixel_sizes
+        if len(pixel_sizes) < len(self.pixel_size_scan_thread.image_paths):
+            # Cancelled
+            self.set_batch_running(False)
+            return
+        missing_paths = [image_path for image_path, pixel_size in pixel_sizes.items() if pixel_size is None]
+        if len(missing_paths) > 0:
+            pixel_size = self.get_pixel_size_with_prompt(
+                "Enter the pixel size in micrometers of the " + str(len(missing_paths)) + " images without one")
+            if pixel_size is None:
+                self.set_batch_running(False)
+                return
+            for image_path in missing_paths:
+                pixel_sizes[image_path] = pixel_size
+
+        jobs = [batch.BatchJob(image_path.stem, pixel_size, path=image_path)
+                for image_path, pixel_size in pixel_sizes.items()]
+        self.batch_image_layers = []
+        self.start_batch(self.scanned_model_path, jobs, save_masks=True,
+                         summary_path=self.scanned_folder / batch.SUMMARY_FILE_NAME)
+
+    def start_batch(self, model_path, jobs, save_masks, summary_path):
+        from . import batch
+        self.set_batch_running(True)
+        self.batch_progress_bar.setMaximum(len(jobs))
+        self.batch_progress_bar.setValue(0)
+        self.batch_progress_bar.setFormat("%v/%m images")
+        self.get_batch_thread()
+        self.batch_thread.jobs = jobs
+        self.batch_thread.path_model = model_path
+        self.batch_thread.settings = batch.BatchSettings(
+            overlap_value=self.settings.overlap_value,
+            zoom_factor=self.settings.zoom_factor,
+            axon_shape=self.settings.axon_shape,
+            no_patch=self.settings.no_patch,
+            gpu_id=self.settings.gpu_id,
+            n_cpu_workers=self.settings.n_cpu_workers,
+            n_batch_workers=self.settings.n_batch_workers,
+            backend=self.settings.get_backend(model_path.name),
+            save_format=self.settings.save_format,
+            save_masks=save_masks
+        )
+        self.batch_thread.summary_path = summary_path
+        show_info("Segmenting " + str(len(jobs)) + " images... Check the console for more information.")
+        self.batch_thread.start()
+
+    def set_batch_running(self, running):
+        self.apply_model_button.setEnabled(not running)
+        self.batch_selected_images_button.setEnabled(not running)
+        self.batch_folder_button.setEnabled(not running)
+        self.cancel_batch_button.setEnabled(running)
+        self.batch_progress_bar.setVisible(running)
+
+    def _on_cancel_batch_button_click(self):
+        if self.pixel_size_scan_thread.isRunning():
+            self.pixel_size_scan_thread.cancel()
+        if self.batch_thread is not None:
+            self.batch_thread.cancel()
+        self.cancel_batch_button.setEnabled(False)
+
+    def _on_batch_job_finished(self, job_index):
+        self.batch_progress_bar.setValue(self.batch_progress_bar.value() + 1)
+        job = self.batch_thread.jobs[job_index]
+        # The console gets the summary at the end of the batch
+        self.batch_progress_bar.setFormat("%v/%m images - " + job.name + ": " + job.status + " (" +
+                                          str(round(job.get_total_time(), 2)) + " s)")
+        if job.status == "done" and len(self.batch_image_layers) > 0:
+            self.add_class_map_layers(self.batch_image_layers[job_index], job.class_map)
+            job.class_map = None
+
+    def _on_batch_finished(self):
+        from . import batch
+        self.set_batch_running(False)
+        self.batch_image_layers = []
+        self.handle_backend_fallback(self.batch_thread.path_model, self.batch_thread.backend_message)
+        show_info(batch.get_summary_string(self.batch_thread.jobs))
+
+    def handle_backend_fallback(self, model_path, backend_message):
+        """
+        Shows why a model was applied with PyTorch instead of its backend, and uses PyTorch for the next runs.
+        :param backend_message: The message of backends.load_session, empty if the backend was used
+        """
+        if not backend_message:
+            return
+        self.settings.model_backends.pop(Path(model_path).name, None)
+        self.show_info_message(backend_message)
 
     def _on_load_mask_button_click(self):
+        from . import mask_loading
+        image_layers = [layer for layer in self.viewer.layers.selection
+                        if layer.__class__ == napari.layers.image.image.Image]
+        if len(image_layers) > 1:
+            self.load_masks_of_images(image_layers)
+            return
+
         microscopy_image_layer = self.get_microscopy_image()
         if microscopy_image_layer is None:
             self.show_info_message("No single image selected/detected")
@@ -235,25 +998,65 @@ class ADSplugin(QWidget):
         if not self.show_ok_cancel_message("The mask will be associated with " + microscopy_image_layer.name):
             return
 
-        img_png2D = ads_utils.imread(mask_file_path)
-        # Extract the Axon mask
-        axon_data = img_png2D > 200
-        axon_data = axon_data.astype(np.uint8)
-        axon_mask_name = microscopy_image_layer.name + config.axon_suffix.stem
-        # Extract the Myelin mask
-        myelin_data = (img_png2D > 100) & (img_png2D < 200)
-        myelin_data = myelin_data.astype(np.uint8)
-        myelin_mask_name = microscopy_image_layer.name + config.myelin_suffix.stem
-
-        # Load the masks and add metadata to the files to keep a link between them
-        self.viewer.add_labels(axon_data, color={1: 'blue'}, name=axon_mask_name,
-                               metadata={"associated_image_name": microscopy_image_layer.name})
-        self.viewer.add_labels(myelin_data, color={1: 'red'}, name=myelin_mask_name,
-                               metadata={"associated_image_name": microscopy_image_layer.name})
-        microscopy_image_layer.metadata["associated_axon_mask_name"] = axon_mask_name
-        microscopy_image_layer.metadata["associated_myelin_mask_name"] = myelin_mask_name
+        self.start_mask_loading([mask_loading.MaskLoadingJob(microscopy_image_layer.name, mask_file_path,
+                                                             axonmyelin_layer=self.settings.axonmyelin_layer)])
+
+    def load_masks_of_images(self, image_layers):
+        """
+        Loads the masks of several images, found by name in a folder.
+        """
+        from . import mask_loading
+        masks_directory = QFileDialog.getExistingDirectory(self, "Select the folder containing the masks")
+        if masks_directory == "":
+            return
+        jobs = []
+        missing_image_names = []
+        for layer in image_layers:
+            mask_path = mask_loading.find_axonmyelin_mask(masks_directory, layer.name)
+            if mask_path is None:
+                missing_image_names.append(layer.name)
+            else:
+                jobs.append(mask_loading.MaskLoadingJob(layer.name, mask_path,
+                                                        axonmyelin_layer=self.settings.axonmyelin_layer))
+        if len(missing_image_names) > 0:
+            show_info("No mask found for: " + ", ".join(missing_image_names))
+        if len(jobs) > 0:
+            self.start_mask_loading(jobs)
+
+    def start_mask_loading(self, jobs):
+        if self.get_mask_loading_thread().isRunning():
+            self.show_info_message("Masks are already being loaded")
+            return
+        profile_run = self.profiler.start_run("Load masks", jobs[0].image_name if len(jobs) == 1 else None)
+        for job in jobs:
+            job.profile_run = profile_run
+        self.mask_loading_thread.profile_run = profile_run
+        self.mask_loading_thread.jobs = jobs
+        self.load_mask_button.setEnabled(False)
+        self.mask_loading_thread.start()
+
+    def _on_mask_loaded(self, job_index):
+        job = self.mask_loading_thread.jobs[job_index]
+        microscopy_image_layer = self.get_layer_by_name(job.image_name)
+        if job.error != "":
+            show_info("Couldn't load " + job.path.name + ": " + job.error)
+        elif microscopy_image_layer is not None:
+            # Load the masks and add metadata to the files to keep a link between them
+            with profiling.stage("layer creation " + job.image_name, job.profile_run):
+                if job.axonmyelin_layer:
+                    self.add_axonmyelin_layer(microscopy_image_layer, job.class_map)
+                else:
+                    self.add_mask_layers(microscopy_image_layer, job.axon_data, job.myelin_data)
+        job.axon_data = None
+        job.myelin_data = None
+        job.class_map = None
+
+    def _on_mask_loading_finished(self):
+        self.load_mask_button.setEnabled(True)
+        self.mask_loading_thread.profile_run.finish()
 
     def _on_fill_axons_click(self):
+        from .fill_axons import fill_axons
         axon_layer = self.get_axon_layer()
         myelin_layer = self.get_myelin_layer()
 
@@ -261,14 +1064,46 @@ class ADSplugin(QWidget):
             self.show_info_message("One or more masks missing")
             return
 
-        myelin_array = np.array(myelin_layer.data, copy=True)
-        axon_extracted_array = postprocessing.fill_myelin_holes(myelin_array)
-        axon_array_indexes = np.where(axon_extracted_array > 0)
-        axon_layer._save_history((axon_array_indexes,
-                                  np.array(axon_layer.data[axon_array_indexes], copy=True),
-                                  1))
-        axon_layer.data[axon_array_indexes] = 1
-        axon_layer.refresh()
+        if self.settings.fill_region == "Current view":
+            fill_box = regions.get_viewport_box(self.viewer, myelin_layer)
+        elif self.settings.fill_region == "Last drawn shape":
+            shapes_layers = [layer for layer in self.viewer.layers
+                             if layer.__class__ == napari.layers.shapes.shapes.Shapes and len(layer.data) > 0]
+            if len(shapes_layers) == 0:
+                self.show_info_message("No shape drawn")
+                return
+            fill_box = regions.get_shapes_box(shapes_layers[-1], myelin_layer)
+        elif self.settings.fill_region == "Recent myelin edits":
+            fill_box = self.myelin_edited_boxes.get(myelin_layer)
+            if fill_box is None:
+                self.show_info_message("No myelin edit since the last fill")
+                return
+        else:
+            fill_box = tuple(slice(0, length) for length in pyramids.get_base_data(myelin_layer).shape)
+
+        if fill_box is None:
+            self.show_info_message("The selected region doesn't overlap the masks")
+            return
+        if regions.get_box_size(fill_box) == pyramids.get_base_data(myelin_layer).size:
+            fill_box = None
+        profile_run = self.profiler.start_run("Fill axons", axon_layer.metadata.get("associated_image_name"))
+        with profiling.stage("fill axons", profile_run):
+            filled_box = fill_axons(axon_layer, myelin_layer, fill_box)
+        profile_run.finish()
+        self.myelin_edited_boxes.pop(myelin_layer, None)
+        # The axon layer is written without a paint event, so the live morphometrics are updated here
+        if (filled_box is not None and self.live_morphometrics is not None and
+                axon_layer in self.live_morphometrics.get_layers()):
+            self.live_morphometrics.invalidate(filled_box)
+
+    def _on_myelin_layer_painted(self, event):
+        myelin_layer = event.source
+        event_box = regions.get_paint_event_bounding_box(event, pyramids.get_base_data(myelin_layer).shape)
+        if event_box is None:
+            return
+        edited_box = self.myelin_edited_boxes.get(myelin_layer)
+        self.myelin_edited_boxes[myelin_layer] = (event_box if edited_box is None
+                                                  else regions.merge_boxes(edited_box, event_box))
 
     def _on_save_segmentation_button(self):
         axon_layer = self.get_axon_layer()
@@ -278,24 +1113,51 @@ class ADSplugin(QWidget):
             self.show_info_message("One or more masks missing")
             return
         save_path = QFileDialog.getExistingDirectory(self, "Select where the segmentation should be saved")
-        save_path = Path(save_path)
-
-        # Scale the pixel values of the masks to 255 for image saving
-        myelin_array = myelin_layer.data * params.intensity['binary']
-        axon_array = axon_layer.data * params.intensity['binary']
-
-        myelin_and_axon_array = (myelin_array // 2 + axon_array).astype(np.uint8)
+        if save_path == "":
+            return
 
         microscopy_image_name = axon_layer.metadata["associated_image_name"]
-        axon_image_name = microscopy_image_name + str(config.axon_suffix)
-        myelin_image_name = microscopy_image_name + str(config.myelin_suffix)
-        axonmyelin_image_name = microscopy_image_name + str(config.axonmyelin_suffix)
-
-        ads_utils.imwrite(filename=save_path / axonmyelin_image_name, img=myelin_and_axon_array)
-        ads_utils.imwrite(filename=save_path / myelin_image_name, img=myelin_array)
-        ads_utils.imwrite(filename=save_path / axon_image_name, img=axon_array)
+        microscopy_image_layer = self.get_microscopy_image()
+        pixel_size = None
+        if microscopy_image_layer is not None:
+            pixel_size = microscopy_image_layer.metadata.get("pixel_size")
+
+        # The masks are written in the background, so the ones in memory are copied to keep the edits made in the
+        # meantime out of the files. The masks stored on disk (tiled segmentation) are read block by block instead.
+        profile_run = self.profiler.start_run("Save segmentation", microscopy_image_name)
+        with profiling.stage("mask copy", profile_run):
+            if masks.is_axonmyelin_layer(axon_layer):
+                axon_data, myelin_data = masks.split_views(self.copy_mask_data(pyramids.get_base_data(axon_layer)))
+            else:
+                axon_data = self.copy_mask_data(pyramids.get_base_data(axon_layer))
+                myelin_data = self.copy_mask_data(pyramids.get_base_data(myelin_layer))
+        self.get_save_segmentation_thread()
+        self.save_segmentation_thread.profile_run = profile_run
+        self.save_segmentation_thread.axon_data = axon_data
+        self.save_segmentation_thread.myelin_data = myelin_data
+        self.save_segmentation_thread.save_directory = Path(save_path)
+        self.save_segmentation_thread.image_name = microscopy_image_name
+        self.save_segmentation_thread.save_format = self.settings.save_format
+        self.save_segmentation_thread.pixel_size = pixel_size
+        self.save_segmentation_button.setEnabled(False)
+        self.save_segmentation_thread.start()
+
+    @staticmethod
+    def copy_mask_data(mask_data):
+        if isinstance(mask_data, np.ndarray) and not isinstance(mask_data, np.memmap):
+            return mask_data.copy()
+        return mask_data
+
+    def _on_save_segmentation_finished(self, error_message):
+        self.save_segmentation_button.setEnabled(True)
+        self.save_segmentation_thread.profile_run.finish()
+        if error_message != "":
+            self.show_info_message(error_message)
+        else:
+            show_info("Segmentation saved")
 
     def _on_compute_morphometrics_button(self):
+        from . import morphometrics_export
         axon_layer = self.get_axon_layer()
         myelin_layer = self.get_myelin_layer()
         microscopy_image_layer = self.get_microscopy_image()
@@ -303,9 +1165,6 @@ class ADSplugin(QWidget):
         if (axon_layer is None) or (myelin_layer is None) or (microscopy_image_layer is None):
             self.show_info_message("Image or mask(s) missing.")
             return
-        axon_data = axon_layer.data
-        myelin_data = myelin_layer.data
-
 
         # Try to find the pixel size
         if "pixel_size" not in microscopy_image_layer.metadata.keys():
@@ -316,35 +1175,312 @@ class ADSplugin(QWidget):
         if pixel_size is None:
             return
 
-        # Ask the user where to save
+        # Ask the user where to save. A Parquet dataset receives the morphometrics of several images.
         default_name = Path(os.getcwd()) / "Morphometrics.csv"
-        file_name, selected_filter = QFileDialog.getSaveFileName(self, caption="Select where to save morphometrics",
-                                                                 directory=str(default_name), filter= "CSV file(*.csv)")
+        file_name, selected_filter = QFileDialog.getSaveFileName(
+            self, caption="Select where to save morphometrics", directory=str(default_name),
+            filter=morphometrics_export.CSV_FILTER + ";;" + morphometrics_export.PARQUET_FILTER)
         if file_name == "":
             return
 
-        # Compute statistics
-        stats_dataframe, index_image_array = compute_morphs.get_axon_morphometrics(im_axon=axon_data,
-                                                                                   im_myelin=myelin_data,
-                                                                                   pixel_size=pixel_size,
-                                                                                   axon_shape=self.settings.axon_shape,
-                                                                                   return_index_image=True)
-        try:
-            compute_morphs.save_axon_morphometrics(file_name, stats_dataframe)
+        # The statistics are computed tile by tile by several processes, in the background
+        self.get_morphometrics_thread()
+        self.morphometrics_thread.profile_run = self.profiler.start_run("Compute morphometrics",
+                                                                        microscopy_image_layer.name)
+        # The masks are copied like when they are saved, so the edits made in the meantime don't change the results
+        if masks.is_axonmyelin_layer(axon_layer):
+            axon_data, myelin_data = masks.split_views(self.copy_mask_data(pyramids.get_base_data(axon_layer)))
+        else:
+            axon_data = self.copy_mask_data(pyramids.get_base_data(axon_layer))
+            myelin_data = self.copy_mask_data(pyramids.get_base_data(myelin_layer))
+        self.morphometrics_thread.axon_data = axon_data
+        self.morphometrics_thread.myelin_data = myelin_data
+        self.morphometrics_thread.pixel_size = pixel_size
+        self.morphometrics_thread.axon_shape = self.settings.axon_shape
+        self.morphometrics_thread.n_workers = self.settings.n_cpu_workers
+        export_format = morphometrics_export.get_export_format(selected_filter)
+        if export_format == morphometrics_export.PARQUET_FORMAT and Path(file_name).suffix.lower() == ".csv":
+            file_name = str(Path(file_name).with_suffix(".parquet"))
+        self.morphometrics_thread.file_name = file_name
+        self.morphometrics_thread.export_format = export_format
+        self.morphometrics_thread.partition_values = {
+            "image_name": microscopy_image_layer.name,
+            "pixel_size": pixel_size,
+            "model": microscopy_image_layer.metadata.get("model"),
+            "zoom_factor": microscopy_image_layer.metadata.get("zoom_factor", self.settings.zoom_factor),
+            "axon_shape": self.settings.axon_shape,
+        }
+        self.morphometrics_image_layer = microscopy_image_layer
+        self.compute_morphometrics_button.setEnabled(False)
+        self.morphometrics_progress_bar.setValue(0)
+        self.morphometrics_progress_bar.setVisible(True)
+        self.morphometrics_thread.start()
+
+    def _on_morphometrics_progress(self, n_tiles_done, n_tiles):
+        self.morphometrics_progress_bar.setMaximum(n_tiles)
+        self.morphometrics_progress_bar.setValue(n_tiles_done)
+
+    def _on_morphometrics_finished(self, error_message):
+        self.compute_morphometrics_button.setEnabled(True)
+        self.morphometrics_progress_bar.setVisible(False)
+        profile_run = self.morphometrics_thread.profile_run
+        stats_dataframe = self.morphometrics_thread.stats_dataframe
+        self.morphometrics_thread.stats_dataframe = None
+        if stats_dataframe is not None:
+            self.last_morphometrics = stats_dataframe
+            self.last_morphometrics_image_name = self.morphometrics_image_layer.name
+            with profiling.stage("axon numbers", profile_run):
+                self.show_axon_numbers(self.morphometrics_image_layer, stats_dataframe)
+        self.morphometrics_image_layer = None
+        profile_run.finish()
+        if error_message != "":
+            self.show_info_message(error_message)
+
+    def show_axon_numbers(self, image_layer, stats_dataframe):
+        """
+        Shows the number of each axon at its centroid. The numbers already shown on the image are replaced.
+        """
+        from .axon_numbers import AxonNumbers
+        axon_numbers = self.axon_numbers.get(image_layer.name)
+        if axon_numbers is None:
+            axon_numbers = AxonNumbers(self.viewer, image_layer)
+            self.axon_numbers[image_layer.name] = axon_numbers
+        axon_numbers.set_dataframe(stats_dataframe)
+
+    def _on_live_morphometrics_toggled(self, checked):
+        from .live_morphometrics import LiveMorphometrics, MorphometricsTable
+        if not checked:
+            if self.live_morphometrics is not None:
+                self.live_morphometrics.stop()
+                self.live_morphometrics = None
+            return
 
-        except IOError:
-            self.show_info_message("Cannot save morphometrics")
+        if self.get_live_morphometrics_thread().isRunning():
+            self.show_info_message("The previous live morphometrics are still being measured")
+            self.live_morphometrics_button.setChecked(False)
+            return
+        axon_layer = self.get_axon_layer()
+        myelin_layer = self.get_myelin_layer()
+        microscopy_image_layer = self.get_microscopy_image()
+        if (axon_layer is None) or (myelin_layer is None) or (microscopy_image_layer is None):
+            self.show_info_message("Image or mask(s) missing.")
+            self.live_morphometrics_button.setChecked(False)
+            return
+        if "pixel_size" not in microscopy_image_layer.metadata.keys():
+            pixel_size = self.get_pixel_size_with_prompt()
+            if pixel_size is None:
+                self.live_morphometrics_button.setChecked(False)
+                return
+            microscopy_image_layer.metadata["pixel_size"] = pixel_size
+
+        if self.morphometrics_table is None:
+            self.morphometrics_table = MorphometricsTable()
+            self.viewer.window.add_dock_widget(self.morphometrics_table, name="Morphometrics", area="right")
+        self.live_morphometrics = LiveMorphometrics(axon_layer, myelin_layer,
+                                                    pixel_size=microscopy_image_layer.metadata["pixel_size"],
+                                                    axon_shape=self.settings.axon_shape,
+                                                    on_update=self._on_live_morphometrics_updated)
+        # The whole image is measured in the background, on a copy of the masks. The edits made meanwhile are kept by
+        # the engine and measured once the results are set.
+        if masks.is_axonmyelin_layer(axon_layer):
+            axon_data, myelin_data = masks.split_views(self.copy_mask_data(pyramids.get_base_data(axon_layer)))
+        else:
+            axon_data = self.copy_mask_data(pyramids.get_base_data(axon_layer))
+            myelin_data = self.copy_mask_data(pyramids.get_base_data(myelin_layer))
+        self.live_morphometrics.start()
+        thread = self.live_morphometrics_thread
+        thread.axon_data = axon_data
+        thread.myelin_data = myelin_data
+        thread.pixel_size = microscopy_image_layer.metadata["pixel_size"]
+        thread.axon_shape = self.settings.axon_shape
+        thread.n_workers = self.settings.n_cpu_workers
+        thread.profile_run = self.profiler.start_run("Live morphometrics", microscopy_image_layer.name)
+        show_info("Measuring the axons of " + microscopy_image_layer.name + "...")
+        thread.start()
+
+    def _on_live_morphometrics_measured(self, error_message):
+        thread = self.live_morphometrics_thread
+        stats_dataframe = thread.stats_dataframe
+        thread.stats_dataframe = None
+        thread.profile_run.finish()
+        if self.live_morphometrics is None:
+            # The live morphometrics were stopped during the measure
+            return
+        if error_message != "":
+            self.live_morphometrics_button.setChecked(False)
+            self.show_info_message(error_message)
+            return
+        self.live_morphometrics.set_stats_dataframe(stats_dataframe)
+        self.morphometrics_table.set_dataframe(self.live_morphometrics.stats_dataframe)
+        image_layer = self.associations.get_image_layer(self.live_morphometrics.axon_layer)
+        if image_layer is not None:
+            self.show_axon_numbers(image_layer, self.live_morphometrics.stats_dataframe)
+
+    def _on_live_morphometrics_updated(self, removed_ids, added_rows):
+        self.morphometrics_table.update_rows(removed_ids, added_rows)
+        image_name = self.live_morphometrics.axon_layer.metadata["associated_image_name"]
+        axon_numbers = self.axon_numbers.get(image_name)
+        if axon_numbers is None:
+            return
+        if axon_numbers.is_shown():
+            axon_numbers.update(removed_ids, added_rows, len(self.live_morphometrics.stats_dataframe))
+        else:
+            axon_numbers.set_dataframe(self.live_morphometrics.stats_dataframe)
+
+    def _on_save_session_button_click(self):
+        from . import sessions
+        if self.get_session_thread().isRunning():
+            self.show_info_message("A session is already being saved or opened")
+            return
+        image_layers = [layer for layer in self.viewer.layers if layer.__class__ == napari.layers.image.image.Image]
+        if len(image_layers) == 0:
+            self.show_info_message("No image to save in the session")
+            return
+        default_name = Path(os.getcwd()) / ("session" + sessions.SESSION_EXTENSION)
+        file_name, _ = QFileDialog.getSaveFileName(self, caption="Select where to save the session",
+                                                   directory=str(default_name), filter=sessions.SESSION_FILTER)
+        if file_name == "":
+            return
+        directory = Path(file_name)
+        if directory.suffix != sessions.SESSION_EXTENSION:
+            directory = directory.with_name(directory.name + sessions.SESSION_EXTENSION)
+
+        # The masks are written in the background, so the ones in memory are copied like when saving a segmentation
+        session_images = []
+        images_without_file = []
+        for image_layer in image_layers:
+            if get_layer_path(image_layer) is None:
+                images_without_file.append(image_layer.name)
+                continue
+            mask_data = {kind: self.copy_mask_data(pyramids.get_base_data(mask_layer))
+                         for kind, mask_layer in self.associations.get_mask_layers(image_layer).items()}
+            session_images.append(sessions.SessionImage(image_layer.name, get_layer_path(image_layer),
+                                                        rgb=image_layer.rgb, metadata=image_layer.metadata,
+                                                        masks=mask_data))
+        if len(images_without_file) > 0:
+            show_info("Images without a file aren't saved in the session: " + ", ".join(images_without_file))
+        if len(session_images) == 0:
+            return
+        session_settings = self.settings.get_session_settings()
+        session_settings["selected_model"] = self.model_selection_combobox.currentText()
+        # The live morphometrics are the last ones computed when they are on
+        if self.live_morphometrics is not None and self.live_morphometrics.stats_dataframe is not None:
+            self.last_morphometrics = self.live_morphometrics.stats_dataframe
+            self.last_morphometrics_image_name = self.live_morphometrics.axon_layer.metadata["associated_image_name"]
+        self.session_thread.session = sessions.Session(session_images, session_settings, self.last_morphometrics,
+                                                       self.last_morphometrics_image_name)
+        self.session_thread.directory = directory
+        self.session_thread.saving = True
+        self.set_session_running(True)
+        self.session_thread.start()
+
+    def _on_open_session_button_click(self):
+        from . import sessions
+        if self.get_session_thread().isRunning():
+            self.show_info_message("A session is already being saved or opened")
+            return
+        directory = QFileDialog.getExistingDirectory(self, "Select the session to open")
+        if directory == "":
+            return
+        if not sessions.is_session_directory(directory):
+            self.show_info_message(Path(directory).name + " isn't a napari-ADS session")
+            return
+        self.session_thread.session = None
+        self.session_thread.directory = Path(directory)
+        self.session_thread.saving = False
+        self.set_session_running(True)
+        self.session_thread.start()
+
+    def set_session_running(self, running):
+        self.save_session_button.setEnabled(not running)
+        self.open_session_button.setEnabled(not running)
+
+    def _on_session_finished(self, error_message):
+        self.set_session_running(False)
+        if error_message != "":
+            self.show_info_message(error_message)
+            return
+        if self.session_thread.saving:
+            show_info("Session saved")
+            return
+        session = self.session_thread.session
+        self.session_thread.session = None
+        self.open_session(session)
 
-        self.viewer.add_image(data = index_image_array, rgb=False, colormap="yellow", blending="additive",
-                              name="numbers")
+    def open_session(self, session):
+        """
+        Restores the settings, the images with their masks and the morphometrics table of a session.
+        """
+        from .live_morphometrics import MorphometricsTable
+        self.settings.set_session_settings(session.settings)
+        selected_model_index = self.model_selection_combobox.findText(session.settings.get("selected_model", ""))
+        if selected_model_index > 0:
+            self.model_selection_combobox.setCurrentIndex(selected_model_index)
+
+        missing_image_names = []
+        for image in session.images:
+            if image.path is None:
+                missing_image_names.append(image.name)
+                continue
+            image_layer = self.get_layer_by_name(image.name)
+            if image_layer is None:
+                image_layer = self.open_session_image(image)
+            else:
+                # The masks of an image that is already open are replaced by the ones of the session
+                for mask_layer in self.associations.get_mask_layers(image_layer).values():
+                    self.viewer.layers.remove(mask_layer)
+            image_layer.metadata.update(image.metadata)
+            if associations.AXONMYELIN_MASK in image.masks:
+                self.add_axonmyelin_layer(image_layer, image.masks[associations.AXONMYELIN_MASK])
+            elif associations.AXON_MASK in image.masks and associations.MYELIN_MASK in image.masks:
+                self.add_mask_layers(image_layer, image.masks[associations.AXON_MASK],
+                                     image.masks[associations.MYELIN_MASK])
+        if len(missing_image_names) > 0:
+            show_info("Images of the session not found: " + ", ".join(missing_image_names))
+        if session.work_directory is not None:
+            # The working folder of the session is removed with the last layer showing one of its masks
+            self.temporary_directories[Path(session.work_directory)] = [
+                mask for image in session.images for mask in image.masks.values()]
+            self.remove_unused_temporary_directories()
+
+        morphometrics_image_layer = self.get_layer_by_name(session.morphometrics_image_name)
+        if session.morphometrics is not None and morphometrics_image_layer is not None:
+            self.last_morphometrics = session.morphometrics
+            self.last_morphometrics_image_name = session.morphometrics_image_name
+            if self.morphometrics_table is None:
+                self.morphometrics_table = MorphometricsTable()
+                self.viewer.window.add_dock_widget(self.morphometrics_table, name="Morphometrics", area="right")
+            self.morphometrics_table.set_dataframe(session.morphometrics)
+            self.show_axon_numbers(morphometrics_image_layer, session.morphometrics)
+
+    def open_session_image(self, image):
+        """
+        Opens an image of a session, lazily when the format allows it.
+        :return: The image layer
+        """
+        from . import tiled
+        try:
+            data = tiled.open_lazy_image(image.path)
+        except (ImportError, ValueError):
+            data = None
+        if data is None:
+            image_layer = self.viewer.open(str(image.path))[0]
+            image_layer.name = image.name
+            return image_layer
+        return self.add_image_with_path(data, image.path, name=image.name, rgb=image.rgb)
+
+    def _on_performance_button_click(self):
+        if self.performance_panel is None:
+            self.performance_panel = _performance_panel.PerformancePanel(self.profiler)
+            self.viewer.window.add_dock_widget(self.performance_panel, name="Performance", area="right")
+        else:
+            self.performance_panel.parent().show()
 
     def _on_settings_menu_clicked(self):
         self.settings.create_settings_menu()
 
     def get_layer_by_name(self, name_of_layer):
-        for layer in self.viewer.layers:
-            if layer.name == name_of_layer:
-                return layer
+        return self.associations.get_layer(name_of_layer)
 
     def get_microscopy_image(self):
         selected_layers = self.viewer.layers.selection
@@ -357,7 +1493,7 @@ class ADSplugin(QWidget):
         if selected_layer.__class__ == napari.layers.image.image.Image:
             return selected_layer
         elif selected_layer.__class__ == napari.layers.labels.labels.Labels:
-            return self.get_layer_by_name(selected_layer.metadata["associated_image_name"])
+            return self.associations.get_image_layer(selected_layer)
         else:
             return None
 
@@ -373,17 +1509,16 @@ class ADSplugin(QWidget):
         napari_labels_class = napari.layers.labels.labels.Labels
         # If the user has a mask selected, refer to its image layer
         if selected_layer.__class__ == napari_labels_class:
-            image_label = self.get_layer_by_name(selected_layer.metadata["associated_image_name"])
+            image_label = self.associations.get_image_layer(selected_layer)
         elif selected_layer.__class__ == napari_image_class:
             image_label = selected_layer
         else:
             return None
+        if image_label is None:
+            return None
 
-        if type_of_mask == "axon":
-            return self.get_layer_by_name(image_label.metadata["associated_axon_mask_name"])
-        elif type_of_mask == "myelin":
-            return self.get_layer_by_name(image_label.metadata["associated_myelin_mask_name"])
-        return None
+        # Both masks are in the same layer if the image has an axonmyelin layer
+        return self.associations.get_mask_layer(image_label, type_of_mask)
 
     def get_axon_layer(self):
         return self.get_mask_layer("axon")
@@ -391,9 +1526,8 @@ class ADSplugin(QWidget):
     def get_myelin_layer(self):
         return self.get_mask_layer("myelin")
 
-    def get_pixel_size_with_prompt(self):
-        pixel_size, ok_pressed = QInputDialog.getDouble(self, "Enter the pixel size",
-                                                        "Enter the pixel size in micrometers", 0.07, 0, 1000, 10)
+    def get_pixel_size_with_prompt(self, label="Enter the pixel size in micrometers"):
+        pixel_size, ok_pressed = QInputDialog.getDouble(self, "Enter the pixel size", label, 0.07, 0, 1000, 10)
         if ok_pressed:
             return pixel_size
         else:
@@ -418,8 +1552,7 @@ class ADSplugin(QWidget):
             return False
 
     def get_logo(self):
-        ads_path = Path(AxonDeepSeg.__file__).parents[0]
-        logo_file = ads_path / "logo_ads-alpha_small.png"
+        logo_file = inference.get_ads_path() / "logo_ads-alpha_small.png"
         logo_label = QLabel(self)
         logo_pixmap = QPixmap(str(logo_file))
         logo_label.setPixmap(logo_pixmap)
@@ -442,12 +1575,40 @@ class ADSplugin(QWidget):
         )
 
 
+class DiscoveryThread(QtCore.QThread):
+    """
+    Finds the available models and GPUs. Importing the deep learning stack to count the GPUs takes a few seconds.
+    """
+    discovery_finished_signal = Signal()
+    def __init__(self):
+        super().__init__()
+        self.available_models = []
+        self.n_gpus = 0
+
+    def run(self):
+        from AxonDeepSeg import ads_utils
+        self.available_models = ads_utils.get_existing_models_list()
+        self.n_gpus = ads_utils.check_available_gpus(None)
+        self.discovery_finished_signal.emit()
+
+
 class ApplyModelThread(QtCore.QThread):
     model_applied_signal = Signal()
+    # Emits (box of the image, class map of the box) after each patch of a progressive segmentation
+    patch_segmented_signal = Signal(object)
     def __init__(self):
         super().__init__()
         # Those values must not be None before calling run()
         self.selected_layer = None
+        self.in_memory = True
+        self.tiled = False
+        # If True, the in-memory and tiled segmentations produce a class map instead of separate masks
+        self.axonmyelin_layer = False
+        # If True, the in-memory segmentation sends each patch with patch_segmented_signal, starting with the patches
+        # closest to the priority box
+        self.progressive = False
+        self.priority_box = None
+        self.progressive_segmentation = None
         self.image_directory = None
         self.path_testing_image = None
         self.path_model = None
@@ -455,27 +1616,185 @@ class ApplyModelThread(QtCore.QThread):
         self.zoom_factor = None
         self.no_patch = False
         self.gpu_id = 0
+        self.n_cpu_workers = 1
+        # Backend of the in-memory and tiled segmentations (see backends.BACKENDS)
+        self.backend = backends.PYTORCH_BACKEND
         self.task_finished_successfully = False
+        # Shown to the user when the segmentation fails, empty if the console has the details
+        self.error_message = ""
+        # Why the PyTorch model was used instead of the backend, empty if it wasn't
+        self.backend_message = ""
+        # ProfileRun receiving the stages of the segmentation
+        self.profile_run = None
+        # Loaded models are reused between runs
+        self.model_cache = None
+        # Results of the in-memory segmentation are reused when the same image is segmented again
+        self.result_cache = None
+        # Results of the in-memory or tiled segmentation
+        self.class_map = None
+        self.axon_data = None
+        self.myelin_data = None
+        # Temporary folder of the on-disk arrays of the tiled segmentation
+        self.mask_directory = None
 
     def run(self):
         self.task_finished_successfully = False
+        self.class_map = None
+        self.axon_data = None
+        self.myelin_data = None
+        self.mask_directory = None
+        self.error_message = ""
+        self.backend_message = ""
         try:
-            segment.segment_image(
-                path_testing_image=self.path_testing_image,
-                path_model=self.path_model,
-                overlap_value=self.overlap_value,
-                acquired_resolution=self.selected_layer.metadata["pixel_size"],
-                zoom_factor=self.zoom_factor,
-                gpu_id=self.gpu_id,
-                no_patch=self.no_patch,
-                verbosity_level=3
-            )
+            # Set here, before the patch workers start, so torch isn't imported by the event loop
+            inference.share_cpu_threads(self.n_cpu_workers)
+            with profiling.stage("segmentation", self.profile_run):
+                if self.tiled:
+                    self.segment_tiled()
+                elif self.progressive:
+                    self.segment_progressive()
+                elif self.in_memory:
+                    self.segment_in_memory()
+                else:
+                    from AxonDeepSeg import segment
+                    segment.segment_image(
+                        path_testing_image=self.path_testing_image,
+                        path_model=self.path_model,
+                        overlap_value=self.overlap_value,
+                        acquired_resolution=self.selected_layer.metadata["pixel_size"],
+                        zoom_factor=self.zoom_factor,
+                        gpu_id=self.gpu_id,
+                        no_patch=self.no_patch,
+                        verbosity_level=3
+                    )
             self.task_finished_successfully = True
+        except inference.ImageTooSmallError as err:
+            print(err)
+            self.error_message = str(err)
         except SystemExit as err:
             if err.code == 4:
-                self.show_info_message(
+                self.error_message = (
                     "Resampled image smaller than model's patch size. Please take a look at your terminal \n"
                     "for the minimum zoom factor value to use (option available in the Settings menu)."
                 )
-            self.task_finished_successfully = False
-        self.model_applied_signal.emit()
+        except Exception as err:
+            traceback.print_exc()
+            self.error_message = "Couldn't apply the ADS model: " + str(err)
+        finally:
+            # The widget enables the Apply button and finishes the ProfileRun when it receives the signal
+            self.model_applied_signal.emit()
+
+    def set_priority_box(self, box):
+        """
+        Sets the box of the image segmented first by the progressive segmentation. Can be called while it runs.
+        """
+        self.priority_box = box
+        if self.progressive_segmentation is not None:
+            self.progressive_segmentation.set_priority_box(box)
+
+    def segment_progressive(self):
+        from . import progressive
+        session = self.get_model_session()
+        image = self.selected_layer.data
+        if self.selected_layer.multiscale:
+            image = image[0]
+        self.progressive_segmentation = progressive.ProgressiveSegmentation(
+            session,
+            image,
+            pixel_size=self.selected_layer.metadata["pixel_size"],
+            zoom_factor=self.zoom_factor,
+            overlap_value=self.overlap_value,
+            rgb=self.selected_layer.rgb
+        )
+        self.progressive_segmentation.set_priority_box(self.priority_box)
+        try:
+            # The patches are predicted by other threads, so only the whole segmentation is measured
+            self.progressive_segmentation.run(lambda box, class_map: self.patch_segmented_signal.emit((box, class_map)),
+                                              n_workers=self.n_cpu_workers)
+        finally:
+            self.progressive_segmentation = None
+
+    def get_model_session(self):
+        with profiling.stage("model loading"):
+            session, self.backend, self.backend_message = backends.load_session(
+                self.path_model, gpu_id=self.gpu_id, backend=self.backend, model_cache=self.model_cache)
+        if self.model_cache is not None:
+            profiling.add_note("model cache", self.model_cache.get_stats_string())
+        return session
+
+    def segment_in_memory(self):
+        image = pyramids.get_base_data(self.selected_layer)
+        result_key = None
+        if self.result_cache is not None:
+            with profiling.stage("result cache lookup"):
+                result_key = result_cache.get_result_key(
+                    image,
+                    self.path_model,
+                    pixel_size=self.selected_layer.metadata["pixel_size"],
+                    zoom_factor=self.zoom_factor,
+                    overlap_value=self.overlap_value,
+                    no_patch=self.no_patch,
+                    rgb=self.selected_layer.rgb,
+                    backend=self.backend
+                )
+                self.class_map = self.result_cache.get(result_key)
+            profiling.add_note("result cache", self.result_cache.get_stats_string())
+            if self.class_map is not None:
+                return
+
+        session = self.get_model_session()
+        class_map = inference.segment_array(
+            session,
+            image,
+            pixel_size=self.selected_layer.metadata["pixel_size"],
+            zoom_factor=self.zoom_factor,
+            overlap_value=self.overlap_value,
+            no_patch=self.no_patch,
+            rgb=self.selected_layer.rgb,
+            n_workers=self.n_cpu_workers
+        )
+        # The key was made for the backend that couldn't be used
+        if result_key is not None and not self.backend_message:
+            with profiling.stage("result cache write"):
+                self.result_cache.put(result_key, class_map)
+        # The masks are split by the widget if needed, so they are only stored once
+        self.class_map = class_map
+
+    def segment_tiled(self):
+        from . import tiled
+        session = self.get_model_session()
+        image = pyramids.get_base_data(self.selected_layer)
+        # The file of the layer is read lazily when its format allows it, patch by patch
+        if get_layer_path(self.selected_layer) is not None:
+            try:
+                lazy_image = tiled.open_lazy_image(get_layer_path(self.selected_layer))
+            except (ImportError, OSError, ValueError):
+                lazy_image = None
+            if lazy_image is not None and tuple(lazy_image.shape) == tuple(image.shape):
+                image = lazy_image
+        rgb = self.selected_layer.rgb
+        image_shape = tiled.get_image_shape(image, rgb)
+        self.mask_directory = tiled.create_temporary_directory()
+        if self.axonmyelin_layer:
+            self.class_map, = tiled.create_mask_stores(image_shape, directory=self.mask_directory,
+                                                       name=self.selected_layer.name, mask_names=("axonmyelin",))
+        else:
+            self.axon_data, self.myelin_data = tiled.create_mask_stores(image_shape, directory=self.mask_directory,
+                                                                        name=self.selected_layer.name)
+        tiled.segment_tiled(
+            session,
+            image,
+            self.axon_data,
+            self.myelin_data,
+            pixel_size=self.selected_layer.metadata["pixel_size"],
+            zoom_factor=self.zoom_factor,
+            overlap_value=self.overlap_value,
+            rgb=rgb,
+            progress_callback=self.print_tiled_progress,
+            class_output=self.class_map,
+            n_workers=self.n_cpu_workers
+        )
+
+    def print_tiled_progress(self, n_patches_done, n_patches):
+        if n_patches_done % 100 == 0 or n_patches_done == n_patches:
+            print("Segmented " + str(n_patches_done) + "/" + str(n_patches) + " patches")
@@ -0,0 +1,144 @@
+"""
+Index of the links between the image layers and their mask layers.
+
+The links are also written to the metadata of the layers (associated_image_name, associated_axon_mask_name,
+associated_myelin_mask_name, associated_axonmyelin_mask_name), which is what napari saves with the layers. The index
+keeps them as references to the layers, updated when layers are added, removed or renamed in the viewer, so the masks
+of an image are found without scanning the layers by name.
+"""
+import weakref
+
+import napari
+
+AXON_MASK = "axon"
+MYELIN_MASK = "myelin"
+AXONMYELIN_MASK = "axonmyelin"
+MASK_KINDS = (AXON_MASK, MYELIN_MASK, AXONMYELIN_MASK)
+# Metadata keys of the image layers naming their masks, by kind of mask
+MASK_NAME_KEYS = {kind: "associated_" + kind + "_mask_name" for kind in MASK_KINDS}
+IMAGE_NAME_KEY = "associated_image_name"
+
+
+class AssociationIndex:
+    """
+    The layers of a viewer by name, and the mask layers of each image layer.
+    """
+    def __init__(self, viewer):
+        self.viewer = viewer
+        self._layers_by_name = {}
+        # Image layer -> {kind of mask: mask layer}
+        self._masks = weakref.WeakKeyDictionary()
+        # Mask layer -> image layer
+        self._images = weakref.WeakKeyDictionary()
+        for layer in viewer.layers:
+            self._add_layer(layer)
+        viewer.layers.events.inserted.connect(self._on_layer_inserted)
+        viewer.layers.events.removed.connect(self._on_layer_removed)
+
+    def get_layer(self, name):
+        """
+        :return: The layer with the given name, or None if there is none
+        """
+        return self._layers_by_name.get(name)
+
+    def get_image_layer(self, mask_layer):
+        """
+        :return: The image layer of a mask layer, or None if it has none
+        """
+        return self._images.get(mask_layer)
+
+    def get_mask_layer(self, image_layer, kind):
+        """
+        :param kind: AXON_MASK or MYELIN_MASK. The axonmyelin layer is returned for both if the image has one.
+        :return: The mask layer of the given kind of an image layer, or None if it has none
+        """
+        masks = self._masks.get(image_layer, {})
+        if AXONMYELIN_MASK in masks:
+            return masks[AXONMYELIN_MASK]
+        return masks.get(kind)
+
+    def get_mask_layers(self, image_layer):
+        """
+        :return: The mask layers of an image layer, by kind of mask
+        :rtype: dict
+        """
+        return dict(self._masks.get(image_layer, {}))
+
+    def associate(self, image_layer, mask_layer, kind):
+        """
+        Links a mask layer to an image layer, and writes the link to their metadata. An axonmyelin layer replaces the
+        axon and myelin layers of the image, and the other way around.
+        """
+        masks = self._masks.setdefault(image_layer, {})
+        replaced_kinds = (AXON_MASK, MYELIN_MASK) if kind == AXONMYELIN_MASK else (AXONMYELIN_MASK,)
+        for replaced_kind in replaced_kinds:
+            masks.pop(replaced_kind, None)
+            image_layer.metadata.pop(MASK_NAME_KEYS[replaced_kind], None)
+        masks[kind] = mask_layer
+        self._images[mask_layer] = image_layer
+        image_layer.metadata[MASK_NAME_KEYS[kind]] = mask_layer.name
+        mask_layer.metadata[IMAGE_NAME_KEY] = image_layer.name
+
+    def replace_layer(self, old_layer, new_layer):
+        """
+        Moves the links of a layer to the layer replacing it in the viewer.
+        """
+        if old_layer in self._masks:
+            masks = self._masks.pop(old_layer)
+            self._masks[new_layer] = masks
+            for mask_layer in masks.values():
+                self._images[mask_layer] = new_layer
+        if old_layer in self._images:
+            image_layer = self._images.pop(old_layer)
+            self._images[new_layer] = image_layer
+            masks = self._masks.get(image_layer, {})
+            for kind, mask_layer in masks.items():
+                if mask_layer is old_layer:
+                    masks[kind] = new_layer
+
+    def _on_layer_inserted(self, event):
+        self._add_layer(event.value)
+
+    def _on_layer_removed(self, event):
+        layer = event.value
+        layer.events.name.disconnect(self._on_layer_renamed)
+        if self._layers_by_name.get(layer.name) is layer:
+            del self._layers_by_name[layer.name]
+        # A removed image keeps its masks until it is replaced (see replace_layer) or they are removed too
+        image_layer = self._images.pop(layer, None)
+        if image_layer is not None:
+            masks = self._masks.get(image_layer, {})
+            for kind in [kind for kind, mask_layer in masks.items() if mask_layer is layer]:
+                del masks[kind]
+
+    def _on_layer_renamed(self, event):
+        layer = event.source
+        for name in [name for name, named_layer in self._layers_by_name.items() if named_layer is layer]:
+            del self._layers_by_name[name]
+        self._layers_by_name[layer.name] = layer
+        # The links written to the metadata follow the new name
+        image_layer = self._images.get(layer)
+        if image_layer is not None:
+            for kind, mask_layer in self._masks.get(image_layer, {}).items():
+                if mask_layer is layer:
+                    image_layer.metadata[MASK_NAME_KEYS[kind]] = layer.name
+        for mask_layer in self._masks.get(layer, {}).values():
+            mask_layer.metadata[IMAGE_NAME_KEY] = layer.name
+
+    def _add_layer(self, layer):
+        self._layers_by_name[layer.name] = layer
+        layer.events.name.connect(self._on_layer_renamed)
+        # Layers added with links in their metadata (by a script or by napari) are linked here
+        if isinstance(layer, napari.layers.Labels) and IMAGE_NAME_KEY in layer.metadata:
+            image_layer = self.get_layer(layer.metadata[IMAGE_NAME_KEY])
+            if image_layer is not None:
+                for kind, key in MASK_NAME_KEYS.items():
+                    if image_layer.metadata.get(key) == layer.name:
+                        self._masks.setdefault(image_layer, {})[kind] = layer
+                        self._images[layer] = image_layer
+        elif isinstance(layer, napari.layers.Image):
+            for kind, key in MASK_NAME_KEYS.items():
+                mask_layer = self.get_layer(layer.metadata.get(key))
+                if mask_layer is not None and mask_layer.metadata.get(IMAGE_NAME_KEY) == layer.name:
+                    self._masks.setdefault(layer, {})[kind] = mask_layer
+                    self._images[mask_layer] = layer
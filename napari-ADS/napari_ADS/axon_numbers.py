@@ -0,0 +1,103 @@
+"""
+Numbers of the axons, shown as text on a Points layer at the centroid of each axon.
+
+The layer only stores one point per axon, so it stays small for large images. The same layer is updated when the
+morphometrics are computed again, and the numbers are hidden when the view is zoomed out too much to read them.
+"""
+import numpy as np
+import pandas as pd
+
+from .fibers import get_centroid_columns
+
+NUMBERS_COLOR = "yellow"
+# Size of the numbers on the screen, in pixels
+TEXT_SIZE = 10
+# The numbers are shown when the mean distance between two axons on the screen is at least this number of text sizes
+MIN_SPACING_IN_TEXT_SIZES = 2.0
+
+
+def get_axon_positions(stats_dataframe):
+    """
+    :return: The (y, x) centroid of each axon, in pixels
+    :rtype: numpy.ndarray
+    """
+    if len(stats_dataframe) == 0:
+        return np.empty((0, 2))
+    x_column, y_column = get_centroid_columns(stats_dataframe)
+    return np.column_stack((np.asarray(stats_dataframe[y_column], dtype=float),
+                            np.asarray(stats_dataframe[x_column], dtype=float)))
+
+
+def get_min_text_zoom(n_axons, image_shape):
+    """
+    :return: The zoom level of the camera from which the numbers can be read without overlapping too much
+    :rtype: float
+    """
+    if n_axons == 0:
+        return 0.0
+    # Mean distance between two axons, in image pixels
+    mean_spacing = np.sqrt(np.prod(image_shape[:2]) / n_axons)
+    return MIN_SPACING_IN_TEXT_SIZES * TEXT_SIZE / mean_spacing
+
+
+class AxonNumbers:
+    """
+    Points layer showing the number of each axon of an image, at its centroid.
+    """
+    def __init__(self, viewer, image_layer):
+        self.viewer = viewer
+        self.image_name = image_layer.name
+        self.image_shape = tuple(image_layer.data.shape if not image_layer.multiscale else image_layer.data[0].shape)
+        self.layer = None
+        self.min_text_zoom = 0.0
+        self.viewer.camera.events.zoom.connect(self._on_zoom)
+
+    def set_dataframe(self, stats_dataframe):
+        """
+        Shows the numbers of the axons of a morphometrics dataframe (the index of each row). The layer is created the
+        first time, or if it was removed from the viewer.
+        """
+        positions = get_axon_positions(stats_dataframe)
+        features = pd.DataFrame({"axon_id": np.asarray(stats_dataframe.index)})
+        self.min_text_zoom = get_min_text_zoom(len(positions), self.image_shape)
+        if not self.is_shown():
+            self.layer = self.viewer.add_points(
+                positions,
+                features=features,
+                text={"string": "{axon_id}", "size": TEXT_SIZE, "color": NUMBERS_COLOR},
+                size=1,
+                face_color=NUMBERS_COLOR,
+                name=self.image_name + "_numbers",
+                metadata={"associated_image_name": self.image_name}
+            )
+        else:
+            self.layer.data = positions
+            self.layer.features = features
+        self._on_zoom()
+
+    def update(self, removed_ids, added_rows, n_axons):
+        """
+        Removes the numbers of some axons and adds the numbers of new ones, without setting the other points again.
+        :param added_rows: The morphometrics of the new axons
+        :param n_axons: Number of axons of the image after the update
+        """
+        removed = np.flatnonzero(np.isin(self.layer.features["axon_id"].to_numpy(), list(removed_ids)))
+        if len(removed) > 0:
+            self.layer.selected_data = set(removed.tolist())
+            self.layer.remove_selected()
+        for axon_id, position in zip(added_rows.index, get_axon_positions(added_rows)):
+            # The features of an added point are the defaults of the layer
+            self.layer.feature_defaults = {"axon_id": axon_id}
+            self.layer.add(position)
+        self.min_text_zoom = get_min_text_zoom(n_axons, self.image_shape)
+        self._on_zoom()
+
+    def is_shown(self):
+        return self.layer is not None and self.layer in self.viewer.layers
+
+    def _on_zoom(self, event=None):
+        if self.layer is None:
+            return
+        visible = self.viewer.camera.zoom >= self.min_text_zoom
+        if self.layer.text.visible != visible:
+            self.layer.text.visible = visible
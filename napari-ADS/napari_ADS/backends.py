@@ -0,0 +1,263 @@
+"""
+Optimized CPU backends for the ADS models.
+
+A model is exported once to TorchScript (frozen and optimized for inference) or to ONNX, optionally quantized to int8
+for ONNX Runtime. The exported files are kept in a folder next to the model and exported again when the weights of
+the model change. The accuracy of a backend is checked against the PyTorch model with the Dice score of each class,
+and the in-memory segmentation (which reimplements the preprocessing and postprocessing of AxonDeepSeg) is checked
+against AxonDeepSeg's own segment_image on the same sample.
+"""
+import os
+import tempfile
+import time
+import traceback
+from pathlib import Path
+
+import numpy as np
+
+from . import inference
+
+PYTORCH_BACKEND = "PyTorch"
+TORCHSCRIPT_BACKEND = "TorchScript (CPU)"
+ONNX_BACKEND = "ONNX Runtime (CPU)"
+ONNX_INT8_BACKEND = "ONNX Runtime int8 (CPU)"
+BACKENDS = (PYTORCH_BACKEND, TORCHSCRIPT_BACKEND, ONNX_BACKEND, ONNX_INT8_BACKEND)
+EXPORT_EXTENSIONS = {TORCHSCRIPT_BACKEND: ".torchscript.pt", ONNX_BACKEND: ".onnx", ONNX_INT8_BACKEND: ".int8.onnx"}
+EXPORT_FOLDER_NAME = "cpu_exports"
+ONNX_OPSET_VERSION = 13
+# Largest part of the image segmented by the accuracy check
+SAMPLE_SHAPE = (2048, 2048)
+
+
+def get_export_path(path_model, backend):
+    """
+    :return: The path of the file exported for a backend, in the folder of the model
+    :rtype: Path
+    """
+    path_model = Path(path_model)
+    return path_model / EXPORT_FOLDER_NAME / (path_model.name + EXPORT_EXTENSIONS[backend])
+
+
+def is_export_up_to_date(path_model, backend):
+    export_path = get_export_path(path_model, backend)
+    model_file = inference.find_model_file(path_model, ".pt")
+    return export_path.exists() and export_path.stat().st_mtime >= model_file.stat().st_mtime
+
+
+def export_model(path_model, backend):
+    """
+    Exports a model for a backend, unless the exported file is already up to date.
+    :param path_model: Path to the folder of the model
+    :param backend: One of the backends of EXPORT_EXTENSIONS
+    :return: The path of the exported file
+    :rtype: Path
+    """
+    import torch
+
+    export_path = get_export_path(path_model, backend)
+    if is_export_up_to_date(path_model, backend):
+        return export_path
+    export_path.parent.mkdir(exist_ok=True)
+    if not os.access(export_path.parent, os.W_OK):
+        raise PermissionError("Can't write the export of the model to " + str(export_path.parent))
+    # Written to a temporary file first, so an interrupted export is never loaded
+    temporary_path = export_path.with_name("tmp_" + export_path.name)
+
+    if backend == ONNX_INT8_BACKEND:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(str(export_model(path_model, ONNX_BACKEND)), str(temporary_path),
+                         weight_type=QuantType.QInt8)
+    else:
+        config = inference.get_model_config(path_model)
+        model = inference.load_torch_model(path_model, torch.device("cpu"))
+        example_input = torch.zeros((1, 1) + tuple(config["default_model"]["length_2D"]), dtype=torch.float32)
+        with torch.no_grad():
+            if backend == TORCHSCRIPT_BACKEND:
+                script_model = torch.jit.freeze(torch.jit.trace(model, example_input))
+                try:
+                    script_model = torch.jit.optimize_for_inference(script_model)
+                except (AttributeError, RuntimeError):
+                    # Not available in older versions of torch
+                    pass
+                torch.jit.save(script_model, str(temporary_path))
+            else:
+                # The height and width are dynamic, so the "no patch" option can predict whole images
+                dynamic_axes = {"input": {2: "height", 3: "width"}, "output": {2: "height", 3: "width"}}
+                torch.onnx.export(model, example_input, str(temporary_path), input_names=["input"],
+                                  output_names=["output"], dynamic_axes=dynamic_axes,
+                                  opset_version=ONNX_OPSET_VERSION)
+    os.replace(temporary_path, export_path)
+    print("Exported " + Path(path_model).name + " for " + backend + ": " + str(export_path))
+    return export_path
+
+
+class TorchScriptSession(inference.ModelSession):
+    """
+    A model exported to TorchScript, running on the CPU.
+    """
+    def load_model(self, gpu_id):
+        import torch
+
+        self.device = torch.device("cpu")
+        self.model = torch.jit.load(str(export_model(self.path_model, TORCHSCRIPT_BACKEND)), map_location=self.device)
+
+
+class OnnxSession(inference.ModelSession):
+    """
+    A model exported to ONNX, running on the CPU with ONNX Runtime.
+    """
+    backend = ONNX_BACKEND
+
+    def load_model(self, gpu_id):
+        import onnxruntime
+        import torch
+
+        self.device = torch.device("cpu")
+        self.model = onnxruntime.InferenceSession(str(export_model(self.path_model, self.backend)),
+                                                  providers=["CPUExecutionProvider"])
+        self.input_name = self.model.get_inputs()[0].name
+
+    def predict(self, patch):
+        return self.model.run(None, {self.input_name: np.ascontiguousarray(patch[None, None], dtype=np.float32)})[0][0]
+
+
+class OnnxInt8Session(OnnxSession):
+    """
+    A model exported to ONNX with int8 weights, running on the CPU with ONNX Runtime.
+    """
+    backend = ONNX_INT8_BACKEND
+
+
+BACKEND_SESSIONS = {
+    PYTORCH_BACKEND: inference.ModelSession,
+    TORCHSCRIPT_BACKEND: TorchScriptSession,
+    ONNX_BACKEND: OnnxSession,
+    ONNX_INT8_BACKEND: OnnxInt8Session,
+}
+
+
+def create_session(path_model, gpu_id=0, backend=PYTORCH_BACKEND):
+    """
+    Loads a model with the given backend. The model is exported first if needed.
+    :rtype: inference.ModelSession
+    """
+    return BACKEND_SESSIONS[backend](path_model, gpu_id=gpu_id)
+
+
+def get_backend_error_message(backend, error):
+    """
+    :param error: The ImportError or OSError raised while loading the model with the backend
+    :return: The reason why the backend can't be used, for the user
+    :rtype: str
+    """
+    if isinstance(error, ImportError):
+        return (getattr(error, "name", None) or "onnxruntime") + " is not installed, so " + backend + " can't be used"
+    return "Can't write the export of the model for " + backend + " (" + str(error) + ")"
+
+
+def load_session(path_model, gpu_id=0, backend=PYTORCH_BACKEND, model_cache=None):
+    """
+    Loads a model with the given backend, or with the PyTorch model if the backend can't be used: its library isn't
+    installed, or the exported file can't be written in the folder of the model.
+    :param model_cache: The inference.ModelCache reusing the loaded models, or None
+    :return: The session, the backend it uses, and the reason why the PyTorch model is used instead of the backend
+             (empty if the backend is used)
+    :rtype: tuple
+    """
+    def load(loaded_backend):
+        if model_cache is None:
+            return create_session(path_model, gpu_id=gpu_id, backend=loaded_backend)
+        return model_cache.get(path_model, gpu_id=gpu_id, backend=loaded_backend)
+
+    backend = backend or PYTORCH_BACKEND
+    try:
+        return load(backend), backend, ""
+    except (ImportError, OSError) as error:
+        if backend == PYTORCH_BACKEND:
+            raise
+        traceback.print_exc()
+        message = get_backend_error_message(backend, error) + ". The " + PYTORCH_BACKEND + " model is used instead."
+        print(message)
+        return load(PYTORCH_BACKEND), PYTORCH_BACKEND, message
+
+
+def get_dice_score(mask, reference_mask):
+    """
+    :return: The Dice score of a binary mask, 1 if both masks are empty
+    :rtype: float
+    """
+    total = np.count_nonzero(mask) + np.count_nonzero(reference_mask)
+    if total == 0:
+        return 1.0
+    return 2 * np.count_nonzero(mask & reference_mask) / total
+
+
+def get_sample(image):
+    """
+    :return: The center of an image, cropped to SAMPLE_SHAPE
+    """
+    box = tuple(slice(max(0, (length - sample_length) // 2), max(0, (length - sample_length) // 2) + sample_length)
+                for length, sample_length in zip(image.shape[:2], SAMPLE_SHAPE))
+    return np.asarray(image[box])
+
+
+def segment_with_ads(path_model, image, pixel_size, zoom_factor=1.0, overlap_value=(48, 48), gpu_id=0):
+    """
+    Segments an image with AxonDeepSeg's segment_image, through a temporary file, like the segmentation that isn't in
+    memory.
+    :return: The class map read from the axonmyelin mask written by AxonDeepSeg
+    :rtype: numpy.ndarray of uint8
+    """
+    from AxonDeepSeg import ads_utils, segment
+    from config import axonmyelin_suffix
+
+    with tempfile.TemporaryDirectory(prefix="ads_parity_") as directory:
+        image_path = Path(directory) / "parity_sample.png"
+        ads_utils.imwrite(filename=image_path, img=image)
+        segment.segment_image(path_testing_image=image_path, path_model=Path(path_model),
+                              overlap_value=list(overlap_value), acquired_resolution=pixel_size,
+                              zoom_factor=zoom_factor, gpu_id=gpu_id, verbosity_level=0)
+        mask_image = np.asarray(ads_utils.imread(Path(directory) / (image_path.stem + str(axonmyelin_suffix))))
+    if mask_image.ndim == 3:
+        mask_image = mask_image[..., 0]
+    # Same thresholds as the masks loaded by the plugin (see mask_loading.py)
+    class_map = np.full(mask_image.shape, inference.BACKGROUND_LABEL, dtype=np.uint8)
+    class_map[(mask_image > 100) & (mask_image < 200)] = inference.MYELIN_LABEL
+    class_map[mask_image > 200] = inference.AXON_LABEL
+    return class_map
+
+
+def check_backend_accuracy(path_model, backend, image, pixel_size, zoom_factor=1.0, overlap_value=(48, 48),
+                           rgb=False, model_cache=None):
+    """
+    Segments a sample of an image with a backend and with the PyTorch model, and compares the results. The PyTorch
+    result is also compared with the result of AxonDeepSeg's segment_image, so a difference between the in-memory
+    segmentation and AxonDeepSeg is reported.
+    :return: The Dice score of the axon and myelin classes, the Dice scores of the PyTorch result against AxonDeepSeg
+             (ads_axon_dice, ads_myelin_dice) and the inference time of each backend, in seconds
+    :rtype: dict
+    """
+    sample = get_sample(image)
+    class_maps = {}
+    times = {}
+    for checked_backend in (PYTORCH_BACKEND, backend):
+        if model_cache is not None:
+            session = model_cache.get(path_model, backend=checked_backend)
+        else:
+            session = create_session(path_model, backend=checked_backend)
+        start = time.perf_counter()
+        class_maps[checked_backend] = inference.segment_array(session, sample, pixel_size, zoom_factor=zoom_factor,
+                                                              overlap_value=overlap_value, rgb=rgb)
+        times[checked_backend] = time.perf_counter() - start
+    ads_class_map = segment_with_ads(path_model, sample, pixel_size, zoom_factor=zoom_factor,
+                                     overlap_value=overlap_value)
+    reference, result = class_maps[PYTORCH_BACKEND], class_maps[backend]
+    return {
+        "axon_dice": get_dice_score(result == inference.AXON_LABEL, reference == inference.AXON_LABEL),
+        "myelin_dice": get_dice_score(result == inference.MYELIN_LABEL, reference == inference.MYELIN_LABEL),
+        "ads_axon_dice": get_dice_score(reference == inference.AXON_LABEL, ads_class_map == inference.AXON_LABEL),
+        "ads_myelin_dice": get_dice_score(reference == inference.MYELIN_LABEL,
+                                          ads_class_map == inference.MYELIN_LABEL),
+        "reference_time": times[PYTORCH_BACKEND],
+        "backend_time": times[backend],
+    }
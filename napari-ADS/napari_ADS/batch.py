@@ -0,0 +1,194 @@
+"""
+Batch segmentation of several images with the same model.
+
+Each image is a BatchJob, processed by BatchJob.run: segmentation, then optionally filling of the axons, saving of the
+masks and morphometrics. The same jobs are run by the plugin and by the headless pipeline (see pipeline.py).
+In the plugin, the images are loaded ahead of time by a loader thread while the previous ones are being segmented, and
+a pool of workers runs the inference. The whole batch runs in a QThread (see _threads.py), so the napari event loop is
+never blocked.
+"""
+import csv
+import time
+from pathlib import Path
+
+from . import backends, inference, masks, morphometrics_export, saving
+from .fill_axons import fill_class_map
+
+IMAGE_EXTENSIONS = (".png", ".tif", ".tiff", ".jpg", ".jpeg")
+SUMMARY_FILE_NAME = "batch_segmentation_summary.csv"
+MORPHOMETRICS_SUFFIX = "_axon_morphometrics.csv"
+TIMING_STEPS = ("load", "inference", "fill", "save", "morphometrics")
+
+
+class BatchSettings:
+    """
+    Parameters of a batch, with the same names and defaults as the ADSsettings of the plugin.
+    """
+    def __init__(self, **settings):
+        """
+        :param settings: Values replacing the defaults, by name
+        """
+        self.overlap_value = 48
+        self.zoom_factor = 1.0
+        self.axon_shape = "circle"
+        self.no_patch = False
+        self.gpu_id = 0
+        self.n_cpu_workers = 1
+        self.n_batch_workers = 1
+        self.backend = backends.PYTORCH_BACKEND
+        self.save_format = saving.PNG_FORMAT
+        # Steps run after the segmentation
+        self.fill_axons = False
+        self.save_masks = True
+        self.compute_morphometrics = False
+        # Parquet dataset receiving the morphometrics of every image, instead of a CSV file per image
+        self.morphometrics_dataset = None
+        for name, value in settings.items():
+            if not hasattr(self, name):
+                raise ValueError("Unknown setting: " + name)
+            setattr(self, name, value)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class BatchJob:
+    """
+    One image of a batch, along with its results and timings.
+    """
+    def __init__(self, name, pixel_size, image=None, path=None, rgb=False):
+        """
+        :param name: Name of the image, used to name the masks
+        :param pixel_size: Pixel size of the image, in micrometers
+        :param image: The image data, for images that are already loaded (napari layers)
+        :param path: Path to the image file, for images that must be read from the disk
+        :param rgb: Whether the last axis of the image contains color channels
+        """
+        self.name = name
+        self.pixel_size = pixel_size
+        self.image = image
+        self.path = None if path is None else Path(path)
+        self.rgb = rgb
+        self.status = "pending"
+        self.error = ""
+        self.timings = {step: 0.0 for step in TIMING_STEPS}
+        # Segmentation of the image (0: background, 1: myelin, 2: axon)
+        self.class_map = None
+
+    def load(self):
+        start = time.perf_counter()
+        if self.image is None:
+            from AxonDeepSeg import ads_utils
+            self.image = ads_utils.imread(self.path)
+        self.timings["load"] = time.perf_counter() - start
+        return self
+
+    def segment(self, session, settings):
+        start = time.perf_counter()
+        self.class_map = inference.segment_array(
+            session,
+            self.image,
+            pixel_size=self.pixel_size,
+            zoom_factor=settings.zoom_factor,
+            overlap_value=[settings.overlap_value, settings.overlap_value],
+            no_patch=settings.no_patch,
+            rgb=self.rgb,
+            n_workers=settings.n_cpu_workers
+        )
+        self.timings["inference"] = time.perf_counter() - start
+
+    def fill_axons(self):
+        start = time.perf_counter()
+        fill_class_map(self.class_map)
+        self.timings["fill"] = time.perf_counter() - start
+
+    def save_masks(self, save_directory=None, save_format=saving.PNG_FORMAT):
+        """
+        Writes the masks with the same names as segment.segment_image, next to the image by default.
+        """
+        start = time.perf_counter()
+        axon_data, myelin_data = masks.split_views(self.class_map)
+        saving.save_segmentation(axon_data, myelin_data, save_directory or self.path.parents[0], self.name,
+                                 save_format=save_format, pixel_size=self.pixel_size)
+        self.timings["save"] = time.perf_counter() - start
+
+    def compute_morphometrics(self, save_directory=None, axon_shape="circle", dataset_path=None, model=None,
+                              zoom_factor=1.0):
+        """
+        Writes the morphometrics of the axons to a CSV file, next to the image by default.
+        :param dataset_path: Parquet dataset receiving the morphometrics instead of the CSV file
+        :param model: Name of the model, written with the rows of the dataset
+        :param zoom_factor: Zoom factor of the segmentation, written with the rows of the dataset
+        """
+        import AxonDeepSeg.morphometrics.compute_morphometrics as compute_morphs
+        start = time.perf_counter()
+        axon_data, myelin_data = inference.split_class_map(self.class_map)
+        stats_dataframe = compute_morphs.get_axon_morphometrics(im_axon=axon_data.view(bool),
+                                                                im_myelin=myelin_data.view(bool),
+                                                                pixel_size=self.pixel_size, axon_shape=axon_shape)
+        if dataset_path is not None:
+            morphometrics_export.append_to_dataset(stats_dataframe, dataset_path, self.name, self.pixel_size,
+                                                   model=model, zoom_factor=zoom_factor, axon_shape=axon_shape)
+        else:
+            morphometrics_path = Path(save_directory or self.path.parents[0]) / (self.name + MORPHOMETRICS_SUFFIX)
+            compute_morphs.save_axon_morphometrics(str(morphometrics_path), stats_dataframe)
+        self.timings["morphometrics"] = time.perf_counter() - start
+
+    def run(self, session, settings, save_directory=None):
+        """
+        Segments the loaded image, then runs the steps enabled in the settings. The image is released at the end if it
+        can be read again from its file, and the class map is released if the masks were saved.
+        :param settings: The BatchSettings of the batch
+        :param save_directory: Folder receiving the masks and the morphometrics. The folder of the image if None.
+        """
+        self.segment(session, settings)
+        if settings.fill_axons:
+            self.fill_axons()
+        if settings.compute_morphometrics:
+            self.compute_morphometrics(save_directory, settings.axon_shape, dataset_path=settings.morphometrics_dataset,
+                                       model=session.path_model.name, zoom_factor=settings.zoom_factor)
+        if settings.save_masks:
+            self.save_masks(save_directory, settings.save_format)
+            self.class_map = None
+        if self.path is not None:
+            # Images read from the disk are not needed anymore
+            self.image = None
+        self.status = "done"
+
+    def get_total_time(self):
+        return sum(self.timings.values())
+
+
+def get_images_in_folder(folder):
+    """
+    Lists the images of a folder that can be segmented, skipping the masks produced by a previous segmentation.
+    :rtype: list of Path
+    """
+    from config import axonmyelin_suffix, axon_suffix, myelin_suffix
+
+    mask_suffixes = (str(axonmyelin_suffix), str(axon_suffix), str(myelin_suffix))
+    return [
+        path for path in sorted(Path(folder).iterdir())
+        if path.suffix.lower() in IMAGE_EXTENSIONS and not path.name.endswith(mask_suffixes)
+    ]
+
+
+def write_summary(jobs, summary_path):
+    """
+    Writes the status and timings of every job of a batch to a CSV file.
+    """
+    with open(summary_path, "w", newline="") as summary_file:
+        writer = csv.writer(summary_file)
+        writer.writerow(["image", "status"] + [step + "_time" for step in TIMING_STEPS] + ["total_time", "error"])
+        for job in jobs:
+            writer.writerow([job.name, job.status] + [round(job.timings[step], 3) for step in TIMING_STEPS] +
+                            [round(job.get_total_time(), 3), job.error])
+
+
+def get_summary_string(jobs):
+    n_done = sum(job.status == "done" for job in jobs)
+    n_failed = sum(job.status == "failed" for job in jobs)
+    n_cancelled = sum(job.status == "cancelled" for job in jobs)
+    total_time = sum(job.get_total_time() for job in jobs)
+    return ("Batch segmentation: " + str(n_done) + " done, " + str(n_failed) + " failed, " + str(n_cancelled) +
+            " cancelled (" + str(round(total_time, 1)) + " s of work)")
@@ -0,0 +1,489 @@
+"""
+Benchmarks of the plugin operations on synthetic images.
+
+Each benchmark builds a synthetic microscopy image of axons surrounded by myelin, with its ground truth masks, opens it
+in a headless napari viewer and drives ADSplugin like a user would: apply a model (a tiny stub model, so the benchmark
+measures the plugin and not the network), load a mask, fill the axons, save the segmentation and compute the
+morphometrics. The dialogs are answered automatically. The start-up of the plugin is measured in a new interpreter:
+the import of the headless pipeline (which must not import napari or Qt), the import of the widget and the time until
+the widget is shown. Each start-up operation has a time budget, and the run fails when one is exceeded. The wall time
+and the peak memory of each operation are written to a JSON file, and two result files (for example of two commits)
+can be compared.
+
+Usage: python -m napari_ADS.benchmarks [--sizes 1000 2000 ...] [--output RESULTS.json]
+                                       [--startup-budget OPERATION SECONDS ...]
+       python -m napari_ADS.benchmarks --smoke
+       python -m napari_ADS.benchmarks --compare BASELINE.json RESULTS.json
+"""
+import argparse
+import datetime
+import gc
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import ExitStack
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+DEFAULT_SIZES = (1000, 2000, 5000, 10000, 20000)
+# Sizes of the quick check run before merging a change. The largest one is above pyramids.MIN_PYRAMID_SIZE, so the
+# layers of large images are covered.
+SMOKE_SIZES = (1000, 5000)
+OPERATIONS = ("apply_model", "load_mask", "fill_axons", "save_segmentation", "compute_morphometrics")
+# Operations measured once, in a new interpreter so nothing is imported yet. Their results have a size of 0.
+STARTUP_OPERATIONS = ("import_pipeline", "import_widget", "show_widget")
+# Longest time allowed for each start-up operation, in seconds. The run fails when one of them is exceeded.
+DEFAULT_STARTUP_BUDGETS_S = {"import_pipeline": 2.0, "import_widget": 5.0, "show_widget": 2.0}
+# Prints the time of each start-up operation, as JSON
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import napari_ADS.pipeline
+times = {"import_pipeline": time.perf_counter() - start}
+gui_modules = sorted(name for name in ("qtpy", "napari") if name in sys.modules)
+import napari
+from qtpy.QtWidgets import QApplication
+start = time.perf_counter()
+from napari_ADS._widget import ADSplugin
+times["import_widget"] = time.perf_counter() - start
+viewer = napari.Viewer(show=False)
+start = time.perf_counter()
+plugin = ADSplugin(viewer)
+plugin.show()
+QApplication.processEvents()
+times["show_widget"] = time.perf_counter() - start
+plugin.discovery_thread.wait()
+viewer.close()
+print(json.dumps({"times": times, "gui_modules": gui_modules}))
+"""
+# Pixel size of the synthetic images and of the stub model, in micrometers
+PIXEL_SIZE = 0.1
+STUB_MODEL_NAME = "model_benchmark_stub"
+STUB_PATCH_SHAPE = (256, 256)
+# Each axon is drawn in its own square cell, so the axons never touch
+CELL_SIZE = 48
+AXON_RADIUS_RANGE = (6, 14)
+MYELIN_THICKNESS_RANGE = (2, 7)
+BACKGROUND_INTENSITY = 140
+MYELIN_INTENSITY = 40
+AXON_INTENSITY = 220
+NOISE_STD = 15
+# Number of rows of the synthetic image drawn at once
+BLOCK_ROWS = 512
+# An operation is reported as a regression when it is this many times slower or larger than the baseline
+REGRESSION_RATIO = 1.2
+EXIT_SUCCESS = 0
+EXIT_REGRESSION = 1
+EXIT_OVER_BUDGET = 2
+
+
+class BenchmarkError(Exception):
+    """
+    Raised when the plugin shows an error message during a benchmark.
+    """
+
+
+def make_synthetic_sample(size, seed=0):
+    """
+    Draws a square image of axons (bright disks) surrounded by myelin (dark rings), with noise.
+    :param size: Width and height of the image, in pixels
+    :return: The uint8 image, the axon mask and the myelin mask
+    :rtype: tuple
+    """
+    rng = np.random.default_rng(seed)
+    n_cells = -(-size // CELL_SIZE)
+    axon_radii = rng.uniform(*AXON_RADIUS_RANGE, (n_cells, n_cells))
+    outer_radii = axon_radii + rng.uniform(*MYELIN_THICKNESS_RANGE, (n_cells, n_cells))
+    # The centers are moved randomly, as far as the myelin stays in its cell
+    max_shifts = CELL_SIZE / 2 - outer_radii - 1
+    cell_centers = (np.arange(n_cells) + 0.5) * CELL_SIZE
+    centers_y = cell_centers[:, None] + rng.uniform(-1, 1, (n_cells, n_cells)) * max_shifts
+    centers_x = cell_centers[None, :] + rng.uniform(-1, 1, (n_cells, n_cells)) * max_shifts
+
+    image = np.empty((size, size), dtype=np.uint8)
+    axon_mask = np.empty((size, size), dtype=bool)
+    myelin_mask = np.empty((size, size), dtype=bool)
+    columns = np.arange(size)
+    for start in range(0, size, BLOCK_ROWS):
+        rows = np.arange(start, min(start + BLOCK_ROWS, size))
+        cells = (rows[:, None] // CELL_SIZE, columns[None, :] // CELL_SIZE)
+        distances = np.hypot(rows[:, None] - centers_y[cells], columns[None, :] - centers_x[cells])
+        axon_block = distances < axon_radii[cells]
+        myelin_block = ~axon_block & (distances < outer_radii[cells])
+        intensities = rng.normal(BACKGROUND_INTENSITY, NOISE_STD, distances.shape)
+        intensities[myelin_block] += MYELIN_INTENSITY - BACKGROUND_INTENSITY
+        intensities[axon_block] += AXON_INTENSITY - BACKGROUND_INTENSITY
+        image[rows[0]:rows[-1] + 1] = np.clip(intensities, 0, 255)
+        axon_mask[rows[0]:rows[-1] + 1] = axon_block
+        myelin_mask[rows[0]:rows[-1] + 1] = myelin_block
+    return image, axon_mask, myelin_mask
+
+
+def create_stub_model(directory):
+    """
+    Writes a model folder with a single convolution, predicting the bright pixels as axon and the dark ones as myelin.
+    :return: The path of the model folder
+    :rtype: Path
+    """
+    import torch
+
+    model_path = Path(directory) / STUB_MODEL_NAME
+    model_path.mkdir(parents=True, exist_ok=True)
+    model = torch.nn.Sequential(torch.nn.Conv2d(1, 2, kernel_size=3, padding=1), torch.nn.Sigmoid())
+    with torch.no_grad():
+        model[0].weight.zero_()
+        model[0].weight[0, 0, 1, 1] = 4.0
+        model[0].weight[1, 0, 1, 1] = -4.0
+        model[0].bias.fill_(-4.0)
+    torch.save(model, str(model_path / (STUB_MODEL_NAME + ".pt")))
+    config = {
+        "default_model": {"name": "Unet", "length_2D": list(STUB_PATCH_SHAPE)},
+        # ivadomed stores the pixel size in millimeters
+        "transformation": {"Resample": {"wspace": PIXEL_SIZE / 1000, "hspace": PIXEL_SIZE / 1000}},
+        "loader_parameters": {"target_suffix": ["_seg-axon-manual", "_seg-myelin-manual"]},
+    }
+    with open(model_path / (STUB_MODEL_NAME + ".json"), "w") as config_file:
+        json.dump(config, config_file, indent=4)
+    return model_path
+
+
+def get_max_rss_mb():
+    """
+    :return: The largest resident memory of the process so far, in MB, or None if it can't be read
+    :rtype: float
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+def measure_startup(budgets=None):
+    """
+    Measures the start-up operations in a new interpreter.
+    :param budgets: Longest time allowed for each start-up operation, in seconds (DEFAULT_STARTUP_BUDGETS_S if None).
+                    The operations without a budget are only measured.
+    :return: One result per start-up operation, with its budget
+    :rtype: list of dict
+    """
+    budgets = DEFAULT_STARTUP_BUDGETS_S if budgets is None else budgets
+    process = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=str(Path(__file__).parent.parent),
+                             capture_output=True, text=True)
+    if process.returncode != 0:
+        raise BenchmarkError("Couldn't measure the start-up of the plugin:\n" + process.stderr)
+    startup = json.loads(process.stdout.strip().splitlines()[-1])
+    if len(startup["gui_modules"]) > 0:
+        raise BenchmarkError("The headless pipeline imports " + ", ".join(startup["gui_modules"]))
+    results = []
+    for operation in STARTUP_OPERATIONS:
+        wall_time = startup["times"][operation]
+        budget = budgets.get(operation)
+        print(operation + ": " + str(round(wall_time, 3)) + " s" +
+              ("" if budget is None else " (budget: " + str(budget) + " s)"))
+        results.append({"size": 0, "operation": operation, "wall_time_s": wall_time, "peak_memory_mb": None,
+                        "max_rss_mb": None, "budget_s": budget})
+    return results
+
+
+def get_over_budget(results):
+    """
+    :return: The results of the operations that took longer than their budget
+    :rtype: list of dict
+    """
+    return [result for result in results["results"]
+            if result.get("budget_s") is not None and result["wall_time_s"] > result["budget_s"]]
+
+
+def get_commit():
+    """
+    :return: The short hash of the git commit of the plugin, or "unknown"
+    :rtype: str
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=str(Path(__file__).parent),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class PluginBenchmark:
+    """
+    Drives the operations of an ADSplugin on a headless viewer, and measures each of them.
+    """
+    def __init__(self, work_directory, trace_memory=True, cpu_workers=1):
+        import napari
+        from ._widget import ADSplugin
+        from .result_cache import ResultCache
+
+        self.work_directory = Path(work_directory)
+        self.trace_memory = trace_memory
+        self.viewer = napari.Viewer(show=False)
+        self.plugin = ADSplugin(self.viewer)
+        # The models found by the plugin are not used, but the discovery must not run during the measures
+        self.plugin.discovery_thread.wait()
+        self.process_events()
+        self.plugin.settings.n_cpu_workers = cpu_workers
+        # The sizes measured are large enough for a multiscale layer, whose masks can't be edited by the operations
+        self.plugin.settings.multiscale_display = False
+        # Every segmentation must run the model, so nothing is kept in the result cache
+        self.plugin.result_cache = ResultCache(self.work_directory / "result_cache", max_size_mb=0)
+        self.plugin.apply_model_thread.result_cache = self.plugin.result_cache
+        self.model_path = create_stub_model(self.work_directory)
+        self.plugin.get_selected_model_path = lambda: self.model_path
+        # The messages are shown by Qt slots, where an exception would be lost, so they are checked after each step
+        self.errors = []
+        self.plugin.show_info_message = self.errors.append
+
+    def check_errors(self):
+        """
+        Raises a BenchmarkError if the plugin showed a message since the last check.
+        """
+        errors, self.errors[:] = list(self.errors), []
+        if errors:
+            raise BenchmarkError("\n".join(errors))
+
+    @staticmethod
+    def process_events():
+        from qtpy.QtWidgets import QApplication
+
+        QApplication.processEvents()
+
+    def wait_for(self, thread):
+        """
+        Waits for a thread started by the plugin, then delivers its signals to the plugin.
+        """
+        thread.wait()
+        self.process_events()
+        self.check_errors()
+
+    def measure(self, operation):
+        """
+        Runs an operation.
+        :return: The wall time of the operation in seconds, the peak of the memory allocated during the operation in MB
+                 (None if the memory is not traced), and the largest resident memory of the process in MB
+        :rtype: dict
+        """
+        gc.collect()
+        if self.trace_memory:
+            tracemalloc.start()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            operation()
+            self.check_errors()
+        finally:
+            wall_time = time.perf_counter() - start
+            peak_memory = None
+            if self.trace_memory:
+                peak_memory = (tracemalloc.get_traced_memory()[1] - start_memory) / 2 ** 20
+                tracemalloc.stop()
+        return {"wall_time_s": wall_time, "peak_memory_mb": peak_memory, "max_rss_mb": get_max_rss_mb()}
+
+    def run(self, size, seed=0):
+        """
+        Measures every operation on a synthetic image.
+        :param size: Width and height of the image, in pixels
+        :return: One result per operation
+        :rtype: list of dict
+        """
+        from qtpy.QtWidgets import QFileDialog
+        from . import saving
+
+        image, axon_mask, myelin_mask = make_synthetic_sample(size, seed)
+        image_name = "synthetic_" + str(size)
+        masks_directory = self.work_directory / (image_name + "_masks")
+        masks_directory.mkdir(exist_ok=True)
+        saving.save_segmentation(axon_mask, myelin_mask, masks_directory, image_name)
+        del axon_mask, myelin_mask
+        save_directory = self.work_directory / (image_name + "_saved")
+        save_directory.mkdir(exist_ok=True)
+        morphometrics_path = self.work_directory / (image_name + "_morphometrics.csv")
+
+        self.viewer.layers.clear()
+        image_layer = self.viewer.add_image(image, name=image_name, metadata={"pixel_size": PIXEL_SIZE})
+        del image
+        self.viewer.layers.selection.active = image_layer
+
+        def apply_model():
+            self.plugin._on_apply_model_button_click()
+            self.wait_for(self.plugin.apply_model_thread)
+
+        def load_mask():
+            self.plugin._on_load_mask_button_click()
+            self.wait_for(self.plugin.mask_loading_thread)
+
+        def save_segmentation():
+            self.plugin._on_save_segmentation_button()
+            self.wait_for(self.plugin.save_segmentation_thread)
+
+        def compute_morphometrics():
+            self.plugin._on_compute_morphometrics_button()
+            self.wait_for(self.plugin.morphometrics_thread)
+
+        operations = {
+            "apply_model": apply_model,
+            "load_mask": load_mask,
+            "fill_axons": self.plugin._on_fill_axons_click,
+            "save_segmentation": save_segmentation,
+            "compute_morphometrics": compute_morphometrics,
+        }
+        mask_path = masks_directory / saving.get_mask_file_names(image_name)[0]
+        results = []
+        with ExitStack() as dialogs:
+            dialogs.enter_context(mock.patch.object(QFileDialog, "getOpenFileName",
+                                                    return_value=(str(mask_path), "")))
+            dialogs.enter_context(mock.patch.object(QFileDialog, "getExistingDirectory",
+                                                    return_value=str(save_directory)))
+            dialogs.enter_context(mock.patch.object(QFileDialog, "getSaveFileName",
+                                                    return_value=(str(morphometrics_path), "CSV file(*.csv)")))
+            dialogs.enter_context(mock.patch.object(self.plugin, "show_ok_cancel_message", return_value=True))
+            for operation in OPERATIONS:
+                if operation == "load_mask":
+                    # The masks predicted by the stub model are replaced by the ground truth. The image layer is found
+                    # by name, in case the plugin replaced it.
+                    image_layer = self.viewer.layers[image_name]
+                    for layer in [layer for layer in self.viewer.layers if layer is not image_layer]:
+                        self.viewer.layers.remove(layer)
+                    self.viewer.layers.selection.active = image_layer
+                result = {"size": size, "operation": operation}
+                result.update(self.measure(operations[operation]))
+                print(image_name + " " + operation + ": " + str(round(result["wall_time_s"], 3)) + " s")
+                results.append(result)
+        self.viewer.layers.clear()
+        return results
+
+    def close(self):
+        self.viewer.close()
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, trace_memory=True, cpu_workers=1, seed=0, startup_budgets=None):
+    """
+    Measures every operation of the plugin on a synthetic image of each size.
+    :param startup_budgets: The budgets of the start-up operations (see measure_startup)
+    :return: The metadata of the run and the results of each operation
+    :rtype: dict
+    """
+    import napari
+
+    results = measure_startup(startup_budgets)
+    with tempfile.TemporaryDirectory(prefix="ads_benchmark_") as work_directory:
+        benchmark = PluginBenchmark(work_directory, trace_memory=trace_memory, cpu_workers=cpu_workers)
+        try:
+            for size in sizes:
+                results.extend(benchmark.run(size, seed))
+        finally:
+            benchmark.close()
+    metadata = {
+        "commit": get_commit(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "napari": napari.__version__,
+        "numpy": np.__version__,
+        "trace_memory": trace_memory,
+        "cpu_workers": cpu_workers,
+        "seed": seed,
+    }
+    return {"metadata": metadata, "results": results}
+
+
+def compare_results(baseline, results, regression_ratio=REGRESSION_RATIO):
+    """
+    Compares the results of two benchmark runs, operation by operation.
+    :return: One line per operation measured in both runs, and whether an operation regressed
+    :rtype: tuple
+    """
+    baseline_results = {(result["size"], result["operation"]): result for result in baseline["results"]}
+    lines = []
+    regressed = False
+    for result in results["results"]:
+        baseline_result = baseline_results.get((result["size"], result["operation"]))
+        if baseline_result is None:
+            continue
+        line = str(result["size"]) + " " + result["operation"] + ":"
+        for measure, unit in (("wall_time_s", " s"), ("peak_memory_mb", " MB")):
+            if result[measure] is None or baseline_result[measure] is None:
+                continue
+            ratio = result[measure] / max(baseline_result[measure], 1e-9)
+            line += (" " + str(round(baseline_result[measure], 3)) + " -> " + str(round(result[measure], 3)) + unit +
+                     " (x" + str(round(ratio, 2)) + ")")
+            if ratio > regression_ratio:
+                line += " REGRESSION"
+                regressed = True
+        lines.append(line)
+    return lines, regressed
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(prog="python -m napari_ADS.benchmarks",
+                                     description="Measures the operations of the plugin on synthetic images.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="Width and height of the synthetic images, in pixels")
+    parser.add_argument("--smoke", action="store_true",
+                        help="Quick check of every operation, on images of " +
+                             " and ".join(str(size) for size in SMOKE_SIZES) + " pixels without tracing the memory")
+    parser.add_argument("-o", "--output", help="JSON file receiving the results (benchmark_<commit>.json by default)")
+    parser.add_argument("--cpu-workers", type=int, default=1, help="Number of patches predicted at the same time")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic images")
+    parser.add_argument("--no-trace-memory", action="store_true",
+                        help="Don't trace the allocations, which slows down the operations")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULTS"),
+                        help="Compare two result files instead of running the benchmarks")
+    parser.add_argument("--regression-ratio", type=float, default=REGRESSION_RATIO,
+                        help="Ratio to the baseline from which an operation is reported as a regression")
+    parser.add_argument("--startup-budget", nargs=2, action="append", default=[], metavar=("OPERATION", "SECONDS"),
+                        help="Longest time allowed for a start-up operation (" + ", ".join(STARTUP_OPERATIONS) +
+                             "), replacing its default budget. A negative time removes the budget.")
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the command line.
+    :return: The exit code: EXIT_REGRESSION if a compared operation regressed, EXIT_OVER_BUDGET if a start-up
+             operation exceeded its budget, EXIT_SUCCESS otherwise
+    :rtype: int
+    """
+    parser = get_argument_parser()
+    arguments = parser.parse_args(argv)
+    startup_budgets = dict(DEFAULT_STARTUP_BUDGETS_S)
+    for operation, seconds in arguments.startup_budget:
+        if operation not in STARTUP_OPERATIONS:
+            parser.error("Unknown start-up operation: " + operation)
+        startup_budgets[operation] = float(seconds) if float(seconds) >= 0 else None
+    if arguments.compare is not None:
+        with open(arguments.compare[0], "r") as baseline_file, open(arguments.compare[1], "r") as results_file:
+            lines, regressed = compare_results(json.load(baseline_file), json.load(results_file),
+                                               arguments.regression_ratio)
+        print("\n".join(lines))
+        return EXIT_REGRESSION if regressed else EXIT_SUCCESS
+
+    sizes = SMOKE_SIZES if arguments.smoke else arguments.sizes
+    results = run_benchmarks(sizes, trace_memory=not (arguments.no_trace_memory or arguments.smoke),
+                             cpu_workers=arguments.cpu_workers, seed=arguments.seed, startup_budgets=startup_budgets)
+    output_path = Path(arguments.output or "benchmark_" + results["metadata"]["commit"] + ".json")
+    with open(output_path, "w") as output_file:
+        json.dump(results, output_file, indent=4)
+    print("Results written to " + str(output_path))
+    over_budget = get_over_budget(results)
+    for result in over_budget:
+        print("OVER BUDGET: " + result["operation"] + " took " + str(round(result["wall_time_s"], 3)) +
+              " s instead of " + str(result["budget_s"]) + " s at most")
+    return EXIT_OVER_BUDGET if over_budget else EXIT_SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+Morphometrics of the fibers (connected components of axon + myelin) of a part of the masks.
+
+Each axon is found again in the masks by a seed, one of its pixels, so the morphometrics of a part of an image can be
+merged with the others or replaced when the part is edited. Used by the live morphometrics and by the morphometrics
+computed tile by tile.
+"""
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from . import regions
+
+# Columns added to the morphometrics of each axon to find it again in the masks
+SEED_COLUMNS = ["seed_y (px)", "seed_x (px)"]
+
+
+def get_centroid_columns(stats_dataframe):
+    """
+    :return: The names of the x and y centroid columns of a morphometrics dataframe
+    :rtype: tuple
+    """
+    x_column = next(column for column in stats_dataframe.columns if str(column).startswith("x0"))
+    y_column = next(column for column in stats_dataframe.columns if str(column).startswith("y0"))
+    return x_column, y_column
+
+
+def get_affected_region(axon, myelin, dirty_box):
+    """
+    Grows the bounding box of an edit until it fully contains every fiber that touches it.
+    :param axon: The axon mask
+    :param myelin: The myelin mask
+    :param dirty_box: Bounding box of an edit
+    :return: The region, the window around it, the fiber labels of the window and the labels of the fibers to measure
+    :rtype: tuple
+    """
+    # Pixels next to the edit may have been disconnected from it
+    region = regions.expand_box(dirty_box, 1, axon.shape)
+    return regions.grow_box_to_components([axon, myelin], region)
+
+
+def measure_fibers(axon, myelin, pixel_size, axon_shape, offset=(0, 0)):
+    """
+    Computes the morphometrics of the axons of the given masks, and finds a pixel (seed) inside each of them.
+    :param offset: Position of the masks in the image, added to the coordinates of the results
+    :return: The morphometrics, with the seed columns
+    :rtype: pandas.DataFrame
+    """
+    import AxonDeepSeg.morphometrics.compute_morphometrics as compute_morphs
+    stats_dataframe = compute_morphs.get_axon_morphometrics(im_axon=axon, im_myelin=myelin, pixel_size=pixel_size,
+                                                            axon_shape=axon_shape)
+    stats_dataframe = pd.DataFrame(stats_dataframe)
+    if len(stats_dataframe) == 0:
+        return stats_dataframe.assign(**{column: np.array([], dtype=np.intp) for column in SEED_COLUMNS})
+
+    # Match each row with the axon under its centroid, then keep one pixel of the axon as seed
+    axon_labels, n_axons = ndimage.label(axon, structure=regions.CONNECTIVITY_STRUCTURE)
+    axon_boxes = ndimage.find_objects(axon_labels)
+    x_column, y_column = get_centroid_columns(stats_dataframe)
+    row_centroids = np.column_stack((np.asarray(stats_dataframe[y_column], dtype=float),
+                                     np.asarray(stats_dataframe[x_column], dtype=float)))
+    centroid_pixels = np.clip(np.rint(row_centroids).astype(np.intp), 0, np.array(axon.shape[:2]) - 1)
+    labels = axon_labels[centroid_pixels[:, 0], centroid_pixels[:, 1]]
+    outside = np.flatnonzero(labels == 0)
+    if len(outside) > 0:
+        # The centroid of a concave axon can be outside of it: the axon with the closest centroid is used instead
+        centroids = np.array(ndimage.center_of_mass(axon, axon_labels, np.arange(1, n_axons + 1)))
+        _, closest = cKDTree(centroids).query(row_centroids[outside])
+        labels[outside] = closest + 1
+    seeds = []
+    for label in labels:
+        box = axon_boxes[label - 1]
+        seed_in_box = np.unravel_index(np.argmax(axon_labels[box] == label), axon_labels[box].shape)
+        seeds.append((seed_in_box[0] + box[0].start + offset[0], seed_in_box[1] + box[1].start + offset[1]))
+
+    stats_dataframe[y_column] += offset[0]
+    stats_dataframe[x_column] += offset[1]
+    stats_dataframe[SEED_COLUMNS[0]] = [seed[0] for seed in seeds]
+    stats_dataframe[SEED_COLUMNS[1]] = [seed[1] for seed in seeds]
+    return stats_dataframe
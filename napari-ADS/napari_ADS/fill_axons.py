@@ -0,0 +1,179 @@
+"""
+Filling of the axons inside the myelin, restricted to a region of the image.
+
+The changes are recorded in the undo history of the axon layer as a bounding box with the old and new values packed
+at 1 bit per pixel, so the memory used by the history grows with the area of the edit. The undo of napari can't
+restore a multiscale layer (it writes to the list of levels), so the changes of those layers are recorded in a history
+of their own, bound to the undo and redo keys of the layer.
+"""
+import weakref
+from collections import deque
+
+import numpy as np
+
+from . import masks, profiling, pyramids, regions
+
+# Default maximum area of a hole, relative to the area of the image, in postprocessing.fill_myelin_holes
+MAX_HOLE_AREA_FRACTION = 0.1
+# Number of fills of a multiscale layer that can be undone
+MAX_MULTISCALE_HISTORY = 20
+
+# Multiscale layer -> (undo history, redo history) of its fills
+_multiscale_histories = weakref.WeakKeyDictionary()
+
+
+class PackedMask:
+    """
+    A binary array stored with 1 bit per pixel. It is unpacked when numpy converts it to an array, for example when it
+    is assigned to the data of a layer on undo or redo.
+    """
+    def __init__(self, array):
+        array = np.asarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.packed = np.packbits(array.astype(bool), axis=None)
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.unpackbits(self.packed, count=int(np.prod(self.shape))).reshape(self.shape)
+        return array.astype(self.dtype if dtype is None else dtype, copy=False)
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+
+def pack_values(values):
+    """
+    Packs the values of a mask if they are binary, otherwise keeps a copy of them.
+    """
+    values = np.asarray(values)
+    if values.size == 0 or values.max() <= 1:
+        return PackedMask(values)
+    return np.array(values, copy=True)
+
+
+def save_multiscale_history(layer, history_item):
+    """
+    Records a change of the base of a multiscale layer, and binds the undo and redo keys of the layer to its history.
+    :param history_item: (bounding box, old values, new values)
+    """
+    if layer not in _multiscale_histories:
+        _multiscale_histories[layer] = (deque(maxlen=MAX_MULTISCALE_HISTORY), deque(maxlen=MAX_MULTISCALE_HISTORY))
+        layer.bind_key("Control-Z", lambda bound_layer: undo_multiscale_fill(bound_layer), overwrite=True)
+        layer.bind_key("Control-Shift-Z", lambda bound_layer: undo_multiscale_fill(bound_layer, redo=True),
+                       overwrite=True)
+    undo_history, redo_history = _multiscale_histories[layer]
+    undo_history.append(history_item)
+    redo_history.clear()
+
+
+def undo_multiscale_fill(layer, redo=False):
+    """
+    Undoes (or redoes) the last fill of a multiscale layer.
+    :return: The bounding box of the restored pixels, or None if there was nothing to undo
+    :rtype: tuple
+    """
+    undo_history, redo_history = _multiscale_histories.get(layer, ((), ()))
+    history, other_history = (redo_history, undo_history) if redo else (undo_history, redo_history)
+    if len(history) == 0:
+        return None
+    box, old_values, new_values = history.pop()
+    other_history.append((box, old_values, new_values))
+    values = np.asarray(new_values if redo else old_values)
+    pyramids.get_base_data(layer)[box] = values
+    pyramids.update_layer(layer, box)
+    layer.refresh()
+    # Sent like the undo of napari, for the live morphometrics
+    if hasattr(layer.events, "labels_update"):
+        layer.events.labels_update(data=values, offset=tuple(axis_slice.start for axis_slice in box))
+    return box
+
+
+def get_changed_box(changed_pixels):
+    """
+    :return: The bounding box of the True pixels of an array, or None if there are none
+    :rtype: tuple
+    """
+    rows = np.flatnonzero(changed_pixels.any(axis=1))
+    columns = np.flatnonzero(changed_pixels.any(axis=0))
+    if len(rows) == 0:
+        return None
+    return slice(rows[0], rows[-1] + 1), slice(columns[0], columns[-1] + 1)
+
+
+def get_filled_axons(myelin_data, box=None):
+    """
+    Finds the holes of the myelin mask, which are the axons.
+    :param myelin_data: The myelin mask (any array-like object)
+    :param box: Region of the image to fill. The whole image is filled if None.
+    :return: The region that was filled (grown to contain the myelin sheaths touching the box), and the filled holes
+             of this region
+    :rtype: tuple
+    """
+    from AxonDeepSeg import postprocessing
+    if box is None:
+        box = tuple(slice(0, length) for length in myelin_data.shape)
+        myelin_array = np.array(myelin_data[box], copy=True)
+        axon_extracted_array = postprocessing.fill_myelin_holes(myelin_array)
+    else:
+        # A myelin sheath cut by the border of the region would leave its axon open, so the region is grown to
+        # contain every myelin component touching it
+        box, _, _, _ = regions.grow_box_to_components([myelin_data], box)
+        myelin_array = np.array(myelin_data[box], copy=True)
+        # Keep the same maximum hole area as when the whole image is filled
+        max_area_fraction = (MAX_HOLE_AREA_FRACTION * regions.get_box_size(
+            tuple(slice(0, length) for length in myelin_data.shape)) / regions.get_box_size(box))
+        axon_extracted_array = postprocessing.fill_myelin_holes(myelin_array, max_area_fraction=max_area_fraction)
+    return box, axon_extracted_array
+
+
+def fill_class_map(class_map):
+    """
+    Fills the holes of the myelin in a class map (0: background, 1: myelin, 2: axon), in place.
+    :return: The number of pixels added to the axons
+    :rtype: int
+    """
+    _, axon_extracted_array = get_filled_axons(masks.ClassMaskView(class_map, masks.MASK_LABELS["myelin"]))
+    changed_pixels = (np.asarray(axon_extracted_array) > 0) & (class_map != masks.MASK_LABELS["axon"])
+    class_map[changed_pixels] = masks.MASK_LABELS["axon"]
+    return int(changed_pixels.sum())
+
+
+def fill_axons(axon_layer, myelin_layer, box=None):
+    """
+    Fills the holes of the myelin mask in the axon layer.
+    :param axon_layer: The axon Labels layer, or the axonmyelin Labels layer
+    :param myelin_layer: The myelin Labels layer, or the axonmyelin Labels layer
+    :param box: Region of the image to fill. The whole image is filled if None.
+    :return: The bounding box of the pixels added to the axon mask, or None if no pixel was added
+    :rtype: tuple
+    """
+    axon_value = masks.get_mask_value(axon_layer, "axon")
+    with profiling.stage("hole filling"):
+        box, axon_extracted_array = get_filled_axons(masks.get_mask_data(myelin_layer, "myelin"), box)
+
+    axon_data = pyramids.get_base_data(axon_layer)
+    with profiling.stage("change detection"):
+        old_values = np.asarray(axon_data[box])
+        changed_pixels = (np.asarray(axon_extracted_array) > 0) & (old_values != axon_value)
+        changed_box = get_changed_box(changed_pixels)
+    if changed_box is None:
+        return None
+
+    # Only the bounding box of the changed pixels is saved in the history
+    with profiling.stage("history"):
+        old_values = np.array(old_values[changed_box], copy=True)
+        new_values = np.where(changed_pixels[changed_box], axon_value, old_values).astype(old_values.dtype)
+        history_box = tuple(slice(box_slice.start + changed_slice.start, box_slice.start + changed_slice.stop)
+                            for box_slice, changed_slice in zip(box, changed_box))
+        history_item = (history_box, pack_values(old_values), pack_values(new_values))
+        # The undo of napari writes to the data of the layer, which is the list of levels of a multiscale layer
+        if axon_layer.multiscale:
+            save_multiscale_history(axon_layer, history_item)
+        else:
+            axon_layer._save_history(history_item)
+    with profiling.stage("layer update"):
+        axon_data[history_box] = new_values
+        pyramids.update_layer(axon_layer, history_box)
+        axon_layer.refresh()
+    return history_box
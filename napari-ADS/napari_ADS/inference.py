@@ -0,0 +1,484 @@
+"""
+In-memory inference with the AxonDeepSeg models.
+
+``segment.segment_image`` only works on image files: it reads the image from disk and writes the predicted masks next
+to it. The functions in this module run the same models directly on the array of a napari layer and return the
+predictions as arrays, so nothing has to be written to or read back from the disk.
+"""
+import importlib.util
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from scipy import ndimage
+
+from . import profiling
+
+# Values of the class map returned by the segmentation
+BACKGROUND_LABEL = 0
+MYELIN_LABEL = 1
+AXON_LABEL = 2
+
+# The ADS models are U-Nets of depth 4, so the input must be divisible by 2**4
+MODEL_INPUT_MULTIPLE = 16
+
+# Number of intra-op threads of torch before share_cpu_threads changed it
+_default_num_threads = None
+
+# A patch is read from ``source`` in the image, and only its ``crop`` part (the part that does not overlap with the
+# neighbouring patches) is written to ``destination`` in the prediction.
+Patch = namedtuple("Patch", ["source", "crop", "destination"])
+
+
+class ImageTooSmallError(ValueError):
+    """
+    Raised when the resampled image is smaller than the patch size of the model.
+    """
+    def __init__(self, minimum_zoom_factor):
+        self.minimum_zoom_factor = minimum_zoom_factor
+        super().__init__(
+            "Resampled image smaller than model's patch size. Please use a zoom factor of at least "
+            + str(round(minimum_zoom_factor, 4)) + " (option available in the Settings menu)."
+        )
+
+
+def get_ads_path():
+    """
+    :return: The folder of the AxonDeepSeg package, found without importing it
+    :rtype: Path
+    """
+    return Path(importlib.util.find_spec("AxonDeepSeg").origin).parents[0]
+
+
+def get_model_config(path_model):
+    """
+    Reads the ivadomed configuration file of a model.
+    :param path_model: Path to the folder of the model
+    :return: The configuration of the model
+    :rtype: dict
+    """
+    path_model = Path(path_model)
+    with open(find_model_file(path_model, ".json"), "r") as config_file:
+        return json.load(config_file)
+
+
+def find_model_file(path_model, extension):
+    """
+    Finds the file with the given extension in the folder of a model. The file named after the folder is preferred.
+    :param path_model: Path to the folder of the model
+    :param extension: Extension of the file, for example ".pt"
+    :return: Path to the file
+    :rtype: Path
+    """
+    path_model = Path(path_model)
+    model_file = path_model / (path_model.name + extension)
+    if model_file.exists():
+        return model_file
+    candidates = sorted(path_model.glob("*" + extension))
+    if len(candidates) == 0:
+        raise FileNotFoundError("No " + extension + " file found in " + str(path_model))
+    return candidates[0]
+
+
+def load_torch_model(path_model, device):
+    """
+    Loads the PyTorch model of an ADS model folder, in evaluation mode.
+    :param device: The torch device receiving the model
+    """
+    import torch
+
+    model_file = find_model_file(path_model, ".pt")
+    try:
+        model = torch.load(str(model_file), map_location=device, weights_only=False)
+    except TypeError:
+        # Older versions of torch don't have the weights_only argument
+        model = torch.load(str(model_file), map_location=device)
+    model.eval()
+    return model
+
+
+class ModelSession:
+    """
+    A loaded ADS model, ready to predict patches.
+    """
+    def __init__(self, path_model, gpu_id=0):
+        """
+        Constructor for the ModelSession class. Loads the model and reads the parameters needed for inference.
+        :param path_model: Path to the folder of the model
+        :param gpu_id: ID of the GPU to use, if one is available
+        """
+        self.path_model = Path(path_model)
+        self.config = get_model_config(self.path_model)
+        self.load_model(gpu_id)
+
+        self.patch_shape = tuple(self.config["default_model"]["length_2D"])
+        # ivadomed stores the pixel size in millimeters
+        self.pixel_size = self.config["transformation"]["Resample"]["wspace"] * 1000
+        self.axon_channel, self.myelin_channel = get_class_channels(self.config)
+
+    def load_model(self, gpu_id):
+        """
+        Loads the model on the GPU if one is available, or on the CPU. Sets self.device and self.model.
+        """
+        import torch
+
+        if torch.cuda.is_available() and gpu_id < torch.cuda.device_count():
+            self.device = torch.device("cuda:" + str(gpu_id))
+        else:
+            self.device = torch.device("cpu")
+        self.model = load_torch_model(self.path_model, self.device)
+
+    def predict(self, patch):
+        """
+        Predicts the class probabilities of a normalized patch.
+        :param patch: 2D float32 array
+        :return: The probabilities of each class, with shape (n_classes, height, width)
+        :rtype: numpy.ndarray
+        """
+        import torch
+
+        with torch.no_grad():
+            tensor = torch.from_numpy(np.ascontiguousarray(patch[None, None])).to(self.device)
+            return self.model(tensor)[0].cpu().numpy()
+
+
+class ModelCache:
+    """
+    Keeps the most recently used ModelSessions in memory, so applying the same model again doesn't reload it.
+    The sessions are keyed by model path, GPU ID and backend, and the least recently used one is released when the
+    cache is full.
+    """
+    def __init__(self, max_size=2):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path_model, gpu_id=0, backend=None):
+        """
+        Returns the session of a model, loading the model if it isn't in the cache.
+        :param path_model: Path to the folder of the model
+        :param gpu_id: ID of the GPU to use, if one is available
+        :param backend: One of backends.BACKENDS. The PyTorch model is used if None.
+        :rtype: ModelSession
+        """
+        from . import backends
+
+        backend = backend or backends.PYTORCH_BACKEND
+        key = (str(Path(path_model).resolve()), gpu_id, backend)
+        with self._lock:
+            if key in self._sessions:
+                self.hits += 1
+                self._sessions.move_to_end(key)
+                return self._sessions[key]
+            self.misses += 1
+            session = backends.create_session(path_model, gpu_id=gpu_id, backend=backend)
+            self._sessions[key] = session
+            self._evict()
+            return session
+
+    def set_max_size(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            self._evict()
+
+    def clear(self):
+        """
+        Releases every model held by the cache.
+        """
+        with self._lock:
+            self._sessions.clear()
+        release_device_memory()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get_stats_string(self):
+        return ("Model cache: " + str(len(self)) + "/" + str(self.max_size) + " models loaded, " +
+                str(self.hits) + " hits, " + str(self.misses) + " misses")
+
+    def _evict(self):
+        evicted = False
+        while len(self._sessions) > self.max_size:
+            self._sessions.popitem(last=False)
+            evicted = True
+        if evicted:
+            release_device_memory()
+
+
+def release_device_memory():
+    """
+    Returns the memory cached by torch on the GPU to the system.
+    """
+    try:
+        import torch
+    except ImportError:
+        return
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def get_class_channels(config):
+    """
+    Finds which output channels of a model correspond to the axon and myelin classes.
+    :param config: The configuration of the model
+    :return: The axon channel and the myelin channel
+    :rtype: tuple
+    """
+    target_suffixes = config.get("loader_parameters", {}).get("target_suffix", [])
+    axon_channel, myelin_channel = 0, 1
+    for channel, suffix in enumerate(target_suffixes):
+        if "myelin" in suffix:
+            myelin_channel = channel
+        elif "axon" in suffix:
+            axon_channel = channel
+    return axon_channel, myelin_channel
+
+
+def to_grayscale(image, rgb=False):
+    """
+    Converts an image to a 2D float32 array.
+    :param image: The image data
+    :param rgb: Whether the last axis of the image contains color channels
+    :return: The grayscale image
+    :rtype: numpy.ndarray
+    """
+    image = np.asarray(image)
+    if rgb:
+        return image[..., :3].mean(axis=-1, dtype=np.float32)
+    return image.astype(np.float32, copy=False)
+
+
+def get_resampling_factor(session, pixel_size, zoom_factor):
+    """
+    :return: The factor by which the image has to be rescaled to match the pixel size of the model
+    :rtype: float
+    """
+    return pixel_size * zoom_factor / session.pixel_size
+
+
+def check_image_size(image_shape, patch_shape, resampling_factor, zoom_factor):
+    """
+    Raises an ImageTooSmallError if the image, once resampled, would be smaller than a patch.
+    """
+    minimum_factor = max(patch / length for patch, length in zip(patch_shape, image_shape))
+    if resampling_factor < minimum_factor:
+        raise ImageTooSmallError(zoom_factor * minimum_factor / resampling_factor)
+
+
+def resample(image, factor, order=1):
+    """
+    Rescales an image by the given factor.
+    """
+    if factor == 1:
+        return image
+    # grid_mode aligns the pixel centers the same way as the tiled segmentation
+    return ndimage.zoom(image, factor, order=order, grid_mode=True, mode="nearest")
+
+
+def resize_nearest(array, shape):
+    """
+    Resizes a label array to the given shape with nearest neighbour interpolation.
+    """
+    if array.shape == tuple(shape):
+        return array
+    indexes = [
+        np.minimum(((np.arange(length) + 0.5) * array.shape[axis] / length).astype(np.intp), array.shape[axis] - 1)
+        for axis, length in enumerate(shape)
+    ]
+    return array[np.ix_(*indexes)]
+
+
+def normalize(image):
+    """
+    Normalizes an image to zero mean and unit variance, like the NormalizeInstance transformation of ivadomed.
+    """
+    image = np.array(image, dtype=np.float32, copy=True)
+    image -= image.mean()
+    std = image.std()
+    if std > 0:
+        image /= std
+    return image
+
+
+def get_axis_tiles(length, patch_length, overlap):
+    """
+    Splits an axis in overlapping tiles. Each tile owns the pixels that are closer to its center than to the center
+    of its neighbours, so every pixel is written by exactly one tile.
+    :return: A list of (start of the tile, start of the owned part, end of the owned part)
+    :rtype: list
+    """
+    stride = patch_length - overlap
+    if stride <= 0:
+        raise ValueError("The overlap value must be smaller than the patch size of the model (" +
+                         str(patch_length) + ")")
+    starts = list(range(0, length - patch_length + 1, stride))
+    if starts[-1] + patch_length < length:
+        starts.append(length - patch_length)
+    bounds = [0] + [(starts[i + 1] + starts[i] + patch_length) // 2 for i in range(len(starts) - 1)] + [length]
+    return [(start, bounds[i], bounds[i + 1]) for i, start in enumerate(starts)]
+
+
+def get_patches(image_shape, patch_shape, overlap_value):
+    """
+    Computes the patches used to segment an image.
+    :param image_shape: Shape of the (resampled) image
+    :param patch_shape: Shape of the input of the model
+    :param overlap_value: Overlap between the patches, in pixels, for each axis
+    :return: The list of patches
+    :rtype: list of Patch
+    """
+    row_tiles = get_axis_tiles(image_shape[0], patch_shape[0], overlap_value[0])
+    column_tiles = get_axis_tiles(image_shape[1], patch_shape[1], overlap_value[1])
+    patches = []
+    for row_start, row_begin, row_end in row_tiles:
+        for column_start, column_begin, column_end in column_tiles:
+            patches.append(Patch(
+                source=(slice(row_start, row_start + patch_shape[0]),
+                        slice(column_start, column_start + patch_shape[1])),
+                crop=(slice(row_begin - row_start, row_end - row_start),
+                      slice(column_begin - column_start, column_end - column_start)),
+                destination=(slice(row_begin, row_end), slice(column_begin, column_end))
+            ))
+    return patches
+
+
+def probabilities_to_class_map(probabilities, axon_channel, myelin_channel):
+    """
+    Converts the probabilities predicted by a model to a class map. Each pixel gets the class with the highest
+    probability, or the background if no class reaches 0.5.
+    :return: The class map (see BACKGROUND_LABEL, MYELIN_LABEL and AXON_LABEL)
+    :rtype: numpy.ndarray of uint8
+    """
+    axon_probabilities = probabilities[axon_channel]
+    myelin_probabilities = probabilities[myelin_channel]
+    class_map = np.where(axon_probabilities >= myelin_probabilities, AXON_LABEL, MYELIN_LABEL).astype(np.uint8)
+    class_map[np.maximum(axon_probabilities, myelin_probabilities) < 0.5] = BACKGROUND_LABEL
+    return class_map
+
+
+def predict_whole_image(session, image):
+    """
+    Predicts the class map of a normalized image in a single pass (the "no patch" option).
+    """
+    pad_width = [(0, -length % MODEL_INPUT_MULTIPLE) for length in image.shape]
+    padded_image = np.pad(image, pad_width, mode="reflect")
+    probabilities = session.predict(padded_image)
+    class_map = probabilities_to_class_map(probabilities, session.axon_channel, session.myelin_channel)
+    return class_map[:image.shape[0], :image.shape[1]]
+
+
+def share_cpu_threads(n_workers):
+    """
+    Shares the CPU cores between the workers of a run: each worker gets its part of the intra-op threads of torch, so
+    the workers don't oversubscribe the cores. The number of threads of torch is global to the process, so this must be
+    called once per run, from the thread starting it (not from the workers), with the total number of workers (the
+    batch workers times the patch workers of each image).
+    :param n_workers: Number of patches predicted at the same time in the whole process
+    """
+    global _default_num_threads
+    import torch
+
+    if _default_num_threads is None:
+        _default_num_threads = torch.get_num_threads()
+    torch.set_num_threads(max(1, _default_num_threads // max(1, n_workers)))
+
+
+def predict_patch_class_maps(session, patches, read_patch, n_workers=1):
+    """
+    Predicts the class map of each patch. On the CPU, the patches are split between n_workers threads (torch releases
+    the GIL while it computes).
+    :param patches: The list of patches to predict
+    :param read_patch: Function returning the normalized input of a patch
+    :param n_workers: Number of patches predicted at the same time on the CPU
+    :return: The (patch, class map of the patch) pairs, in the order of the patches
+    :rtype: generator
+    """
+    def predict(patch):
+        start = time.perf_counter()
+        probabilities = session.predict(read_patch(patch))
+        patch_class_map = probabilities_to_class_map(probabilities, session.axon_channel, session.myelin_channel)
+        return patch_class_map, time.perf_counter() - start
+
+    n_workers = min(n_workers, len(patches))
+    if n_workers <= 1 or session.device.type != "cpu":
+        for patch in patches:
+            yield patch, predict(patch)[0]
+        return
+
+    start = time.perf_counter()
+    patch_time = 0.0
+    with ThreadPoolExecutor(max_workers=n_workers) as workers:
+        for patch, (patch_class_map, predict_time) in zip(patches, workers.map(predict, patches)):
+            patch_time += predict_time
+            yield patch, patch_class_map
+    total_time = time.perf_counter() - start
+    # The sum of the patch times over the wall time is the average number of patches predicted at once. It isn't a
+    # speedup: each patch is slower when the cores are shared.
+    profiling.add_note("parallel occupancy", str(round(patch_time / max(total_time, 1e-9), 2)) + " of " +
+                       str(n_workers) + " CPU workers (" + str(len(patches)) + " patches in " +
+                       str(round(total_time, 2)) + " s)")
+
+
+def predict_patches(session, image, overlap_value, n_workers=1):
+    """
+    Predicts the class map of a normalized image patch by patch.
+    """
+    class_map = np.zeros(image.shape, dtype=np.uint8)
+    patches = get_patches(image.shape, session.patch_shape, overlap_value)
+    stitching_time = 0.0
+    for patch, patch_class_map in predict_patch_class_maps(session, patches, lambda patch: image[patch.source],
+                                                           n_workers=n_workers):
+        start = time.perf_counter()
+        class_map[patch.destination] = patch_class_map[patch.crop]
+        stitching_time += time.perf_counter() - start
+    profiling.add_stage("stitching", stitching_time)
+    return class_map
+
+
+def segment_array(session, image, pixel_size, zoom_factor=1.0, overlap_value=(48, 48), no_patch=False, rgb=False,
+                  n_workers=1):
+    """
+    Segments an image held in memory.
+    :param session: The ModelSession of the model to apply
+    :param image: The image data
+    :param pixel_size: The pixel size of the image, in micrometers
+    :param zoom_factor: Multiplicative constant applied to the pixel size before inference
+    :param overlap_value: Overlap between the patches, in pixels, for each axis
+    :param no_patch: If True, the image is segmented in a single pass
+    :param rgb: Whether the last axis of the image contains color channels
+    :param n_workers: Number of patches predicted at the same time on the CPU
+    :return: The class map of the image, at the resolution of the image
+    :rtype: numpy.ndarray of uint8
+    """
+    with profiling.stage("grayscale conversion"):
+        image = to_grayscale(image, rgb)
+    resampling_factor = get_resampling_factor(session, pixel_size, zoom_factor)
+    check_image_size(image.shape, session.patch_shape, resampling_factor, zoom_factor)
+
+    with profiling.stage("resampling"):
+        resampled_image = normalize(resample(image, resampling_factor))
+    with profiling.stage("inference"):
+        if no_patch:
+            class_map = predict_whole_image(session, resampled_image)
+        else:
+            class_map = predict_patches(session, resampled_image, overlap_value, n_workers=n_workers)
+    with profiling.stage("resizing to the image"):
+        return resize_nearest(class_map, image.shape)
+
+
+def split_class_map(class_map):
+    """
+    Splits a class map in an axon mask and a myelin mask.
+    :return: The axon mask and the myelin mask, as uint8 arrays of 0 and 1
+    :rtype: tuple
+    """
+    # Viewing the boolean arrays as uint8 doesn't copy them
+    axon_mask = (class_map == AXON_LABEL).view(np.uint8)
+    myelin_mask = (class_map == MYELIN_LABEL).view(np.uint8)
+    return axon_mask, myelin_mask
@@ -0,0 +1,189 @@
+"""
+Morphometrics that are kept up to date while the masks are edited.
+
+The engine listens to the paint events of the axon and myelin Labels layers, and to the updates made by the undo and
+redo of napari, and keeps the bounding boxes of the edits. Only the fibers (connected components of axon + myelin)
+touching those boxes are measured again, so the time of an update depends on the size of the edit rather than on the
+size of the image. The edits made without events (filling of the axons) are passed to LiveMorphometrics.update.
+The whole image is only measured once, by a MorphometricsThread (see _threads.py), and the edits made meanwhile are
+measured when its results are set.
+"""
+import numpy as np
+import pandas as pd
+from qtpy.QtCore import QTimer
+from qtpy.QtWidgets import QTableWidget, QTableWidgetItem
+
+from . import masks, pyramids, regions
+from .fibers import SEED_COLUMNS, get_affected_region, measure_fibers
+
+
+class LiveMorphometrics:
+    """
+    Keeps the morphometrics of a pair of axon and myelin Labels layers (or of an axonmyelin Labels layer, passed as
+    both layers) up to date while they are edited.
+    """
+    def __init__(self, axon_layer, myelin_layer, pixel_size, axon_shape="circle", on_update=None):
+        """
+        :param on_update: Called with (removed axon IDs, added rows) after each update
+        """
+        self.axon_layer = axon_layer
+        self.myelin_layer = myelin_layer
+        self.pixel_size = pixel_size
+        self.axon_shape = axon_shape
+        self.on_update = on_update
+        self.stats_dataframe = None
+        self.next_axon_id = 0
+        self.dirty_box = None
+
+    def start(self):
+        """
+        Starts listening to the edits. The edits are kept until the morphometrics of the whole image are set.
+        """
+        for layer in self.get_layers():
+            layer.events.paint.connect(self._on_paint)
+            layer.events.data.connect(self._on_data)
+            # The undo and redo of napari don't send paint events. Recent versions send a labels_update event instead.
+            if hasattr(layer.events, "labels_update"):
+                layer.events.labels_update.connect(self._on_labels_update)
+
+    def set_stats_dataframe(self, stats_dataframe):
+        """
+        Sets the morphometrics of the whole image, measured with the seed columns on a copy of the masks taken before
+        start() was called, then measures the edits made since.
+        """
+        stats_dataframe = pd.DataFrame(stats_dataframe)
+        for column in SEED_COLUMNS:
+            if column not in stats_dataframe.columns:
+                # No axon was found
+                stats_dataframe[column] = np.array([], dtype=np.intp)
+        stats_dataframe.index = pd.RangeIndex(len(stats_dataframe))
+        self.stats_dataframe = stats_dataframe
+        self.next_axon_id = len(stats_dataframe)
+        if self.dirty_box is not None:
+            QTimer.singleShot(0, self._update_dirty_box)
+
+    def stop(self):
+        self.stats_dataframe = None
+        self.dirty_box = None
+        for layer in self.get_layers():
+            layer.events.paint.disconnect(self._on_paint)
+            layer.events.data.disconnect(self._on_data)
+            if hasattr(layer.events, "labels_update"):
+                layer.events.labels_update.disconnect(self._on_labels_update)
+
+    def get_layers(self):
+        if self.axon_layer is self.myelin_layer:
+            return [self.axon_layer]
+        return [self.axon_layer, self.myelin_layer]
+
+    def invalidate(self, box):
+        """
+        Schedules the update of the fibers touching a bounding box.
+        """
+        schedule_update = self.dirty_box is None
+        self.dirty_box = box if self.dirty_box is None else regions.merge_boxes(self.dirty_box, box)
+        # The events can be sent before the data is modified, so the update waits for the event loop. The edits made
+        # in the meantime are merged in the same update.
+        if schedule_update:
+            QTimer.singleShot(0, self._update_dirty_box)
+
+    def _on_paint(self, event):
+        event_box = regions.get_paint_event_bounding_box(event, pyramids.get_base_data(self.axon_layer).shape)
+        if event_box is not None:
+            self.invalidate(event_box)
+
+    def _on_labels_update(self, event):
+        offset = getattr(event, "offset", None)
+        data = getattr(event, "data", None)
+        if offset is None or data is None:
+            return
+        shape = pyramids.get_base_data(self.axon_layer).shape
+        event_box = regions.clip_box(tuple(slice(int(start), int(start) + length)
+                                           for start, length in zip(offset, data.shape)), shape)
+        if event_box is not None:
+            self.invalidate(event_box)
+
+    def _on_data(self, event):
+        # The data of the layer was replaced: every fiber is measured again
+        self.invalidate(tuple(slice(0, length) for length in pyramids.get_base_data(self.axon_layer).shape))
+
+    def _update_dirty_box(self):
+        if self.dirty_box is None or self.stats_dataframe is None:
+            return
+        dirty_box = self.dirty_box
+        self.dirty_box = None
+        self.update(dirty_box)
+
+    def update(self, dirty_box):
+        """
+        Measures again the fibers touching the given bounding box.
+        :param dirty_box: Bounding box of an edit, as a tuple of slices
+        """
+        axon = masks.get_mask_data(self.axon_layer, "axon")
+        myelin = masks.get_mask_data(self.myelin_layer, "myelin")
+        region, window, fiber_labels, touching_labels = get_affected_region(axon, myelin, dirty_box)
+
+        # Every axon with its seed in the region belongs to a fiber that is measured again (or that was erased)
+        seeds_y = self.stats_dataframe[SEED_COLUMNS[0]]
+        seeds_x = self.stats_dataframe[SEED_COLUMNS[1]]
+        in_region = ((seeds_y >= region[0].start) & (seeds_y < region[0].stop) &
+                     (seeds_x >= region[1].start) & (seeds_x < region[1].stop))
+        removed_ids = list(self.stats_dataframe.index[in_region])
+
+        fibers_to_measure = np.isin(fiber_labels, touching_labels)
+        added_rows = measure_fibers(
+            np.asarray(axon[window], dtype=bool) & fibers_to_measure,
+            np.asarray(myelin[window], dtype=bool) & fibers_to_measure,
+            self.pixel_size,
+            self.axon_shape,
+            offset=(window[0].start, window[1].start)
+        )
+        added_rows.index = pd.RangeIndex(self.next_axon_id, self.next_axon_id + len(added_rows))
+        self.next_axon_id += len(added_rows)
+
+        self.stats_dataframe = pd.concat([self.stats_dataframe.drop(index=removed_ids), added_rows])
+        if self.on_update is not None:
+            self.on_update(removed_ids, added_rows)
+
+
+class MorphometricsTable(QTableWidget):
+    """
+    Table showing the morphometrics of each axon, updated row by row.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # First item of the row of each axon ID, which follows the row when the table is sorted
+        self._row_items = {}
+
+    def set_dataframe(self, stats_dataframe):
+        self.setRowCount(0)
+        self._row_items = {}
+        self.setColumnCount(len(stats_dataframe.columns))
+        self.setHorizontalHeaderLabels([str(column) for column in stats_dataframe.columns])
+        self.add_rows(stats_dataframe)
+
+    def update_rows(self, removed_ids, added_rows):
+        """
+        Removes the rows of some axons and adds new rows, without reading the other rows.
+        """
+        sorting = self.isSortingEnabled()
+        self.setSortingEnabled(False)
+        removed_rows = [self.row(self._row_items.pop(axon_id)) for axon_id in removed_ids
+                        if axon_id in self._row_items]
+        for row in sorted(removed_rows, reverse=True):
+            self.removeRow(row)
+        self.add_rows(added_rows, sorting)
+
+    def add_rows(self, stats_dataframe, sorting=True):
+        self.setSortingEnabled(False)
+        for axon_id, values in stats_dataframe.iterrows():
+            row = self.rowCount()
+            self.insertRow(row)
+            self.setVerticalHeaderItem(row, QTableWidgetItem(str(axon_id)))
+            for column, value in enumerate(values):
+                item = QTableWidgetItem()
+                item.setData(0, value.item() if isinstance(value, np.generic) else value)
+                self.setItem(row, column, item)
+                if column == 0:
+                    self._row_items[axon_id] = item
+        self.setSortingEnabled(sorting)
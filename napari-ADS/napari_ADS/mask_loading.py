@@ -0,0 +1,128 @@
+"""
+Loading of the masks of previous segmentations, in a background thread.
+
+The combined axonmyelin image is decoded into the axon and myelin masks (or into a class map) with lookup tables, one
+block of rows at a time, so the only full-size arrays are the outputs. TIFF and zarr
+files are read lazily (memory-mapped when possible).
+"""
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+from qtpy import QtCore
+from qtpy.QtCore import Signal
+
+from . import inference, profiling, saving, tiled
+
+# Same thresholds as the masks saved by AxonDeepSeg: axon above 200, myelin between 100 and 200
+AXON_LUT = (np.arange(256) > 200).astype(np.uint8)
+MYELIN_LUT = ((np.arange(256) > 100) & (np.arange(256) < 200)).astype(np.uint8)
+CLASS_LUT = AXON_LUT * np.uint8(inference.AXON_LABEL) + MYELIN_LUT * np.uint8(inference.MYELIN_LABEL)
+BLOCK_ROWS = 1024
+LOADING_WORKERS = 4
+
+
+def open_mask_image(path):
+    """
+    Opens an axonmyelin mask, lazily when the format allows it.
+    :return: An array-like object
+    """
+    path = Path(path)
+    if path.suffix.lower() in (".tif", ".tiff", ".npy", ".zarr") or path.is_dir():
+        return tiled.open_lazy_image(path)
+    from AxonDeepSeg import ads_utils
+    return ads_utils.imread(path)
+
+
+def decode_axonmyelin_image(image, lookup_tables=(AXON_LUT, MYELIN_LUT)):
+    """
+    Decodes an axonmyelin image into masks.
+    :param image: The axonmyelin image (any array-like object)
+    :param lookup_tables: One lookup table per output mask. By default, the axon and myelin masks are decoded. Use
+                          (CLASS_LUT,) to decode the class map (0: background, 1: myelin, 2: axon).
+    :return: The masks, as uint8 arrays
+    :rtype: tuple
+    """
+    shape = tuple(image.shape[:2])
+    outputs = tuple(np.empty(shape, dtype=np.uint8) for _ in lookup_tables)
+    for row in range(0, shape[0], BLOCK_ROWS):
+        block = np.asarray(image[row:row + BLOCK_ROWS])
+        if block.ndim == 3:
+            block = block[..., 0]
+        if block.dtype != np.uint8:
+            # Values above 255 are axon pixels, like in the thresholds
+            block = np.clip(block, 0, 255).astype(np.uint8)
+        for lookup_table, output in zip(lookup_tables, outputs):
+            np.take(lookup_table, block, out=output[row:row + BLOCK_ROWS])
+    return outputs
+
+
+def find_axonmyelin_mask(directory, image_name):
+    """
+    Looks for the axonmyelin mask of an image in a folder, in any of the formats used to save the segmentations.
+    :return: The path of the mask, or None if there is none
+    :rtype: Path
+    """
+    for save_format in saving.SAVE_FORMATS:
+        path = Path(directory) / saving.get_mask_file_names(image_name, save_format)[0]
+        if path.exists():
+            return path
+    return None
+
+
+class MaskLoadingJob:
+    """
+    An axonmyelin mask to load, and the image it is associated with.
+    """
+    def __init__(self, image_name, path, axonmyelin_layer=False):
+        """
+        :param axonmyelin_layer: If True, the mask is decoded into a class map instead of separate masks
+        """
+        self.image_name = image_name
+        self.path = Path(path)
+        self.axonmyelin_layer = axonmyelin_layer
+        self.axon_data = None
+        self.myelin_data = None
+        self.class_map = None
+        self.error = ""
+        # ProfileRun receiving the stages of the loading
+        self.profile_run = None
+
+    def load(self):
+        with profiling.stage("mask imread " + self.image_name, self.profile_run):
+            image = open_mask_image(self.path)
+        with profiling.stage("mask decoding " + self.image_name, self.profile_run):
+            if self.axonmyelin_layer:
+                self.class_map, = decode_axonmyelin_image(image, lookup_tables=(CLASS_LUT,))
+            else:
+                self.axon_data, self.myelin_data = decode_axonmyelin_image(image)
+        return self
+
+
+class MaskLoadingThread(QtCore.QThread):
+    """
+    Loads a list of MaskLoadingJobs, several at a time.
+    """
+    # Emits the index of the job that just finished (successfully or not)
+    mask_loaded_signal = Signal(int)
+    loading_finished_signal = Signal()
+
+    def __init__(self):
+        super().__init__()
+        # Must not be None before calling run()
+        self.jobs = None
+        # ProfileRun receiving the stages of the loading, finished by the widget
+        self.profile_run = None
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=min(LOADING_WORKERS, max(len(self.jobs), 1))) as workers:
+            futures = {workers.submit(job.load): index for index, job in enumerate(self.jobs)}
+            for future in as_completed(futures):
+                index = futures[future]
+                if future.exception() is not None:
+                    error = future.exception()
+                    traceback.print_exception(type(error), error, error.__traceback__)
+                    self.jobs[index].error = str(error)
+                self.mask_loaded_signal.emit(index)
+        self.loading_finished_signal.emit()
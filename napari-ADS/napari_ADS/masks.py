@@ -0,0 +1,81 @@
+"""
+Access to the axon and myelin masks of an image.
+
+The masks are either two binary Labels layers, or a single axonmyelin Labels layer with the values of the class maps
+of the inference (0: background, 1: myelin, 2: axon). The second one uses half of the memory, and the binary masks it
+contains are produced on demand by ClassMaskView, without being stored.
+"""
+import numpy as np
+
+from . import inference, pyramids
+
+AXONMYELIN_MASK_TYPE = "axonmyelin"
+MASK_LABELS = {"axon": inference.AXON_LABEL, "myelin": inference.MYELIN_LABEL}
+# Colors of the Labels layers
+MASK_COLORS = {"axon": "blue", "myelin": "red"}
+
+
+class ClassMaskView:
+    """
+    Read-only binary view of one class of a class map. Only the requested part of the mask is computed when the view
+    is sliced.
+    """
+    def __init__(self, class_map, label):
+        self.class_map = class_map
+        self.label = label
+        self.dtype = np.dtype(np.uint8)
+
+    @property
+    def shape(self):
+        return tuple(self.class_map.shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return (np.asarray(self.class_map[key]) == self.label).view(np.uint8)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+
+def is_axonmyelin_layer(layer):
+    return layer.metadata.get("mask_type") == AXONMYELIN_MASK_TYPE
+
+
+def get_mask_data(layer, kind):
+    """
+    :param layer: An axon or myelin Labels layer, or an axonmyelin Labels layer
+    :param kind: "axon" or "myelin"
+    :return: The binary mask of the given kind, as an array-like object
+    """
+    if is_axonmyelin_layer(layer):
+        return ClassMaskView(pyramids.get_base_data(layer), MASK_LABELS[kind])
+    return pyramids.get_base_data(layer)
+
+
+def get_mask_value(layer, kind):
+    """
+    :return: The value of the pixels of the given kind in the layer
+    :rtype: int
+    """
+    if is_axonmyelin_layer(layer):
+        return MASK_LABELS[kind]
+    return 1
+
+
+def split_views(class_map):
+    """
+    :return: The axon and myelin views of a class map
+    :rtype: tuple
+    """
+    return ClassMaskView(class_map, MASK_LABELS["axon"]), ClassMaskView(class_map, MASK_LABELS["myelin"])
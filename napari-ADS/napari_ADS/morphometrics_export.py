@@ -0,0 +1,128 @@
+"""
+Columnar export of the morphometrics, appended to one Parquet dataset across images.
+
+Each export adds the morphometrics of one image to the dataset as new Parquet files, so the tables of the previous
+images are never read or held in memory. The rows carry the image name, the pixel size, the model and the settings
+that change the results as hive partition columns (model=.../zoom_factor=.../axon_shape=.../pixel_size=.../
+image_name=...), so a filter on them only reads the matching files. Exporting an image again with the same model and
+settings replaces its rows.
+"""
+import functools
+import operator
+import threading
+import uuid
+from pathlib import Path
+
+import pandas as pd
+
+CSV_FORMAT = "CSV"
+PARQUET_FORMAT = "Parquet dataset"
+CSV_FILTER = "CSV file(*.csv)"
+PARQUET_FILTER = "Parquet dataset(*.parquet)"
+PARTITION_COLUMNS = ("model", "zoom_factor", "axon_shape", "pixel_size", "image_name")
+AXON_ID_COLUMN = "axon_id"
+UNKNOWN_MODEL = "unknown"
+
+# The batch workers can append to the same dataset at the same time. The lock only serializes the threads of one
+# process: separate processes (two pipelines, for example) must not export the same image to the same dataset at the
+# same time.
+_write_lock = threading.Lock()
+
+
+def get_export_format(selected_filter):
+    """
+    :param selected_filter: The filter selected in the save dialog of the morphometrics
+    :return: PARQUET_FORMAT or CSV_FORMAT
+    """
+    return PARQUET_FORMAT if selected_filter == PARQUET_FILTER else CSV_FORMAT
+
+
+def get_partition_values(image_name, pixel_size, model=None, zoom_factor=1.0, axon_shape="circle"):
+    """
+    :return: The value of each partition column for the morphometrics of an image
+    :rtype: dict
+    """
+    return {"model": model or UNKNOWN_MODEL, "zoom_factor": float(zoom_factor), "axon_shape": str(axon_shape),
+            "pixel_size": float(pixel_size), "image_name": str(image_name)}
+
+
+def get_partitioning():
+    """
+    :return: The hive partitioning of the datasets, with the types of get_partition_values
+    :rtype: pyarrow.dataset.Partitioning
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    types = {"model": pa.string(), "zoom_factor": pa.float64(), "axon_shape": pa.string(), "pixel_size": pa.float64(),
+             "image_name": pa.string()}
+    return ds.partitioning(pa.schema([(column, types[column]) for column in PARTITION_COLUMNS]), flavor="hive")
+
+
+def to_partitioned_dataframe(stats_dataframe, image_name, pixel_size, model=None, zoom_factor=1.0,
+                             axon_shape="circle"):
+    """
+    :return: The morphometrics of an image with the axon IDs and the partition columns
+    :rtype: pandas.DataFrame
+    """
+    partitioned_dataframe = pd.DataFrame(stats_dataframe).rename_axis(AXON_ID_COLUMN).reset_index()
+    # Parquet column names must be strings
+    partitioned_dataframe.columns = [str(column) for column in partitioned_dataframe.columns]
+    partition_values = get_partition_values(image_name, pixel_size, model, zoom_factor, axon_shape)
+    for column in PARTITION_COLUMNS:
+        partitioned_dataframe[column] = partition_values[column]
+    return partitioned_dataframe
+
+
+def append_to_dataset(stats_dataframe, dataset_path, image_name, pixel_size, model=None, zoom_factor=1.0,
+                      axon_shape="circle"):
+    """
+    Writes the morphometrics of an image to a Parquet dataset, replacing the rows previously exported for the same
+    image, model and settings.
+    :param dataset_path: Folder of the dataset, created if needed
+    :param model: Name of the model that segmented the image
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    partitioned_dataframe = to_partitioned_dataframe(stats_dataframe, image_name, pixel_size, model, zoom_factor,
+                                                     axon_shape)
+    partition_values = get_partition_values(image_name, pixel_size, model, zoom_factor, axon_shape)
+    partitioning = get_partitioning()
+    with _write_lock:
+        # The previous rows are removed first: an image without axons writes no file, so it wouldn't replace them
+        if Path(dataset_path).is_dir():
+            partition_filter = functools.reduce(operator.and_, [ds.field(column) == partition_values[column]
+                                                                for column in PARTITION_COLUMNS])
+            previous_dataset = ds.dataset(str(dataset_path), format="parquet", partitioning=partitioning)
+            for fragment in previous_dataset.get_fragments(filter=partition_filter):
+                Path(fragment.path).unlink()
+        if len(partitioned_dataframe) == 0:
+            return
+        table = pa.Table.from_pandas(partitioned_dataframe, preserve_index=False)
+        ds.write_dataset(table, str(dataset_path), format="parquet", partitioning=partitioning,
+                         basename_template=uuid.uuid4().hex + "-{i}.parquet",
+                         existing_data_behavior="overwrite_or_ignore")
+
+
+def open_dataset(dataset_path):
+    """
+    Opens a dataset written by append_to_dataset, without reading it. Use to_table(filter=...) to read the rows of
+    some images, or to_batches() to read it by parts.
+    :rtype: pyarrow.dataset.Dataset
+    """
+    import pyarrow.dataset as ds
+
+    return ds.dataset(str(dataset_path), format="parquet", partitioning="hive")
+
+
+def save_morphometrics(stats_dataframe, path, export_format=CSV_FORMAT, **partition_values):
+    """
+    Saves the morphometrics of an image to a CSV file, or appends them to a Parquet dataset.
+    :param partition_values: The image_name, pixel_size, model, zoom_factor and axon_shape of the rows of the dataset
+    """
+    if export_format == PARQUET_FORMAT:
+        append_to_dataset(stats_dataframe, Path(path), **partition_values)
+    else:
+        import AxonDeepSeg.morphometrics.compute_morphometrics as compute_morphs
+        compute_morphs.save_axon_morphometrics(str(path), stats_dataframe)
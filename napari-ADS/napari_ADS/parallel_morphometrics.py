@@ -0,0 +1,150 @@
+"""
+Morphometrics of large images, computed tile by tile in a process pool.
+
+The image is split in square tiles, and each axon belongs to the tile containing its seed (its first pixel in raster
+order), so the axons crossing the border of a tile are measured exactly once. A tile is measured on a window grown to
+contain every fiber (connected component of axon + myelin) touching it, like the updates of the live morphometrics.
+The masks are copied once to shared memory, where the worker processes read them without pickling. The workers are
+spawned, so they import this module again: it doesn't import napari or Qt (the thread of the plugin is in _threads.py).
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from . import regions
+from .fibers import SEED_COLUMNS, measure_fibers
+
+TILE_SIZE = 2048
+# Number of rows copied at once to the shared memory
+COPY_BLOCK_ROWS = 1024
+# Each worker imports AxonDeepSeg and holds the windows of its tiles, so the default doesn't grow with the machine
+MAX_DEFAULT_N_WORKERS = 4
+DEFAULT_N_WORKERS = min(os.cpu_count() or 1, MAX_DEFAULT_N_WORKERS)
+
+# Masks of the worker process, attached to the shared memory by init_worker
+_worker_masks = None
+
+
+def get_tile_boxes(shape, tile_size=TILE_SIZE):
+    """
+    :return: The boxes of the tiles covering an image
+    :rtype: list of tuple
+    """
+    return [(slice(row, min(row + tile_size, shape[0])), slice(column, min(column + tile_size, shape[1])))
+            for row in range(0, shape[0], tile_size) for column in range(0, shape[1], tile_size)]
+
+
+def measure_tile(axon, myelin, tile_box, pixel_size, axon_shape="circle"):
+    """
+    Computes the morphometrics of the axons having their seed in a tile.
+    :param axon: The axon mask of the whole image
+    :param myelin: The myelin mask of the whole image
+    :param tile_box: The box of the tile
+    :return: The morphometrics, with the seed columns
+    :rtype: pandas.DataFrame
+    """
+    if not np.any(axon[tile_box]):
+        return None
+    _, window, fiber_labels, touching_labels = regions.grow_box_to_components([axon, myelin], tile_box)
+    fibers_to_measure = np.isin(fiber_labels, touching_labels)
+    stats_dataframe = measure_fibers(np.asarray(axon[window], dtype=bool) & fibers_to_measure,
+                                     np.asarray(myelin[window], dtype=bool) & fibers_to_measure,
+                                     pixel_size, axon_shape, offset=(window[0].start, window[1].start))
+    # The axons of the fibers crossing the border of the tile are also measured by the neighbouring tiles
+    seeds_y = stats_dataframe[SEED_COLUMNS[0]]
+    seeds_x = stats_dataframe[SEED_COLUMNS[1]]
+    in_tile = ((seeds_y >= tile_box[0].start) & (seeds_y < tile_box[0].stop) &
+               (seeds_x >= tile_box[1].start) & (seeds_x < tile_box[1].stop))
+    return stats_dataframe[in_tile]
+
+
+def init_worker(shared_names, shape):
+    global _worker_masks
+    shared_memories = [shared_memory.SharedMemory(name=name) for name in shared_names]
+    arrays = [np.ndarray(shape, dtype=bool, buffer=shared.buf) for shared in shared_memories]
+    # The shared memories are kept with the arrays, so they stay attached
+    _worker_masks = (arrays, shared_memories)
+
+
+def measure_shared_tile(tile_box, pixel_size, axon_shape):
+    (axon, myelin), _ = _worker_masks
+    return measure_tile(axon, myelin, tile_box, pixel_size, axon_shape)
+
+
+def copy_to_shared_memory(mask):
+    """
+    Copies a mask to a new shared memory block, as booleans. The caller must close and unlink the block.
+    :param mask: The mask (any array-like object)
+    :return: The shared memory block and the array using it
+    :rtype: tuple
+    """
+    shape = tuple(mask.shape)
+    shared = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape))))
+    array = np.ndarray(shape, dtype=bool, buffer=shared.buf)
+    for row in range(0, shape[0], COPY_BLOCK_ROWS):
+        array[row:row + COPY_BLOCK_ROWS] = np.asarray(mask[row:row + COPY_BLOCK_ROWS], dtype=bool)
+    return shared, array
+
+
+def merge_tile_results(tile_results, keep_seeds=False):
+    """
+    Merges the morphometrics of the tiles in the order of the axons in the whole image (raster order of their seeds),
+    which is the order of AxonDeepSeg's morphometrics.
+    :param keep_seeds: If True, the seed columns are kept (see LiveMorphometrics)
+    :rtype: pandas.DataFrame
+    """
+    tile_results = [result for result in tile_results if result is not None and len(result) > 0]
+    if len(tile_results) == 0:
+        return pd.DataFrame()
+    stats_dataframe = pd.concat(tile_results).sort_values(SEED_COLUMNS, kind="stable")
+    if not keep_seeds:
+        stats_dataframe = stats_dataframe.drop(columns=SEED_COLUMNS)
+    stats_dataframe.index = pd.RangeIndex(len(stats_dataframe))
+    return stats_dataframe
+
+
+def compute_morphometrics(axon, myelin, pixel_size, axon_shape="circle", n_workers=DEFAULT_N_WORKERS,
+                          tile_size=TILE_SIZE, progress_callback=None, keep_seeds=False):
+    """
+    Computes the morphometrics of every axon of an image, tile by tile.
+    :param axon: The axon mask (any array-like object)
+    :param myelin: The myelin mask
+    :param pixel_size: The pixel size of the image, in micrometers
+    :param n_workers: Number of processes measuring tiles. The tiles are measured in this process if it is 1.
+    :param progress_callback: Called with (number of tiles done, total number of tiles) after each tile
+    :param keep_seeds: If True, the seed columns are kept, so the rows can be updated by the live morphometrics
+    :return: The morphometrics of the axons, with the columns and the order of AxonDeepSeg's morphometrics
+    :rtype: pandas.DataFrame
+    """
+    tile_boxes = get_tile_boxes(axon.shape, tile_size)
+    tile_results = []
+    if n_workers <= 1 or len(tile_boxes) == 1:
+        for tile_box in tile_boxes:
+            tile_results.append(measure_tile(axon, myelin, tile_box, pixel_size, axon_shape))
+            if progress_callback is not None:
+                progress_callback(len(tile_results), len(tile_boxes))
+        return merge_tile_results(tile_results, keep_seeds)
+
+    shared_memories = []
+    try:
+        for mask in (axon, myelin):
+            shared_memories.append(copy_to_shared_memory(mask)[0])
+        # Forking a process running Qt threads isn't safe, so the workers are always spawned
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(tile_boxes)),
+                                 mp_context=multiprocessing.get_context("spawn"), initializer=init_worker,
+                                 initargs=([shared.name for shared in shared_memories], tuple(axon.shape))) as workers:
+            futures = [workers.submit(measure_shared_tile, tile_box, pixel_size, axon_shape)
+                       for tile_box in tile_boxes]
+            for future in as_completed(futures):
+                tile_results.append(future.result())
+                if progress_callback is not None:
+                    progress_callback(len(tile_results), len(tile_boxes))
+    finally:
+        for shared in shared_memories:
+            shared.close()
+            shared.unlink()
+    return merge_tile_results(tile_results, keep_seeds)
@@ -0,0 +1,205 @@
+"""
+Headless segmentation pipeline: segment, fill the axons, save the masks and compute the morphometrics of a list of
+images, without napari.
+
+The images are processed by the same BatchJobs as the batch segmentation of the plugin, several at a time. The status
+of each image is appended to a progress file in the output folder, so a pipeline run again with the same output folder
+skips the images that are already done. Errors are reported with exit codes instead of message boxes.
+
+Usage: python -m napari_ADS.pipeline IMAGE_OR_FOLDER [...] --model MODEL [--config CONFIG.json] [--output-dir DIR]
+"""
+import argparse
+import json
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from . import backends, batch, inference, resolution
+
+PROGRESS_FILE_NAME = "ads_pipeline_progress.jsonl"
+# Exit codes of the command line
+EXIT_SUCCESS = 0
+EXIT_IMAGES_FAILED = 1
+EXIT_INVALID_ARGUMENTS = 2
+
+
+class PipelineError(Exception):
+    """
+    Raised when the pipeline can't start, for example if the model or the images are not found.
+    """
+
+
+def get_model_path(model):
+    """
+    :param model: Path to a model folder, or name of a model installed with AxonDeepSeg
+    :rtype: Path
+    """
+    model_path = Path(model)
+    if not model_path.is_dir():
+        model_path = inference.get_ads_path() / "models" / model
+    if not model_path.is_dir():
+        raise PipelineError("Model not found: " + str(model))
+    return model_path
+
+
+def get_image_paths(paths):
+    """
+    :param paths: Image files and folders of images
+    :return: The images to segment, without the masks of previous segmentations
+    :rtype: list of Path
+    """
+    image_paths = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            image_paths.extend(batch.get_images_in_folder(path))
+        elif path.is_file():
+            image_paths.append(path)
+        else:
+            raise PipelineError("Image not found: " + str(path))
+    return image_paths
+
+
+def read_progress(progress_path):
+    """
+    :return: The last status of each image of a progress file, by image path
+    :rtype: dict
+    """
+    statuses = {}
+    if not progress_path.exists():
+        return statuses
+    with open(progress_path, "r") as progress_file:
+        for line in progress_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Line cut by an interrupted run
+                continue
+            statuses[entry["path"]] = entry["status"]
+    return statuses
+
+
+def run_pipeline(image_paths, model, settings=None, output_directory=None, pixel_size=None, restart=False,
+                 on_job_finished=None):
+    """
+    Runs the pipeline on a list of images.
+    :param image_paths: Image files and folders of images
+    :param model: Path to a model folder, or name of a model installed with AxonDeepSeg
+    :param settings: The BatchSettings of the pipeline. By default, the axons are filled, and the masks and the
+                     morphometrics are saved.
+    :param output_directory: Folder receiving the results. Each image folder is used if None.
+    :param pixel_size: Pixel size of every image, in micrometers. If None, it is read from the metadata of each
+                       image, or from the pixel_size_in_micrometer.txt file of its folder.
+    :param restart: If True, the images already done in a previous run are segmented again
+    :param on_job_finished: Called with each BatchJob once it is done or failed
+    :return: The jobs of the images, including the ones skipped because they were already done
+    :rtype: list of batch.BatchJob
+    """
+    if settings is None:
+        settings = batch.BatchSettings(fill_axons=True, compute_morphometrics=True)
+    model_path = get_model_path(model)
+    image_paths = get_image_paths(image_paths)
+    if len(image_paths) == 0:
+        raise PipelineError("No image to segment")
+    if output_directory is not None:
+        output_directory = Path(output_directory)
+        output_directory.mkdir(parents=True, exist_ok=True)
+    progress_path = (output_directory or image_paths[0].parent) / PROGRESS_FILE_NAME
+    statuses = {} if restart else read_progress(progress_path)
+
+    jobs = []
+    resolver = resolution.PixelSizeResolver()
+    for image_path in image_paths:
+        image_pixel_size = pixel_size if pixel_size is not None else resolver.get_pixel_size(image_path)
+        job = batch.BatchJob(image_path.stem, image_pixel_size, path=image_path)
+        if statuses.get(str(image_path.resolve())) == "done":
+            job.status = "skipped"
+        elif image_pixel_size is None:
+            job.status = "failed"
+            job.error = ("No pixel size given, found in the image metadata or in a " +
+                         resolution.PIXEL_SIZE_FILE_NAME + " file")
+        jobs.append(job)
+
+    session, settings.backend, backend_message = backends.load_session(model_path, gpu_id=settings.gpu_id,
+                                                                       backend=settings.backend)
+    if backend_message:
+        print("Warning: " + backend_message, file=sys.stderr)
+    progress_lock = threading.Lock()
+
+    def run_job(job):
+        try:
+            job.load()
+            job.run(session, settings, output_directory)
+        except Exception as error:
+            traceback.print_exc()
+            job.status = "failed"
+            job.error = str(error)
+        finally:
+            job.image = None
+            job.class_map = None
+        with progress_lock, open(progress_path, "a") as progress_file:
+            progress_file.write(json.dumps({"path": str(job.path.resolve()), "status": job.status,
+                                            "timings": job.timings, "error": job.error}) + "\n")
+        return job
+
+    pending_jobs = [job for job in jobs if job.status == "pending"]
+    inference.share_cpu_threads(settings.n_batch_workers * settings.n_cpu_workers)
+    with ThreadPoolExecutor(max_workers=max(1, settings.n_batch_workers)) as workers:
+        for future in as_completed([workers.submit(run_job, job) for job in pending_jobs]):
+            job = future.result()
+            print(job.name + ": " + job.status + " (" + str(round(job.get_total_time(), 2)) + " s)")
+            if on_job_finished is not None:
+                on_job_finished(job)
+
+    print(batch.get_summary_string(jobs))
+    batch.write_summary(jobs, progress_path.parent / batch.SUMMARY_FILE_NAME)
+    return jobs
+
+
+def get_argument_parser():
+    parser = argparse.ArgumentParser(prog="python -m napari_ADS.pipeline",
+                                     description="Segments images with an AxonDeepSeg model, without napari.")
+    parser.add_argument("images", nargs="+", help="Image files or folders of images")
+    parser.add_argument("-m", "--model", required=True, help="Path to a model folder, or name of an installed model")
+    parser.add_argument("-c", "--config", help="JSON file of settings, with the names of the plugin settings")
+    parser.add_argument("-o", "--output-dir", help="Folder receiving the results (each image folder by default)")
+    parser.add_argument("-s", "--pixel-size", type=float,
+                        help="Pixel size in micrometers (read from the image metadata or from " +
+                             resolution.PIXEL_SIZE_FILE_NAME + " by default)")
+    parser.add_argument("-w", "--workers", type=int, help="Number of images processed at the same time")
+    parser.add_argument("--morphometrics-dataset",
+                        help="Parquet dataset receiving the morphometrics of every image, instead of CSV files")
+    parser.add_argument("--restart", action="store_true", help="Segment again the images done in a previous run")
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the command line.
+    :return: The exit code: EXIT_SUCCESS, EXIT_IMAGES_FAILED if an image failed, or EXIT_INVALID_ARGUMENTS
+    :rtype: int
+    """
+    arguments = get_argument_parser().parse_args(argv)
+    try:
+        config = {"fill_axons": True, "compute_morphometrics": True}
+        if arguments.config is not None:
+            with open(arguments.config, "r") as config_file:
+                config.update(json.load(config_file))
+        if arguments.workers is not None:
+            config["n_batch_workers"] = arguments.workers
+        if arguments.morphometrics_dataset is not None:
+            config["morphometrics_dataset"] = arguments.morphometrics_dataset
+        settings = batch.BatchSettings(**config)
+        jobs = run_pipeline(arguments.images, arguments.model, settings, output_directory=arguments.output_dir,
+                            pixel_size=arguments.pixel_size, restart=arguments.restart)
+    except (PipelineError, ValueError, OSError) as error:
+        print("Error: " + str(error), file=sys.stderr)
+        return EXIT_INVALID_ARGUMENTS
+    if any(job.status == "failed" for job in jobs):
+        return EXIT_IMAGES_FAILED
+    return EXIT_SUCCESS
+
+
+if __name__ == "__main__":
+    sys.exit(main())
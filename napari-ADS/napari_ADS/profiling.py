@@ -0,0 +1,278 @@
+"""
+Profiling of the plugin operations.
+
+Each operation (applying a model, filling the axons, ...) is recorded as a ProfileRun made of stages. A stage records
+its duration, the bytes read and written by the process and the peak resident memory while it runs. Stages can be
+nested, and the functions called during a stage add their own stages to the same run without receiving it, as the run
+of the current stage is kept per thread. A run also keeps notes, the measures that aren't durations (the parallel
+occupancy of the patch workers, the statistics of the caches). The runs are shown in the Performance panel (see
+_performance_panel.py), and can be exported to JSON or to the Chrome trace format (chrome://tracing or
+https://ui.perfetto.dev).
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Time between two measures of the resident memory while a stage runs, in seconds
+RSS_SAMPLING_INTERVAL = 0.01
+# Number of runs kept by the Profiler
+MAX_RUNS = 50
+JSON_FILTER = "JSON file(*.json)"
+CHROME_TRACE_FILTER = "Chrome trace(*.json)"
+
+# Run and depth of the stage running in each thread
+_current = threading.local()
+
+
+def get_rss_bytes():
+    """
+    :return: The resident memory of the process, in bytes, or None if it can't be read
+    :rtype: int
+    """
+    try:
+        with open("/proc/self/statm", "r") as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss
+
+
+def get_io_bytes():
+    """
+    :return: The bytes read and written by the process so far, or (None, None) if they can't be read
+    :rtype: tuple
+    """
+    try:
+        with open("/proc/self/io", "r") as io_file:
+            counters = dict(line.split(":", 1) for line in io_file.read().splitlines() if ":" in line)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import psutil
+        counters = psutil.Process().io_counters()
+    except (ImportError, AttributeError):
+        # psutil can't count the I/O on macOS
+        return None, None
+    return counters.read_bytes, counters.write_bytes
+
+
+def get_difference(end, start):
+    return None if end is None or start is None else end - start
+
+
+class Stage:
+    """
+    A measured part of a run.
+    """
+    def __init__(self, name, start, depth, thread_id):
+        """
+        :param start: Start of the stage, in seconds since the start of the run
+        :param depth: Number of stages containing this one
+        """
+        self.name = name
+        self.start = start
+        self.depth = depth
+        self.thread_id = thread_id
+        self.duration = 0.0
+        self.bytes_read = None
+        self.bytes_written = None
+        self.peak_rss = None
+
+    def update_peak_rss(self, rss):
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+
+    def to_dict(self):
+        return {"name": self.name, "start_s": self.start, "duration_s": self.duration, "depth": self.depth,
+                "thread_id": self.thread_id, "bytes_read": self.bytes_read, "bytes_written": self.bytes_written,
+                "peak_rss_bytes": self.peak_rss}
+
+
+class RssMonitor:
+    """
+    Measures the resident memory in the background while stages run, and keeps the peak of each stage.
+    """
+    def __init__(self):
+        self._stages = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, stage):
+        with self._lock:
+            self._stages.add(stage)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="ADS RSS monitor", daemon=True)
+                self._thread.start()
+
+    def remove(self, stage):
+        with self._lock:
+            self._stages.discard(stage)
+
+    def _run(self):
+        while True:
+            rss = get_rss_bytes()
+            with self._lock:
+                if len(self._stages) == 0 or rss is None:
+                    self._thread = None
+                    return
+                for stage in self._stages:
+                    stage.update_peak_rss(rss)
+            time.sleep(RSS_SAMPLING_INTERVAL)
+
+
+_rss_monitor = RssMonitor()
+
+
+class ProfileRun:
+    """
+    The stages of an operation of the plugin. The stages can run in several threads.
+    """
+    def __init__(self, name, image_name=None, on_finished=None):
+        """
+        :param name: Name of the operation
+        :param image_name: Name of the image the operation runs on
+        :param on_finished: Called with the run when finish() is called
+        """
+        self.name = name
+        self.image_name = image_name
+        self.start_time = time.time()
+        self.duration = None
+        self.stages = []
+        # Measures of the run that aren't durations (parallel occupancy, cache statistics, ...), by name
+        self.notes = {}
+        self._start = time.perf_counter()
+        self._on_finished = on_finished
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measures the code run in the with block as a stage of the run.
+        """
+        previous_run = getattr(_current, "run", None)
+        previous_depth = getattr(_current, "depth", 0)
+        depth = previous_depth if previous_run is self else 0
+        stage = Stage(name, time.perf_counter() - self._start, depth, threading.get_ident())
+        bytes_read, bytes_written = get_io_bytes()
+        stage.update_peak_rss(get_rss_bytes())
+        _rss_monitor.add(stage)
+        _current.run, _current.depth = self, depth + 1
+        try:
+            yield stage
+        finally:
+            _current.run, _current.depth = previous_run, previous_depth
+            _rss_monitor.remove(stage)
+            stage.update_peak_rss(get_rss_bytes())
+            stage.duration = time.perf_counter() - self._start - stage.start
+            end_bytes_read, end_bytes_written = get_io_bytes()
+            stage.bytes_read = get_difference(end_bytes_read, bytes_read)
+            stage.bytes_written = get_difference(end_bytes_written, bytes_written)
+            with self._lock:
+                self.stages.append(stage)
+
+    def add_stage(self, name, duration):
+        """
+        Adds a stage ending now, measured by the caller. Used for the work spread over many small calls, for example
+        the stitching of the patches.
+        """
+        depth = getattr(_current, "depth", 0) if getattr(_current, "run", None) is self else 0
+        stage = Stage(name, max(0.0, time.perf_counter() - self._start - duration), depth, threading.get_ident())
+        stage.duration = duration
+        with self._lock:
+            self.stages.append(stage)
+
+    def add_note(self, name, text):
+        with self._lock:
+            self.notes[name] = text
+
+    def finish(self):
+        """
+        Ends the run. Only the first call has an effect.
+        """
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._start
+        if self._on_finished is not None:
+            self._on_finished(self)
+
+    def get_sorted_stages(self):
+        with self._lock:
+            return sorted(self.stages, key=lambda stage: (stage.start, stage.depth))
+
+    def get_title(self):
+        title = time.strftime("%H:%M:%S", time.localtime(self.start_time)) + " " + self.name
+        if self.image_name is not None:
+            title += " (" + self.image_name + ")"
+        if self.duration is not None:
+            title += " - " + str(round(self.duration, 2)) + " s"
+        return title
+
+    def to_dict(self):
+        return {"name": self.name, "image_name": self.image_name, "start_time": self.start_time,
+                "duration_s": self.duration, "notes": dict(self.notes),
+                "stages": [stage.to_dict() for stage in self.get_sorted_stages()]}
+
+    def to_trace_events(self):
+        """
+        :return: The run and its stages as complete events of the Chrome trace format, in microseconds
+        :rtype: list of dict
+        """
+        process_id = os.getpid()
+        start = self.start_time * 1e6
+        events = [{"name": self.name, "cat": "run", "ph": "X", "ts": start, "dur": (self.duration or 0.0) * 1e6,
+                   "pid": process_id, "tid": 0, "args": dict(self.notes, image_name=self.image_name)}]
+        for stage in self.get_sorted_stages():
+            args = {key: value for key, value in stage.to_dict().items()
+                    if key in ("bytes_read", "bytes_written", "peak_rss_bytes") and value is not None}
+            events.append({"name": stage.name, "cat": self.name, "ph": "X", "ts": start + stage.start * 1e6,
+                           "dur": stage.duration * 1e6, "pid": process_id, "tid": stage.thread_id, "args": args})
+        return events
+
+
+def stage(name, run=None):
+    """
+    Measures the code run in the with block as a stage of a run. Does nothing when no run is given and no stage of a
+    run is running in the current thread, so the instrumented functions can also be used without profiling.
+    :param run: The ProfileRun receiving the stage. By default, the run of the current stage of the thread.
+    """
+    run = run if run is not None else getattr(_current, "run", None)
+    if run is None:
+        return nullcontext()
+    return run.stage(name)
+
+
+def add_stage(name, duration, run=None):
+    """
+    Adds a stage measured by the caller to a run (see ProfileRun.add_stage). Does nothing if there is no run.
+    """
+    run = run if run is not None else getattr(_current, "run", None)
+    if run is not None:
+        run.add_stage(name, duration)
+
+
+def add_note(name, text, run=None):
+    """
+    Adds a measure that isn't a duration to a run, shown with its stages. Does nothing if there is no run.
+    :param run: The ProfileRun receiving the note. By default, the run of the current stage of the thread.
+    """
+    run = run if run is not None else getattr(_current, "run", None)
+    if run is not None:
+        run.add_note(name, text)
+
+
+def write_json(runs, path):
+    with open(path, "w") as json_file:
+        json.dump({"runs": [run.to_dict() for run in runs]}, json_file, indent=4)
+
+
+def write_chrome_trace(runs, path):
+    events = [event for run in runs for event in run.to_trace_events()]
+    with open(path, "w") as trace_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
@@ -0,0 +1,101 @@
+"""
+Progressive segmentation, starting with the part of the image shown in the viewer.
+
+The patches are predicted one at a time (or a few at a time with CPU workers), always taking next the patch closest to
+the priority box: the patches intersecting it first, then the others by distance. The priority box can be changed
+while the segmentation runs, for example when the user pans or zooms. The remaining patches are kept in a heap ordered
+by their distance to the priority box, built again when the box changes.
+"""
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from . import inference, tiled
+
+
+def get_box_distance(box, other_box):
+    """
+    :return: The distance between two boxes, in pixels (0 if they intersect)
+    :rtype: float
+    """
+    gaps = [max(other.start - axis_slice.stop, axis_slice.start - other.stop, 0)
+            for axis_slice, other in zip(box, other_box)]
+    return float(np.hypot(*gaps))
+
+
+class ProgressiveSegmentation:
+    """
+    Segments an image patch by patch, in the order given by the priority box.
+    """
+    def __init__(self, session, image, pixel_size, zoom_factor=1.0, overlap_value=(48, 48), rgb=False):
+        self.tiling = tiled.Tiling(session, image, pixel_size, zoom_factor, overlap_value, rgb)
+        self.destinations = [self.tiling.get_destination(patch)[0] for patch in self.tiling.patches]
+        self.remaining = set(range(len(self.tiling.patches)))
+        self._priority_box = None
+        # (distance to the priority box, index) of the remaining patches, or None until it is built
+        self._heap = None
+        self._lock = threading.Lock()
+
+    def set_priority_box(self, box):
+        """
+        :param box: Box of the image to segment first, or None to go through the patches in order
+        """
+        with self._lock:
+            self._priority_box = box
+            self._heap = None
+
+    def pop_next_patch(self):
+        """
+        :return: The index of the remaining patch closest to the priority box
+        :rtype: int
+        """
+        with self._lock:
+            if self._heap is None:
+                self._heap = [(self.get_priority(index), index) for index in self.remaining]
+                heapq.heapify(self._heap)
+            _, index = heapq.heappop(self._heap)
+            self.remaining.remove(index)
+            return index
+
+    def get_priority(self, index):
+        if self._priority_box is None:
+            return 0.0
+        return get_box_distance(self.destinations[index], self._priority_box)
+
+    def predict(self, index):
+        """
+        :return: The box of the image predicted by a patch, and its class map
+        :rtype: tuple
+        """
+        patch = self.tiling.patches[index]
+        probabilities = self.tiling.session.predict(self.tiling.read_patch(patch))
+        class_map = inference.probabilities_to_class_map(probabilities, self.tiling.session.axon_channel,
+                                                         self.tiling.session.myelin_channel)
+        return self.tiling.to_image_class_map(patch, class_map)
+
+    def run(self, on_patch, n_workers=1, is_cancelled=None):
+        """
+        Predicts every patch.
+        :param on_patch: Called with (box, class map of the box) after each patch
+        :param n_workers: Number of patches predicted at the same time on the CPU
+        :param is_cancelled: Function returning True to stop before the next patch
+        """
+        if n_workers <= 1 or self.tiling.session.device.type != "cpu":
+            while self.remaining and not (is_cancelled is not None and is_cancelled()):
+                on_patch(*self.predict(self.pop_next_patch()))
+            return
+
+        # A patch is only taken when a worker is free, so the later ones follow the priority box
+        with ThreadPoolExecutor(max_workers=n_workers) as workers:
+            running = set()
+            while self.remaining or running:
+                while (self.remaining and len(running) < n_workers
+                       and not (is_cancelled is not None and is_cancelled())):
+                    running.add(workers.submit(self.predict, self.pop_next_patch()))
+                if not running:
+                    break
+                done_futures, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done_futures:
+                    on_patch(*future.result())
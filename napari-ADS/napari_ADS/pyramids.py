@@ -0,0 +1,337 @@
+"""
+Multiscale pyramids of large images and masks, so napari only draws the resolution needed for the current zoom.
+
+The array of the layer is the base level of its pyramid, and each coarser level halves the size of the previous one.
+The coarse levels can be shown right away: until a level is built, its pixels are read from the base with a stride.
+They are built in the background by PyramidThread (see _threads.py). The mask levels keep one pixel of each 2x2 block
+(the labels can't be averaged), so an edit of the base is copied to the coarse levels by reading the edited box again,
+without rebuilding them. The image levels are averaged. The levels of an image can be stored on disk, under the
+identity of its file, so they are read back when the same file is opened again.
+"""
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from . import regions
+
+DEFAULT_CACHE_DIRECTORY = Path.home() / ".cache" / "napari-ADS" / "pyramids"
+DEFAULT_MAX_SIZE_MB = 2048
+LEVEL_EXTENSION = ".npy"
+# Layers whose largest side is smaller are shown at a single resolution
+MIN_PYRAMID_SIZE = 4096
+# The coarsest level is the first one whose largest side is at most this size
+MIN_LEVEL_SIZE = 512
+# Number of rows of a level built at once
+BUILD_BLOCK_ROWS = 512
+
+
+def get_base_data(layer):
+    """
+    :return: The full resolution data of a layer, multiscale or not
+    """
+    return layer.data[0] if layer.multiscale else layer.data
+
+
+def get_pyramid(layer):
+    """
+    :return: The Pyramid shown by a layer, or None if the layer doesn't show one
+    :rtype: Pyramid
+    """
+    if not layer.multiscale or len(layer.data) < 2 or not isinstance(layer.data[1], PyramidLevel):
+        return None
+    return layer.data[1].pyramid
+
+
+def update_layer(layer, box):
+    """
+    Copies an edit of the base of a layer to the coarse levels of its pyramid, if it shows one.
+    :param box: Bounding box of the edit, in the coordinates of the base
+    """
+    pyramid = get_pyramid(layer)
+    if pyramid is not None:
+        pyramid.update(box)
+
+
+def needs_pyramid(shape, rgb=False, min_pyramid_size=MIN_PYRAMID_SIZE):
+    image_shape = shape[:-1] if rgb else shape
+    return len(image_shape) == 2 and max(image_shape) >= min_pyramid_size
+
+
+def get_level_shapes(shape, rgb=False, min_level_size=MIN_LEVEL_SIZE):
+    """
+    :return: The shape of each coarse level of the pyramid of an array (the base isn't included)
+    :rtype: list of tuple
+    """
+    channels = tuple(shape[2:]) if rgb else ()
+    level_shape = tuple(shape[:2])
+    level_shapes = []
+    while max(level_shape) > min_level_size:
+        level_shape = tuple((length + 1) // 2 for length in level_shape)
+        level_shapes.append(level_shape + channels)
+    return level_shapes
+
+
+def downsample_block(block, labels=False):
+    """
+    Halves the size of a block of a level, along its first two axes.
+    :param block: Rows of the previous level. Their first row must be even.
+    :param labels: If True, one pixel of each 2x2 block is kept. The pixels are averaged otherwise.
+    """
+    block = np.asarray(block)
+    if labels:
+        return block[::2, ::2]
+    # The last row and column are repeated when the size is odd, like the borders of the image
+    padding = [(0, block.shape[0] % 2), (0, block.shape[1] % 2)] + [(0, 0)] * (block.ndim - 2)
+    padded = np.pad(block, padding, mode="edge")
+    mean = padded.reshape((padded.shape[0] // 2, 2, padded.shape[1] // 2, 2) + padded.shape[2:]).mean(axis=(1, 3))
+    if np.issubdtype(block.dtype, np.integer):
+        mean = np.rint(mean)
+    return mean.astype(block.dtype)
+
+
+def get_file_identity(path):
+    """
+    :return: A string identifying a file and its version
+    :rtype: str
+    """
+    path = Path(path)
+    file_stat = path.stat()
+    return str(path.resolve()) + ":" + str(file_stat.st_size) + ":" + str(file_stat.st_mtime_ns)
+
+
+def get_cache_key(path, labels=False, rgb=False, min_level_size=MIN_LEVEL_SIZE):
+    """
+    :param path: Path of the file read by the layer
+    :return: The key of the pyramid of the file
+    :rtype: str
+    """
+    parameters = [get_file_identity(path), labels, rgb, min_level_size]
+    return hashlib.blake2b(repr(parameters).encode(), digest_size=20).hexdigest()
+
+
+class PyramidLevel:
+    """
+    Array-like coarse level of a pyramid. Until it is built, its pixels are read from the base with a stride.
+    """
+    def __init__(self, pyramid, level, shape):
+        self.pyramid = pyramid
+        self.level = level
+        # Size of a pixel of the level, in pixels of the base
+        self.factor = 2 ** level
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(pyramid.base.dtype)
+        # Set when the level is built
+        self.array = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        array = self.array
+        if array is not None:
+            return array[key]
+        base_key = self.to_base_key(key)
+        if base_key is None:
+            # Index arrays can't be read with a stride
+            return np.asarray(self.pyramid.base[::self.factor, ::self.factor])[key]
+        return np.asarray(self.pyramid.base[base_key])
+
+    def __array__(self, dtype=None, copy=None):
+        array = np.asarray(self[...])
+        return array if dtype is None else array.astype(dtype, copy=False)
+
+    def to_base_key(self, key):
+        """
+        :return: The key reading the pixels of the level in the base, or None if the key doesn't only contain slices
+                 and integers
+        :rtype: tuple
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(axis_key is Ellipsis for axis_key in key):
+            ellipsis_index = key.index(Ellipsis)
+            n_missing = self.ndim - (len(key) - 1)
+            key = key[:ellipsis_index] + (slice(None),) * n_missing + key[ellipsis_index + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        base_key = []
+        for axis, axis_key in enumerate(key):
+            if axis >= 2:
+                base_key.append(axis_key)
+            elif isinstance(axis_key, slice):
+                start, stop, step = axis_key.indices(self.shape[axis])
+                if step < 0:
+                    return None
+                base_key.append(slice(start * self.factor, min(stop * self.factor, self.pyramid.base.shape[axis]),
+                                      step * self.factor))
+            elif isinstance(axis_key, (int, np.integer)):
+                base_key.append(int(range(self.shape[axis])[axis_key]) * self.factor)
+            else:
+                return None
+        return tuple(base_key)
+
+
+class Pyramid:
+    """
+    The levels of an image or a mask, from the full resolution to the coarsest one.
+    """
+    def __init__(self, base, labels=False, rgb=False, min_level_size=MIN_LEVEL_SIZE):
+        """
+        :param base: The full resolution data (numpy, zarr or memory-mapped array)
+        :param labels: Whether the data is a mask (or a class map), whose values can't be averaged
+        :param rgb: Whether the last axis of the data contains color channels
+        """
+        self.base = base
+        self.labels = labels
+        self.rgb = rgb
+        self.levels = [PyramidLevel(self, level + 1, shape)
+                       for level, shape in enumerate(get_level_shapes(tuple(base.shape), rgb, min_level_size))]
+        # Box of the edits of the base made while the levels are built
+        self.pending_box = None
+        self._lock = threading.Lock()
+
+    def get_data(self):
+        """
+        :return: The levels, as the multiscale data of a napari layer
+        :rtype: list
+        """
+        return [self.base] + self.levels
+
+    @property
+    def is_built(self):
+        return all(level.array is not None for level in self.levels)
+
+    def build(self, cache=None, cache_key=None, is_cancelled=None):
+        """
+        Builds the levels that are not built yet, from the finest to the coarsest.
+        :param cache: The PyramidCache where the levels are read or stored, or None
+        :param cache_key: The key of the pyramid in the cache (see get_cache_key)
+        :param is_cancelled: Function returning True to stop before the next block
+        :return: True if every level was built
+        :rtype: bool
+        """
+        previous = self.base
+        for level in self.levels:
+            if level.array is None:
+                array = cache.get(cache_key, level.level) if cache is not None else None
+                if array is None or tuple(array.shape) != level.shape:
+                    array = np.empty(level.shape, dtype=level.dtype)
+                    for row in range(0, level.shape[0], BUILD_BLOCK_ROWS):
+                        if is_cancelled is not None and is_cancelled():
+                            return False
+                        with self._lock:
+                            array[row:row + BUILD_BLOCK_ROWS] = downsample_block(
+                                previous[2 * row:2 * (row + BUILD_BLOCK_ROWS)], self.labels)
+                    if cache is not None:
+                        cache.put(cache_key, level.level, array)
+                with self._lock:
+                    level.array = array
+            previous = level.array
+        # The edits made during the build may have been read before they were made
+        with self._lock:
+            pending_box = self.pending_box
+            self.pending_box = None
+            if pending_box is not None:
+                self._update_levels(pending_box)
+        return True
+
+    def update(self, box):
+        """
+        Copies an edit of the base to the built levels, and keeps it for the levels built later.
+        :param box: Bounding box of the edit, in the coordinates of the base
+        """
+        if not self.labels:
+            # Only the masks are edited, and the averages of the images can't be updated by a stride
+            raise ValueError("Only the pyramids of labels can be updated")
+        with self._lock:
+            if not self.is_built:
+                self.pending_box = box if self.pending_box is None else regions.merge_boxes(self.pending_box, box)
+            self._update_levels(box)
+
+    def _update_levels(self, box):
+        previous = self.base
+        for level in self.levels:
+            if level.array is None:
+                return
+            # The pixels of the level whose source pixel (at twice their index) is in the box
+            box = tuple(slice((axis_slice.start + 1) // 2, (axis_slice.stop + 1) // 2) for axis_slice in box[:2])
+            if any(axis_slice.start >= axis_slice.stop for axis_slice in box):
+                return
+            level.array[box] = np.asarray(previous[tuple(slice(2 * axis_slice.start, 2 * axis_slice.stop, 2)
+                                                         for axis_slice in box)])
+            previous = level.array
+
+
+class PyramidCache:
+    """
+    Levels of the pyramids of previous files, stored as .npy files in a folder. The least recently used pyramids are
+    removed first when the cache is too large.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        self.directory = Path(directory)
+        self.max_size_mb = max_size_mb
+        self._lock = threading.Lock()
+
+    def get(self, key, level):
+        """
+        :return: The level stored under the key, memory-mapped (copy-on-write), or None if there is none
+        :rtype: numpy.ndarray
+        """
+        path = self._get_path(key, level)
+        with self._lock:
+            try:
+                array = np.load(path, mmap_mode="c")
+            except (OSError, ValueError):
+                return None
+            # Mark the level as recently used
+            os.utime(path)
+            return array
+
+    def put(self, key, level, array):
+        """
+        Stores a level, then removes the least recently used levels if the cache is too large.
+        """
+        if self.max_size_mb <= 0:
+            return
+        path = self._get_path(key, level)
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Written to a temporary file first, so a level is never read while it's incomplete
+            temporary_path = path.with_name(path.stem + ".tmp" + LEVEL_EXTENSION)
+            np.save(temporary_path, array)
+            os.replace(temporary_path, path)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            for path in self._get_level_paths():
+                path.unlink(missing_ok=True)
+
+    def _get_path(self, key, level):
+        return self.directory / (key + "_" + str(level) + LEVEL_EXTENSION)
+
+    def _get_level_paths(self):
+        if not self.directory.is_dir():
+            return []
+        return [path for path in self.directory.glob("*" + LEVEL_EXTENSION) if ".tmp" not in path.name]
+
+    def _evict(self):
+        levels = sorted(((path.stat().st_mtime, path.stat().st_size, path) for path in self._get_level_paths()),
+                        key=lambda level: level[0])
+        total_size = sum(size for _, size, _ in levels)
+        max_size = self.max_size_mb * 2 ** 20
+        for _, size, path in levels:
+            if total_size <= max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
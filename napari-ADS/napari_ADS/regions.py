@@ -0,0 +1,149 @@
+"""
+Bounding boxes used to restrict the work done on the masks to a region of the image.
+
+A box is a tuple of slices, one per axis of the mask, that can be used to index the mask directly.
+"""
+import numpy as np
+from scipy import ndimage
+
+# 8-connectivity, as used by skimage.measure.label in compute_morphometrics
+CONNECTIVITY_STRUCTURE = np.ones((3, 3), dtype=bool)
+
+
+def get_atom_bounding_box(atom, shape):
+    """
+    Computes the bounding box of a Labels history atom, as sent by the paint event.
+    :return: The bounding box, or None if the atom is empty
+    :rtype: tuple
+    """
+    if hasattr(atom, "slice_key"):
+        indices = atom.slice_key
+    else:
+        indices = atom[0]
+    box = []
+    for axis_indices, length in zip(indices, shape):
+        if isinstance(axis_indices, slice):
+            start, stop, _ = axis_indices.indices(length)
+        else:
+            axis_indices = np.asarray(axis_indices)
+            if axis_indices.size == 0:
+                return None
+            start, stop = int(axis_indices.min()), int(axis_indices.max()) + 1
+        box.append(slice(start, stop))
+    return tuple(box)
+
+
+def get_paint_event_bounding_box(event, shape):
+    """
+    :return: The bounding box of all the atoms of a paint event, or None if the event is empty
+    :rtype: tuple
+    """
+    event_box = None
+    for atom in event.value:
+        atom_box = get_atom_bounding_box(atom, shape)
+        if atom_box is not None:
+            event_box = atom_box if event_box is None else merge_boxes(event_box, atom_box)
+    return event_box
+
+
+def expand_box(box, margin, shape):
+    return tuple(slice(max(axis_slice.start - margin, 0), min(axis_slice.stop + margin, length))
+                 for axis_slice, length in zip(box, shape))
+
+
+def merge_boxes(first_box, second_box):
+    return tuple(slice(min(first.start, second.start), max(first.stop, second.stop))
+                 for first, second in zip(first_box, second_box))
+
+
+def clip_box(box, shape):
+    """
+    :return: The part of the box inside an array of the given shape, or None if the box is outside of it
+    :rtype: tuple
+    """
+    clipped_box = tuple(slice(max(axis_slice.start, 0), min(axis_slice.stop, length))
+                        for axis_slice, length in zip(box, shape))
+    if any(axis_slice.start >= axis_slice.stop for axis_slice in clipped_box):
+        return None
+    return clipped_box
+
+
+def get_box_size(box):
+    return int(np.prod([axis_slice.stop - axis_slice.start for axis_slice in box]))
+
+
+def get_box_from_corners(first_corner, second_corner, shape):
+    """
+    :return: The box containing the two corners (in data coordinates), clipped to the given shape
+    :rtype: tuple
+    """
+    box = tuple(slice(int(np.floor(min(first, second))), int(np.ceil(max(first, second))) + 1)
+                for first, second in zip(first_corner, second_corner))
+    return clip_box(box, shape)
+
+
+def grow_box_to_components(masks, box):
+    """
+    Grows a box until it fully contains every connected component (of the union of the masks) touching it.
+    :param masks: The masks, all with the same shape
+    :param box: The box to grow
+    :return: The grown box, a window around it, the component labels of the window and the labels of the components
+             touching the box
+    :rtype: tuple
+    """
+    shape = masks[0].shape
+    # The margin doubles every time the box grows, so large components are covered in a few iterations
+    margin = 1
+    while True:
+        window = expand_box(box, margin, shape)
+        union = np.zeros([axis_slice.stop - axis_slice.start for axis_slice in window], dtype=bool)
+        for mask in masks:
+            union |= np.asarray(mask[window], dtype=bool)
+        component_labels, _ = ndimage.label(union, structure=CONNECTIVITY_STRUCTURE)
+        box_in_window = tuple(slice(box_slice.start - window_slice.start, box_slice.stop - window_slice.start)
+                              for box_slice, window_slice in zip(box, window))
+        touching_labels = np.unique(component_labels[box_in_window])
+        touching_labels = touching_labels[touching_labels > 0]
+
+        grown_box = box
+        component_boxes = ndimage.find_objects(component_labels)
+        for label in touching_labels:
+            component_box = tuple(
+                slice(component_slice.start + window_slice.start, component_slice.stop + window_slice.start)
+                for component_slice, window_slice in zip(component_boxes[label - 1], window)
+            )
+            grown_box = merge_boxes(grown_box, component_box)
+        if grown_box == box:
+            return box, window, component_labels, touching_labels
+        box = grown_box
+        margin *= 2
+
+
+def get_viewport_box(viewer, layer):
+    """
+    :return: The box of the layer data visible in the canvas of the viewer, or None if nothing is visible
+    :rtype: tuple
+    """
+    center = np.asarray(viewer.camera.center[-2:])
+    # The size of the canvas moved from the viewer to its canvas model in recent versions of napari
+    canvas_size = viewer._canvas_size if hasattr(viewer, "_canvas_size") else viewer.canvas.size
+    half_size = np.asarray(canvas_size) / viewer.camera.zoom / 2
+    first_point = np.array(viewer.dims.point, dtype=float)
+    second_point = first_point.copy()
+    first_point[-2:] = center - half_size
+    second_point[-2:] = center + half_size
+    first_corner = np.asarray(layer.world_to_data(first_point))[-2:]
+    second_corner = np.asarray(layer.world_to_data(second_point))[-2:]
+    return get_box_from_corners(first_corner, second_corner, layer.data.shape)
+
+
+def get_shapes_box(shapes_layer, layer):
+    """
+    :return: The box of the layer data covered by the last shape drawn in a Shapes layer, or None if there is none
+    :rtype: tuple
+    """
+    if len(shapes_layer.data) == 0:
+        return None
+    vertices = np.asarray([shapes_layer.data_to_world(vertex) for vertex in shapes_layer.data[-1]])
+    vertices = np.asarray([layer.world_to_data(vertex) for vertex in vertices])[:, -2:]
+    return get_box_from_corners(vertices.min(axis=0), vertices.max(axis=0), layer.data.shape)
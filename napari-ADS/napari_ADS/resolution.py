@@ -0,0 +1,178 @@
+"""
+Resolution of the pixel size of the images.
+
+The pixel size is read from the metadata of the image first (OME-XML, ImageJ or resolution tags of TIFF files), then
+from the pixel_size_in_micrometer.txt file of its folder. The values are cached with the modification time of the
+file they were read from, so a file is only read again when it changes. A folder can be scanned in the background
+before a batch, so the batch never waits on a prompt or on a read.
+"""
+import threading
+import traceback
+import xml.etree.ElementTree as ElementTree
+from pathlib import Path
+
+PIXEL_SIZE_FILE_NAME = "pixel_size_in_micrometer.txt"
+TIFF_EXTENSIONS = (".tif", ".tiff")
+# Length of each unit, in micrometers
+UNIT_LENGTHS = {
+    "pm": 1e-6, "nm": 1e-3, "um": 1.0, "µm": 1.0, "μm": 1.0, "micron": 1.0, "microns": 1.0, "micrometer": 1.0,
+    "mm": 1e3, "cm": 1e4, "m": 1e6,
+}
+# Values of the ResolutionUnit TIFF tag. Inches are not used: they only come from the default resolution of image
+# editors (72 or 300 dpi).
+CENTIMETER_RESOLUTION_UNIT = 3
+
+
+def to_micrometers(length, unit):
+    """
+    :return: A length in micrometers, or None if the unit is unknown or the length isn't positive
+    :rtype: float
+    """
+    unit_length = UNIT_LENGTHS.get(str(unit).strip().lower().replace("\\u00b5", "µ"))
+    if unit_length is None or length is None or float(length) <= 0:
+        return None
+    return float(length) * unit_length
+
+
+def read_pixel_size_file(path):
+    """
+    :param path: Path of a pixel_size_in_micrometer.txt file
+    :return: The pixel size written in the file, or None if it doesn't contain a number
+    :rtype: float
+    """
+    with open(str(path), "r") as resolution_file:
+        content = resolution_file.read()
+    try:
+        return float(content)
+    except ValueError:
+        print("Invalid pixel size in " + str(path) + ": " + content.strip())
+        return None
+
+
+def get_ome_pixel_size(ome_xml):
+    """
+    :return: The PhysicalSizeX of the first image of an OME-XML document, in micrometers
+    :rtype: float
+    """
+    for element in ElementTree.fromstring(ome_xml).iter():
+        if element.tag.endswith("Pixels") and "PhysicalSizeX" in element.attrib:
+            return to_micrometers(element.attrib["PhysicalSizeX"], element.attrib.get("PhysicalSizeXUnit", "µm"))
+    return None
+
+
+def get_resolution_tag_pixel_size(page, unit):
+    """
+    :param page: A page of a TIFF file
+    :param unit: Unit of the XResolution tag, or None to use the ResolutionUnit tag
+    :return: The inverse of the XResolution tag, in micrometers
+    :rtype: float
+    """
+    x_resolution = page.tags.get("XResolution")
+    if x_resolution is None:
+        return None
+    numerator, denominator = x_resolution.value
+    if numerator == 0:
+        return None
+    if unit is None:
+        resolution_unit = page.tags.get("ResolutionUnit")
+        if resolution_unit is None or int(resolution_unit.value) != CENTIMETER_RESOLUTION_UNIT:
+            return None
+        unit = "cm"
+    return to_micrometers(denominator / numerator, unit)
+
+
+def read_metadata_pixel_size(image_path):
+    """
+    Reads the pixel size from the metadata of a TIFF image.
+    :return: The pixel size in micrometers, or None if the image has none (or isn't a TIFF file, or tifffile is
+             missing)
+    :rtype: float
+    """
+    image_path = Path(image_path)
+    if image_path.suffix.lower() not in TIFF_EXTENSIONS:
+        return None
+    try:
+        import tifffile
+    except ImportError:
+        return None
+    try:
+        with tifffile.TiffFile(str(image_path)) as tiff_file:
+            if tiff_file.is_ome and tiff_file.ome_metadata:
+                pixel_size = get_ome_pixel_size(tiff_file.ome_metadata)
+                if pixel_size is not None:
+                    return pixel_size
+            page = tiff_file.pages[0]
+            if tiff_file.is_imagej and tiff_file.imagej_metadata is not None:
+                unit = tiff_file.imagej_metadata.get("unit")
+                if unit is not None:
+                    return get_resolution_tag_pixel_size(page, unit)
+            return get_resolution_tag_pixel_size(page, None)
+    except Exception:
+        traceback.print_exc()
+        return None
+
+
+class PixelSizeResolver:
+    """
+    Finds the pixel size of images, and caches the values read with the modification time of their file.
+    """
+    def __init__(self):
+        # Path of the file -> (modification time, pixel size read from the file)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get_pixel_size(self, image_path):
+        """
+        :return: The pixel size of an image in micrometers, from its metadata or from the pixel size file of its
+                 folder, or None if there is none
+        :rtype: float
+        """
+        image_path = Path(image_path)
+        pixel_size = self.get_metadata_pixel_size(image_path)
+        if pixel_size is None:
+            pixel_size = self.get_directory_pixel_size(image_path.parent)
+        return pixel_size
+
+    def get_metadata_pixel_size(self, image_path):
+        return self._get_cached_value(Path(image_path), read_metadata_pixel_size)
+
+    def get_directory_pixel_size(self, directory):
+        """
+        :return: The pixel size written in the pixel_size_in_micrometer.txt file of a folder, or None if there is none
+        :rtype: float
+        """
+        return self._get_cached_value(Path(directory) / PIXEL_SIZE_FILE_NAME, read_pixel_size_file)
+
+    def scan(self, image_paths, is_cancelled=None):
+        """
+        Finds the pixel size of several images, filling the cache.
+        :param is_cancelled: Function returning True to stop before the next image
+        :return: The pixel size of each scanned image (None if it has none), by path
+        :rtype: dict
+        """
+        pixel_sizes = {}
+        for image_path in image_paths:
+            if is_cancelled is not None and is_cancelled():
+                break
+            pixel_sizes[Path(image_path)] = self.get_pixel_size(image_path)
+        return pixel_sizes
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _get_cached_value(self, path, read_function):
+        try:
+            modification_time = path.stat().st_mtime_ns
+        except OSError:
+            # A missing file is cached too, and read once it's created
+            modification_time = None
+        key = str(path)
+        with self._lock:
+            cached = self._values.get(key)
+        if cached is not None and cached[0] == modification_time:
+            return cached[1]
+        value = read_function(path) if modification_time is not None else None
+        with self._lock:
+            self._values[key] = (modification_time, value)
+        return value
@@ -0,0 +1,136 @@
+"""
+On-disk cache of the segmentation results.
+
+A result is stored under a hash of the image pixels, of the model and of the segmentation parameters, so segmenting
+the same image again with the same settings reads the class map back instead of running the model. The cache has a
+size limit, and the least recently used results are removed first (a hit updates the modification time of its file).
+"""
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from . import inference
+
+DEFAULT_CACHE_DIRECTORY = Path.home() / ".cache" / "napari-ADS" / "segmentations"
+DEFAULT_MAX_SIZE_MB = 1024
+RESULT_EXTENSION = ".npz"
+# Number of rows of the image hashed at once, so the image is never copied as a whole
+HASH_BLOCK_ROWS = 1024
+
+
+def get_model_identity(path_model):
+    """
+    :return: A string identifying a model and the version of its weights
+    :rtype: str
+    """
+    model_file = inference.find_model_file(path_model, ".pt")
+    model_stat = model_file.stat()
+    return str(model_file.resolve()) + ":" + str(model_stat.st_size) + ":" + str(model_stat.st_mtime_ns)
+
+
+def get_result_key(image, path_model, pixel_size, zoom_factor, overlap_value, no_patch, rgb, backend=None):
+    """
+    :param image: The image data (any array-like object)
+    :param backend: The inference backend (see backends.BACKENDS), as the exported models can give other results
+    :return: The key of the segmentation of the image with the given model and parameters
+    :rtype: str
+    """
+    image_hash = hashlib.blake2b(digest_size=20)
+    image_hash.update((str(tuple(image.shape)) + str(np.dtype(image.dtype))).encode())
+    for row in range(0, image.shape[0], HASH_BLOCK_ROWS):
+        image_hash.update(np.ascontiguousarray(image[row:row + HASH_BLOCK_ROWS]).data)
+    parameters = [get_model_identity(path_model), pixel_size, zoom_factor, tuple(overlap_value), no_patch, rgb]
+    if backend is not None:
+        parameters.append(backend)
+    image_hash.update(repr(parameters).encode())
+    return image_hash.hexdigest()
+
+
+class ResultCache:
+    """
+    Class maps of previous segmentations, stored as compressed files in a folder.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_size_mb=DEFAULT_MAX_SIZE_MB):
+        self.directory = Path(directory)
+        self.max_size_mb = max_size_mb
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :return: The class map stored under the key, or None if there is none
+        :rtype: numpy.ndarray
+        """
+        path = self._get_path(key)
+        with self._lock:
+            try:
+                with np.load(path) as result:
+                    class_map = result["class_map"]
+            except (OSError, KeyError, ValueError):
+                self.misses += 1
+                return None
+            self.hits += 1
+            # Mark the result as recently used
+            os.utime(path)
+            return class_map
+
+    def put(self, key, class_map):
+        """
+        Stores a class map, then removes the least recently used results if the cache is too large.
+        """
+        if self.max_size_mb <= 0:
+            return
+        path = self._get_path(key)
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            # Written to a temporary file first, so a result is never read while it's incomplete
+            temporary_path = path.with_name(path.stem + ".tmp" + RESULT_EXTENSION)
+            np.savez_compressed(temporary_path, class_map=class_map)
+            os.replace(temporary_path, path)
+            self._evict()
+
+    def set_max_size_mb(self, max_size_mb):
+        with self._lock:
+            self.max_size_mb = max_size_mb
+            self._evict()
+
+    def clear(self):
+        """
+        Removes every result of the cache.
+        """
+        with self._lock:
+            for path in self._get_result_paths():
+                path.unlink(missing_ok=True)
+
+    def get_size_bytes(self):
+        return sum(path.stat().st_size for path in self._get_result_paths())
+
+    def __len__(self):
+        return len(self._get_result_paths())
+
+    def get_stats_string(self):
+        return ("Result cache: " + str(len(self)) + " results, " + str(round(self.get_size_bytes() / 2 ** 20, 1)) +
+                "/" + str(self.max_size_mb) + " MB, " + str(self.hits) + " hits, " + str(self.misses) + " misses")
+
+    def _get_path(self, key):
+        return self.directory / (key + RESULT_EXTENSION)
+
+    def _get_result_paths(self):
+        if not self.directory.is_dir():
+            return []
+        return [path for path in self.directory.glob("*" + RESULT_EXTENSION) if ".tmp" not in path.name]
+
+    def _evict(self):
+        results = sorted(((path.stat().st_mtime, path.stat().st_size, path) for path in self._get_result_paths()),
+                         key=lambda result: result[0])
+        total_size = sum(size for _, size, _ in results)
+        max_size = self.max_size_mb * 2 ** 20
+        for _, size, path in results:
+            if total_size <= max_size:
+                break
+            path.unlink(missing_ok=True)
+            total_size -= size
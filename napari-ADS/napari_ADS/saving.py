@@ -0,0 +1,137 @@
+"""
+Saving of the axon and myelin masks.
+
+The masks are converted to 8-bit images without any wider temporary array, and written either as PNG files, as
+compressed tiled TIFF files or as OME-Zarr arrays. The TIFF and OME-Zarr outputs are written by blocks of rows, so the
+full-size images are never built in memory.
+"""
+from pathlib import Path
+
+import numpy as np
+
+from . import profiling
+
+PNG_FORMAT = "PNG"
+TIFF_FORMAT = "Compressed TIFF"
+OME_ZARR_FORMAT = "OME-Zarr"
+SAVE_FORMATS = (PNG_FORMAT, TIFF_FORMAT, OME_ZARR_FORMAT)
+# Order of the masks in the file names and paths
+MASK_KINDS = ("axonmyelin", "myelin", "axon")
+FORMAT_EXTENSIONS = {PNG_FORMAT: None, TIFF_FORMAT: ".tif", OME_ZARR_FORMAT: ".ome.zarr"}
+# Size of the TIFF tiles and of the OME-Zarr chunks
+TILE_SHAPE = (256, 256)
+BLOCK_ROWS = 1024
+
+
+def get_mask_file_names(image_name, save_format=PNG_FORMAT):
+    """
+    :return: The file names of the axonmyelin, myelin and axon masks of an image
+    :rtype: tuple
+    """
+    from config import axonmyelin_suffix, axon_suffix, myelin_suffix
+
+    file_names = []
+    for suffix in (axonmyelin_suffix, myelin_suffix, axon_suffix):
+        file_name = image_name + str(suffix)
+        extension = FORMAT_EXTENSIONS[save_format]
+        if extension is not None:
+            file_name = str(Path(file_name).with_suffix(extension))
+        file_names.append(file_name)
+    return tuple(file_names)
+
+
+def to_mask_image(kind, axon_block, myelin_block):
+    """
+    Converts binary masks to one of the 8-bit images saved by AxonDeepSeg, in a single pass.
+    :param kind: "axonmyelin", "myelin" or "axon"
+    :rtype: numpy.ndarray
+    """
+    from AxonDeepSeg import params
+
+    binary_intensity = params.intensity['binary']
+    if kind == "axon":
+        return np.multiply(axon_block, binary_intensity, dtype=np.uint8, casting="unsafe")
+    myelin_image = np.multiply(myelin_block, binary_intensity, dtype=np.uint8, casting="unsafe")
+    if kind == "myelin":
+        return myelin_image
+    # Same values as myelin // 2 + axon, computed in uint8 in the same buffer
+    axonmyelin_image = np.floor_divide(myelin_image, 2, out=myelin_image)
+    axon_image = np.multiply(axon_block, binary_intensity, dtype=np.uint8, casting="unsafe")
+    return np.add(axonmyelin_image, axon_image, out=axonmyelin_image)
+
+
+def iter_blocks(kind, axon_data, myelin_data, block_rows=BLOCK_ROWS):
+    """
+    Yields the row offset and the mask image of each block of rows. Only one block is in memory at a time.
+    """
+    for row in range(0, axon_data.shape[0], block_rows):
+        yield row, to_mask_image(kind, np.asarray(axon_data[row:row + block_rows]),
+                                 np.asarray(myelin_data[row:row + block_rows]))
+
+
+def iter_tiles(kind, axon_data, myelin_data):
+    """
+    Yields the tiles of a mask image in the order expected by tifffile (row by row).
+    """
+    for _, block in iter_blocks(kind, axon_data, myelin_data, block_rows=TILE_SHAPE[0]):
+        for column in range(0, block.shape[1], TILE_SHAPE[1]):
+            yield block[:, column:column + TILE_SHAPE[1]]
+
+
+def save_png(axon_data, myelin_data, paths):
+    from AxonDeepSeg import ads_utils
+    axon_data = np.asarray(axon_data)
+    myelin_data = np.asarray(myelin_data)
+    for kind, path in zip(MASK_KINDS, paths):
+        with profiling.stage("writing " + kind + " mask"):
+            ads_utils.imwrite(filename=path, img=to_mask_image(kind, axon_data, myelin_data))
+
+
+def save_tiff(axon_data, myelin_data, paths):
+    import tifffile
+    shape = tuple(axon_data.shape)
+    for kind, path in zip(MASK_KINDS, paths):
+        with profiling.stage("writing " + kind + " mask"):
+            tifffile.imwrite(str(path), iter_tiles(kind, axon_data, myelin_data), shape=shape, dtype=np.uint8,
+                             tile=TILE_SHAPE, compression="zlib", bigtiff=axon_data.size > 2 ** 31)
+
+
+def save_ome_zarr(axon_data, myelin_data, paths, pixel_size=None):
+    import zarr
+    shape = tuple(axon_data.shape)
+    chunks = tuple(min(chunk, length) for chunk, length in zip(TILE_SHAPE, shape))
+    scale = [1.0, 1.0] if pixel_size is None else [float(pixel_size)] * 2
+    unit = {} if pixel_size is None else {"unit": "micrometer"}
+    for kind, path in zip(MASK_KINDS, paths):
+        group = zarr.open_group(str(path), mode="w")
+        group.attrs["multiscales"] = [{
+            "version": "0.4",
+            "axes": [dict(name="y", type="space", **unit), dict(name="x", type="space", **unit)],
+            "datasets": [{"path": "0", "coordinateTransformations": [{"type": "scale", "scale": scale}]}],
+        }]
+        array = zarr.open_array(str(Path(path) / "0"), mode="w", shape=shape, chunks=chunks, dtype=np.uint8)
+        with profiling.stage("writing " + kind + " mask"):
+            for row, block in iter_blocks(kind, axon_data, myelin_data):
+                array[row:row + block.shape[0]] = block
+
+
+def save_segmentation(axon_data, myelin_data, save_directory, image_name, save_format=PNG_FORMAT, pixel_size=None):
+    """
+    Writes the axonmyelin, myelin and axon masks of an image.
+    :param axon_data: The axon mask (any array-like object with values 0 and 1)
+    :param myelin_data: The myelin mask
+    :param save_directory: Folder in which the masks are written
+    :param image_name: Name of the microscopy image, used as prefix of the file names
+    :param save_format: One of SAVE_FORMATS
+    :param pixel_size: Pixel size in micrometers, written in the OME-Zarr metadata
+    :return: The paths of the written masks
+    :rtype: list of Path
+    """
+    paths = [Path(save_directory) / file_name for file_name in get_mask_file_names(image_name, save_format)]
+    if save_format == TIFF_FORMAT:
+        save_tiff(axon_data, myelin_data, paths)
+    elif save_format == OME_ZARR_FORMAT:
+        save_ome_zarr(axon_data, myelin_data, paths, pixel_size)
+    else:
+        save_png(axon_data, myelin_data, paths)
+    return paths
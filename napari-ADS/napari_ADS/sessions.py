@@ -0,0 +1,269 @@
+"""
+Session snapshots, to reopen the images under review with their masks as they were left.
+
+A session is a folder containing session.json (the images, their pixel size and the names of their masks, the
+settings of the plugin), one compressed array per mask and the last morphometrics table as a CSV file. The images
+aren't copied: the session keeps their path, absolute and relative to the folder, so a session moved with its images
+can still be opened. The masks are chunked zarr arrays if zarr is installed (.npz files otherwise). When a session is
+opened, their chunks are copied to a temporary working folder without being decompressed, and the mask layers read
+them from there, so a mask is only decompressed where it is shown or edited. The plugin removes the working folder
+with the last of those layers.
+"""
+import json
+import os
+import shutil
+import traceback
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from qtpy import QtCore
+from qtpy.QtCore import Signal
+
+from . import tiled
+
+SESSION_EXTENSION = ".adssession"
+SESSION_FILTER = "napari-ADS session(*" + SESSION_EXTENSION + ")"
+SESSION_FILE_NAME = "session.json"
+MORPHOMETRICS_FILE_NAME = "morphometrics.csv"
+MASKS_DIRECTORY_NAME = "masks"
+FORMAT_VERSION = 1
+# Metadata of the image layers kept in the session
+METADATA_KEYS = ("pixel_size", "model", "zoom_factor")
+# Number of rows of a mask written at once
+BLOCK_ROWS = 1024
+
+
+class SessionImage:
+    """
+    An image of a session, with its masks.
+    """
+    def __init__(self, name, path=None, rgb=False, metadata=None, masks=None):
+        """
+        :param name: Name of the image layer
+        :param path: Path of the image file, or None if the image has no file
+        :param metadata: The metadata of METADATA_KEYS (pixel size, model and zoom factor)
+        :param masks: The mask data (any array-like object) by kind ("axon", "myelin" or "axonmyelin")
+        """
+        self.name = name
+        self.path = None if path is None else Path(path)
+        self.rgb = rgb
+        self.metadata = dict(metadata or {})
+        self.masks = dict(masks or {})
+
+
+class Session:
+    """
+    The content of a session: its images, the settings of the plugin and the last morphometrics table.
+    """
+    def __init__(self, images=None, settings=None, morphometrics=None, morphometrics_image_name=None,
+                 work_directory=None):
+        """
+        :param settings: The settings of the plugin, by name
+        :param morphometrics: The last morphometrics table (pandas.DataFrame), or None
+        :param morphometrics_image_name: Name of the image of the morphometrics table
+        :param work_directory: Folder of the editable copy of the masks of an opened session
+        """
+        self.images = list(images or [])
+        self.settings = dict(settings or {})
+        self.morphometrics = morphometrics
+        self.morphometrics_image_name = morphometrics_image_name
+        self.work_directory = work_directory
+
+
+def write_mask(data, path):
+    """
+    Writes a mask as a compressed array, by blocks of rows.
+    :param data: The mask (any array-like object)
+    :param path: Path of the array, without extension
+    :return: The path of the written array
+    :rtype: Path
+    """
+    try:
+        import zarr
+    except ImportError:
+        zarr = None
+    shape = tuple(data.shape)
+    if zarr is None:
+        path = path.with_suffix(".npz")
+        np.savez_compressed(path, mask=np.asarray(data, dtype=np.uint8))
+        return path
+    path = path.with_suffix(".zarr")
+    chunks = tuple(min(chunk, length) for chunk, length in zip(tiled.CHUNK_SHAPE, shape))
+    array = zarr.open(str(path), mode="w", shape=shape, chunks=chunks, dtype=np.uint8)
+    for row in range(0, shape[0], BLOCK_ROWS):
+        array[row:row + BLOCK_ROWS] = np.asarray(data[row:row + BLOCK_ROWS], dtype=np.uint8)
+    return path
+
+
+def open_mask(path, work_directory):
+    """
+    Opens a mask written by write_mask, as an editable array that doesn't change the session.
+    :param work_directory: Folder receiving the copy of the zarr arrays
+    :return: A zarr array reading the copy lazily, or the decompressed .npz array
+    """
+    path = Path(path)
+    if path.suffix == ".npz":
+        with np.load(path) as mask_file:
+            return mask_file["mask"]
+    import zarr
+    # The compressed chunks are copied as they are
+    work_path = Path(work_directory) / path.name
+    shutil.copytree(path, work_path)
+    return zarr.open(str(work_path), mode="r+")
+
+
+def is_session_directory(directory):
+    return (Path(directory) / SESSION_FILE_NAME).is_file()
+
+
+def get_relative_path(path, directory):
+    try:
+        return os.path.relpath(str(path), str(directory))
+    except ValueError:
+        # The paths are on different drives
+        return None
+
+
+def find_image_path(image_entry, directory):
+    """
+    :return: The image file of an image of a session, at its absolute path or relative to the session, or None if
+             it isn't found
+    :rtype: Path
+    """
+    candidates = []
+    if image_entry.get("path") is not None:
+        candidates.append(Path(image_entry["path"]))
+    if image_entry.get("relative_path") is not None:
+        candidates.append(Path(directory) / image_entry["relative_path"])
+    for candidate in candidates:
+        if candidate.exists():
+            return candidate
+    return None
+
+
+def save_session(session, directory):
+    """
+    Writes a session to a folder, replacing the session it contains. The session is written to a temporary folder
+    first, so the previous one is kept if the writing fails. The previous session is then renamed and removed only
+    once the new one is in place.
+    :param directory: Folder of the session, created if needed. It must be empty if it isn't a session.
+    """
+    directory = Path(directory)
+    if directory.exists() and not is_session_directory(directory) and any(directory.iterdir()):
+        raise ValueError(directory.name + " isn't a napari-ADS session and isn't empty")
+    temporary_directory = directory.with_name(directory.name + ".tmp")
+    shutil.rmtree(temporary_directory, ignore_errors=True)
+    (temporary_directory / MASKS_DIRECTORY_NAME).mkdir(parents=True)
+
+    image_entries = []
+    for image_index, image in enumerate(session.images):
+        mask_paths = {}
+        for kind, mask_data in image.masks.items():
+            mask_path = write_mask(mask_data, temporary_directory / MASKS_DIRECTORY_NAME /
+                                   (str(image_index) + "_" + kind))
+            mask_paths[kind] = mask_path.relative_to(temporary_directory).as_posix()
+        image_entries.append({
+            "name": image.name,
+            "path": None if image.path is None else str(image.path.resolve()),
+            "relative_path": None if image.path is None else get_relative_path(image.path.resolve(),
+                                                                                directory.resolve()),
+            "rgb": image.rgb,
+            "metadata": {key: image.metadata[key] for key in METADATA_KEYS if image.metadata.get(key) is not None},
+            "masks": mask_paths,
+        })
+    if session.morphometrics is not None:
+        session.morphometrics.to_csv(temporary_directory / MORPHOMETRICS_FILE_NAME)
+    session_entry = {
+        "version": FORMAT_VERSION,
+        "images": image_entries,
+        "settings": session.settings,
+        "morphometrics_image_name": session.morphometrics_image_name if session.morphometrics is not None else None,
+    }
+    with open(temporary_directory / SESSION_FILE_NAME, "w") as session_file:
+        json.dump(session_entry, session_file, indent=2)
+
+    if not directory.exists():
+        os.replace(temporary_directory, directory)
+        return
+    old_directory = directory.with_name(directory.name + ".old")
+    shutil.rmtree(old_directory, ignore_errors=True)
+    os.replace(directory, old_directory)
+    try:
+        os.replace(temporary_directory, directory)
+    except OSError:
+        # The previous session is put back
+        os.replace(old_directory, directory)
+        raise
+    shutil.rmtree(old_directory, ignore_errors=True)
+
+
+def load_session(directory, work_directory=None):
+    """
+    Reads a session. The images aren't read: the path of each image is the file found for it, or None.
+    :param work_directory: Folder receiving the editable copy of the masks. A temporary folder (see
+                           tiled.create_temporary_directory) is used if None.
+    :rtype: Session
+    """
+    directory = Path(directory)
+    if not is_session_directory(directory):
+        raise ValueError(directory.name + " isn't a napari-ADS session")
+    with open(directory / SESSION_FILE_NAME, "r") as session_file:
+        session_entry = json.load(session_file)
+    if session_entry.get("version", FORMAT_VERSION) > FORMAT_VERSION:
+        raise ValueError(directory.name + " was saved by a newer version of napari-ADS")
+    temporary = work_directory is None
+    if temporary:
+        work_directory = tiled.create_temporary_directory()
+
+    images = []
+    try:
+        for image_index, image_entry in enumerate(session_entry["images"]):
+            image_work_directory = Path(work_directory) / str(image_index)
+            image_work_directory.mkdir(parents=True, exist_ok=True)
+            image_masks = {kind: open_mask(directory / mask_path, image_work_directory)
+                           for kind, mask_path in image_entry["masks"].items()}
+            images.append(SessionImage(image_entry["name"], find_image_path(image_entry, directory),
+                                       rgb=image_entry.get("rgb", False), metadata=image_entry.get("metadata"),
+                                       masks=image_masks))
+    except Exception:
+        if temporary:
+            tiled.remove_temporary_directory(work_directory)
+        raise
+    morphometrics = None
+    morphometrics_path = directory / MORPHOMETRICS_FILE_NAME
+    if morphometrics_path.is_file():
+        morphometrics = pd.read_csv(morphometrics_path, index_col=0)
+    return Session(images, session_entry.get("settings"), morphometrics, session_entry.get("morphometrics_image_name"),
+                   work_directory)
+
+
+class SessionThread(QtCore.QThread):
+    """
+    Saves or opens a session without blocking the napari event loop.
+    """
+    # Emits an error message, empty if the session was saved or opened
+    session_finished_signal = Signal(str)
+
+    def __init__(self):
+        super().__init__()
+        # Folder of the session. Must not be None before calling run().
+        self.directory = None
+        # The session to save, or None to open the session of the folder. Contains the opened session after run().
+        self.session = None
+        self.saving = False
+
+    def run(self):
+        try:
+            if self.saving:
+                save_session(self.session, self.directory)
+                # The masks aren't kept in memory after they are saved
+                self.session = None
+            else:
+                self.session = load_session(self.directory)
+        except Exception as error:
+            traceback.print_exc()
+            action = "save" if self.saving else "open"
+            self.session_finished_signal.emit("Couldn't " + action + " the session: " + str(error))
+        else:
+            self.session_finished_signal.emit("")
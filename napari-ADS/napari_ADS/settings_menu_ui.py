@@ -26,13 +26,58 @@ class Ui_Settings_menu_ui(object):
         self.gpu_id_spinBox = QtWidgets.QSpinBox(Settings_menu_ui)
         self.gpu_id_spinBox.setObjectName("gpu_id_spinBox")
         self.horizontalLayout_6.addWidget(self.gpu_id_spinBox)
+        self.label_11 = QtWidgets.QLabel(Settings_menu_ui)
+        self.label_11.setObjectName("label_11")
+        self.horizontalLayout_6.addWidget(self.label_11)
+        self.cpu_workers_spinBox = QtWidgets.QSpinBox(Settings_menu_ui)
+        self.cpu_workers_spinBox.setMinimum(1)
+        self.cpu_workers_spinBox.setProperty("value", 1)
+        self.cpu_workers_spinBox.setObjectName("cpu_workers_spinBox")
+        self.horizontalLayout_6.addWidget(self.cpu_workers_spinBox)
         self.verticalLayout.addLayout(self.horizontalLayout_6)
+        self.horizontalLayout_8 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_8.setObjectName("horizontalLayout_8")
+        self.label_7 = QtWidgets.QLabel(Settings_menu_ui)
+        self.label_7.setObjectName("label_7")
+        self.horizontalLayout_8.addWidget(self.label_7)
+        self.batch_workers_spinBox = QtWidgets.QSpinBox(Settings_menu_ui)
+        self.batch_workers_spinBox.setMinimum(1)
+        self.batch_workers_spinBox.setMaximum(64)
+        self.batch_workers_spinBox.setProperty("value", 1)
+        self.batch_workers_spinBox.setObjectName("batch_workers_spinBox")
+        self.horizontalLayout_8.addWidget(self.batch_workers_spinBox)
+        self.verticalLayout.addLayout(self.horizontalLayout_8)
         self.horizontalLayout_5 = QtWidgets.QHBoxLayout()
         self.horizontalLayout_5.setObjectName("horizontalLayout_5")
         self.no_patch_checkBox = QtWidgets.QCheckBox(Settings_menu_ui)
         self.no_patch_checkBox.setObjectName("no_patch_checkBox")
         self.horizontalLayout_5.addWidget(self.no_patch_checkBox)
+        self.in_memory_checkBox = QtWidgets.QCheckBox(Settings_menu_ui)
+        self.in_memory_checkBox.setChecked(True)
+        self.in_memory_checkBox.setObjectName("in_memory_checkBox")
+        self.horizontalLayout_5.addWidget(self.in_memory_checkBox)
+        self.tiled_checkBox = QtWidgets.QCheckBox(Settings_menu_ui)
+        self.tiled_checkBox.setObjectName("tiled_checkBox")
+        self.horizontalLayout_5.addWidget(self.tiled_checkBox)
         self.verticalLayout.addLayout(self.horizontalLayout_5)
+        self.horizontalLayout_11 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_11.setObjectName("horizontalLayout_11")
+        self.axonmyelin_layer_checkBox = QtWidgets.QCheckBox(Settings_menu_ui)
+        self.axonmyelin_layer_checkBox.setObjectName("axonmyelin_layer_checkBox")
+        self.horizontalLayout_11.addWidget(self.axonmyelin_layer_checkBox)
+        self.progressive_checkBox = QtWidgets.QCheckBox(Settings_menu_ui)
+        self.progressive_checkBox.setObjectName("progressive_checkBox")
+        self.horizontalLayout_11.addWidget(self.progressive_checkBox)
+        self.verticalLayout.addLayout(self.horizontalLayout_11)
+        self.horizontalLayout_14 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_14.setObjectName("horizontalLayout_14")
+        self.multiscale_checkBox = QtWidgets.QCheckBox(Settings_menu_ui)
+        self.multiscale_checkBox.setObjectName("multiscale_checkBox")
+        self.horizontalLayout_14.addWidget(self.multiscale_checkBox)
+        self.pyramid_cache_checkBox = QtWidgets.QCheckBox(Settings_menu_ui)
+        self.pyramid_cache_checkBox.setObjectName("pyramid_cache_checkBox")
+        self.horizontalLayout_14.addWidget(self.pyramid_cache_checkBox)
+        self.verticalLayout.addLayout(self.horizontalLayout_14)
         self.horizontalLayout_4 = QtWidgets.QHBoxLayout()
         self.horizontalLayout_4.setObjectName("horizontalLayout_4")
         self.label_4 = QtWidgets.QLabel(Settings_menu_ui)
@@ -44,6 +89,31 @@ class Ui_Settings_menu_ui(object):
         self.axon_shape_comboBox.addItem("")
         self.horizontalLayout_4.addWidget(self.axon_shape_comboBox)
         self.verticalLayout.addLayout(self.horizontalLayout_4)
+        self.horizontalLayout_9 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_9.setObjectName("horizontalLayout_9")
+        self.label_8 = QtWidgets.QLabel(Settings_menu_ui)
+        self.label_8.setObjectName("label_8")
+        self.horizontalLayout_9.addWidget(self.label_8)
+        self.fill_region_comboBox = QtWidgets.QComboBox(Settings_menu_ui)
+        self.fill_region_comboBox.setObjectName("fill_region_comboBox")
+        self.fill_region_comboBox.addItem("")
+        self.fill_region_comboBox.addItem("")
+        self.fill_region_comboBox.addItem("")
+        self.fill_region_comboBox.addItem("")
+        self.horizontalLayout_9.addWidget(self.fill_region_comboBox)
+        self.verticalLayout.addLayout(self.horizontalLayout_9)
+        self.horizontalLayout_10 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_10.setObjectName("horizontalLayout_10")
+        self.label_9 = QtWidgets.QLabel(Settings_menu_ui)
+        self.label_9.setObjectName("label_9")
+        self.horizontalLayout_10.addWidget(self.label_9)
+        self.save_format_comboBox = QtWidgets.QComboBox(Settings_menu_ui)
+        self.save_format_comboBox.setObjectName("save_format_comboBox")
+        self.save_format_comboBox.addItem("")
+        self.save_format_comboBox.addItem("")
+        self.save_format_comboBox.addItem("")
+        self.horizontalLayout_10.addWidget(self.save_format_comboBox)
+        self.verticalLayout.addLayout(self.horizontalLayout_10)
         self.horizontalLayout_2 = QtWidgets.QHBoxLayout()
         self.horizontalLayout_2.setObjectName("horizontalLayout_2")
         self.label = QtWidgets.QLabel(Settings_menu_ui)
@@ -68,6 +138,55 @@ class Ui_Settings_menu_ui(object):
         self.zoom_factor_spinBox.setObjectName("zoom_factor_spinBox")
         self.horizontalLayout.addWidget(self.zoom_factor_spinBox)
         self.verticalLayout.addLayout(self.horizontalLayout)
+        self.horizontalLayout_7 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_7.setObjectName("horizontalLayout_7")
+        self.label_6 = QtWidgets.QLabel(Settings_menu_ui)
+        self.label_6.setObjectName("label_6")
+        self.horizontalLayout_7.addWidget(self.label_6)
+        self.model_cache_size_spinBox = QtWidgets.QSpinBox(Settings_menu_ui)
+        self.model_cache_size_spinBox.setMinimum(1)
+        self.model_cache_size_spinBox.setMaximum(10)
+        self.model_cache_size_spinBox.setProperty("value", 2)
+        self.model_cache_size_spinBox.setObjectName("model_cache_size_spinBox")
+        self.horizontalLayout_7.addWidget(self.model_cache_size_spinBox)
+        self.release_memory_button = QtWidgets.QPushButton(Settings_menu_ui)
+        self.release_memory_button.setObjectName("release_memory_button")
+        self.horizontalLayout_7.addWidget(self.release_memory_button)
+        self.verticalLayout.addLayout(self.horizontalLayout_7)
+        self.horizontalLayout_12 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_12.setObjectName("horizontalLayout_12")
+        self.label_10 = QtWidgets.QLabel(Settings_menu_ui)
+        self.label_10.setObjectName("label_10")
+        self.horizontalLayout_12.addWidget(self.label_10)
+        self.result_cache_size_spinBox = QtWidgets.QSpinBox(Settings_menu_ui)
+        self.result_cache_size_spinBox.setMaximum(1000000)
+        self.result_cache_size_spinBox.setSingleStep(256)
+        self.result_cache_size_spinBox.setProperty("value", 1024)
+        self.result_cache_size_spinBox.setObjectName("result_cache_size_spinBox")
+        self.horizontalLayout_12.addWidget(self.result_cache_size_spinBox)
+        self.clear_result_cache_button = QtWidgets.QPushButton(Settings_menu_ui)
+        self.clear_result_cache_button.setObjectName("clear_result_cache_button")
+        self.horizontalLayout_12.addWidget(self.clear_result_cache_button)
+        self.verticalLayout.addLayout(self.horizontalLayout_12)
+        self.horizontalLayout_13 = QtWidgets.QHBoxLayout()
+        self.horizontalLayout_13.setObjectName("horizontalLayout_13")
+        self.label_12 = QtWidgets.QLabel(Settings_menu_ui)
+        self.label_12.setObjectName("label_12")
+        self.horizontalLayout_13.addWidget(self.label_12)
+        self.backend_comboBox = QtWidgets.QComboBox(Settings_menu_ui)
+        self.backend_comboBox.setObjectName("backend_comboBox")
+        self.backend_comboBox.addItem("")
+        self.backend_comboBox.addItem("")
+        self.backend_comboBox.addItem("")
+        self.backend_comboBox.addItem("")
+        self.horizontalLayout_13.addWidget(self.backend_comboBox)
+        self.check_backend_button = QtWidgets.QPushButton(Settings_menu_ui)
+        self.check_backend_button.setObjectName("check_backend_button")
+        self.horizontalLayout_13.addWidget(self.check_backend_button)
+        self.verticalLayout.addLayout(self.horizontalLayout_13)
+        self.result_cache_stats_label = QtWidgets.QLabel(Settings_menu_ui)
+        self.result_cache_stats_label.setObjectName("result_cache_stats_label")
+        self.verticalLayout.addWidget(self.result_cache_stats_label)
         self.done_button = QtWidgets.QPushButton(Settings_menu_ui)
         self.done_button.setObjectName("done_button")
         self.verticalLayout.addWidget(self.done_button)
@@ -81,12 +200,39 @@ class Ui_Settings_menu_ui(object):
         _translate = QtCore.QCoreApplication.translate
         Settings_menu_ui.setWindowTitle(_translate("Settings_menu_ui", "Settings menu"))
         self.label_5.setText(_translate("Settings_menu_ui", "GPU ID"))
+        self.label_11.setText(_translate("Settings_menu_ui", "CPU workers"))
+        self.label_7.setText(_translate("Settings_menu_ui", "Batch workers"))
         self.no_patch_checkBox.setText(_translate("Settings_menu_ui", "No patch"))
+        self.in_memory_checkBox.setText(_translate("Settings_menu_ui", "In-memory segmentation"))
+        self.tiled_checkBox.setText(_translate("Settings_menu_ui", "Out-of-core (tiled)"))
+        self.axonmyelin_layer_checkBox.setText(_translate("Settings_menu_ui", "Single axon-myelin layer"))
+        self.progressive_checkBox.setText(_translate("Settings_menu_ui", "Progressive preview"))
+        self.multiscale_checkBox.setText(_translate("Settings_menu_ui", "Multiscale display (no mask painting)"))
+        self.pyramid_cache_checkBox.setText(_translate("Settings_menu_ui", "Cache image pyramids on disk"))
         self.label_4.setText(_translate("Settings_menu_ui", "Axon Shape"))
         self.axon_shape_comboBox.setItemText(0, _translate("Settings_menu_ui", "circle"))
         self.axon_shape_comboBox.setItemText(1, _translate("Settings_menu_ui", "ellipse"))
+        self.label_8.setText(_translate("Settings_menu_ui", "Fill axons region"))
+        self.fill_region_comboBox.setItemText(0, _translate("Settings_menu_ui", "Whole image"))
+        self.fill_region_comboBox.setItemText(1, _translate("Settings_menu_ui", "Current view"))
+        self.fill_region_comboBox.setItemText(2, _translate("Settings_menu_ui", "Last drawn shape"))
+        self.fill_region_comboBox.setItemText(3, _translate("Settings_menu_ui", "Recent myelin edits"))
+        self.label_9.setText(_translate("Settings_menu_ui", "Segmentation format"))
+        self.save_format_comboBox.setItemText(0, _translate("Settings_menu_ui", "PNG"))
+        self.save_format_comboBox.setItemText(1, _translate("Settings_menu_ui", "Compressed TIFF"))
+        self.save_format_comboBox.setItemText(2, _translate("Settings_menu_ui", "OME-Zarr"))
         self.label.setText(_translate("Settings_menu_ui", "Overlap Value"))
         self.label_3.setText(_translate("Settings_menu_ui", "Zoom factor"))
+        self.label_6.setText(_translate("Settings_menu_ui", "Models kept in memory"))
+        self.release_memory_button.setText(_translate("Settings_menu_ui", "Release memory"))
+        self.label_10.setText(_translate("Settings_menu_ui", "Result cache size (MB)"))
+        self.clear_result_cache_button.setText(_translate("Settings_menu_ui", "Clear result cache"))
+        self.label_12.setText(_translate("Settings_menu_ui", "Inference backend"))
+        self.backend_comboBox.setItemText(0, _translate("Settings_menu_ui", "PyTorch"))
+        self.backend_comboBox.setItemText(1, _translate("Settings_menu_ui", "TorchScript (CPU)"))
+        self.backend_comboBox.setItemText(2, _translate("Settings_menu_ui", "ONNX Runtime (CPU)"))
+        self.backend_comboBox.setItemText(3, _translate("Settings_menu_ui", "ONNX Runtime int8 (CPU)"))
+        self.check_backend_button.setText(_translate("Settings_menu_ui", "Check accuracy"))
         self.done_button.setText(_translate("Settings_menu_ui", "Done"))
 
 
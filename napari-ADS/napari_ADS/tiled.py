@@ -0,0 +1,274 @@
+"""
+Out-of-core segmentation of images that don't fit in memory.
+
+The image is read one patch at a time (with the halo given by the overlap value), and the predictions are written
+straight into chunked on-disk arrays (zarr if it is installed, memory-mapped .npy files otherwise). The peak memory use
+depends on the patch size of the model, not on the size of the image. The arrays are created in a temporary folder,
+removed when the layers showing them are removed, or at exit.
+"""
+import atexit
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy import ndimage
+
+from . import inference, profiling
+
+CHUNK_SHAPE = (1024, 1024)
+# Number of rows read at once when computing the statistics of the image
+STATISTICS_BLOCK_ROWS = 1024
+
+# Temporary folders created by create_temporary_directory and not removed yet
+_temporary_directories = set()
+
+
+def open_lazy_image(path):
+    """
+    Opens an image without reading it in memory, when the format allows it.
+    :param path: Path to a zarr folder (or OME-Zarr image), a TIFF file or a .npy file
+    :return: An array-like object that reads the pixels when it is sliced
+    """
+    path = Path(path)
+    if path.suffix == ".zarr" or path.is_dir():
+        import zarr
+        array = zarr.open(str(path), mode="r")
+        if isinstance(array, zarr.Group):
+            # OME-Zarr image: the full resolution array is the first dataset of the multiscales metadata
+            array = array[array.attrs["multiscales"][0]["datasets"][0]["path"]]
+        return array
+    if path.suffix == ".npy":
+        return np.load(str(path), mmap_mode="r")
+    if path.suffix.lower() in (".tif", ".tiff"):
+        import tifffile
+        try:
+            return tifffile.memmap(str(path), mode="r")
+        except ValueError:
+            pass
+        try:
+            # Compressed or tiled TIFF files can't be memory-mapped, but they can be read as zarr arrays
+            import zarr
+            return zarr.open(tifffile.imread(str(path), aszarr=True), mode="r")
+        except (ImportError, ValueError):
+            # zarr is missing, or its version isn't supported by tifffile
+            return tifffile.imread(str(path))
+    raise ValueError("Can't open " + path.name + " lazily. Supported formats: zarr, TIFF and npy")
+
+
+def create_temporary_directory():
+    """
+    Creates a temporary folder, removed at exit if remove_temporary_directory wasn't called before.
+    :rtype: Path
+    """
+    directory = Path(tempfile.mkdtemp(prefix="napari-ADS-"))
+    _temporary_directories.add(directory)
+    return directory
+
+
+def remove_temporary_directory(directory):
+    directory = Path(directory)
+    _temporary_directories.discard(directory)
+    # The files still memory-mapped can't be removed on Windows
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+@atexit.register
+def remove_temporary_directories():
+    for directory in list(_temporary_directories):
+        remove_temporary_directory(directory)
+
+
+def create_mask_stores(shape, directory=None, name="segmentation", mask_names=("axon", "myelin")):
+    """
+    Creates the on-disk arrays receiving the masks.
+    :param shape: Shape of the masks
+    :param directory: Folder in which the arrays are created. A temporary folder (see create_temporary_directory) is
+                      used if None.
+    :param name: Prefix of the array names
+    :param mask_names: Suffix of each array name. One array is created per name.
+    :return: The arrays, in the order of mask_names (the axon array and the myelin array by default)
+    :rtype: tuple
+    """
+    if directory is None:
+        directory = create_temporary_directory()
+    directory = Path(directory)
+    chunks = tuple(min(chunk, length) for chunk, length in zip(CHUNK_SHAPE, shape))
+    try:
+        import zarr
+    except ImportError:
+        zarr = None
+
+    stores = []
+    for mask_name in mask_names:
+        if zarr is not None:
+            store_path = directory / (name + "_" + mask_name + ".zarr")
+            stores.append(zarr.open(str(store_path), mode="w", shape=shape, chunks=chunks, dtype=np.uint8))
+        else:
+            store_path = directory / (name + "_" + mask_name + ".npy")
+            stores.append(np.lib.format.open_memmap(str(store_path), mode="w+", dtype=np.uint8, shape=shape))
+    return tuple(stores)
+
+
+def get_image_shape(image, rgb=False):
+    return tuple(image.shape[:-1]) if rgb else tuple(image.shape)
+
+
+def compute_image_statistics(image, rgb=False):
+    """
+    Computes the mean and standard deviation of an image, reading it by blocks of rows.
+    """
+    pixel_sum = 0.0
+    squared_sum = 0.0
+    n_rows = image.shape[0]
+    for row in range(0, n_rows, STATISTICS_BLOCK_ROWS):
+        block = inference.to_grayscale(image[row:row + STATISTICS_BLOCK_ROWS], rgb).astype(np.float64)
+        pixel_sum += block.sum()
+        squared_sum += np.square(block).sum()
+    n_pixels = np.prod(get_image_shape(image, rgb), dtype=np.float64)
+    mean = pixel_sum / n_pixels
+    std = np.sqrt(max(squared_sum / n_pixels - mean ** 2, 0.0))
+    return mean, std
+
+
+def get_model_indexes(image_length, model_length):
+    """
+    :return: For each pixel of an image axis, the index of the nearest pixel of the resampled axis
+    :rtype: numpy.ndarray
+    """
+    indexes = ((np.arange(image_length) + 0.5) * model_length / image_length).astype(np.intp)
+    return np.minimum(indexes, model_length - 1)
+
+
+def read_resampled_patch(image, source, model_shape, rgb=False):
+    """
+    Reads the part of the image covered by a patch of the resampled image, and resamples it.
+    :param image: The image data, at its original resolution
+    :param source: Slices of the patch, in the coordinates of the resampled image
+    :param model_shape: Shape of the resampled image
+    :return: The resampled patch, as float32
+    """
+    image_shape = get_image_shape(image, rgb)
+    factors = [model_length / image_length for model_length, image_length in zip(model_shape, image_shape)]
+    if all(factor == 1 for factor in factors):
+        return inference.to_grayscale(image[tuple(source)], rgb)
+    window = []
+    offsets = []
+    for axis_slice, factor, image_length in zip(source, factors, image_shape):
+        # Position of the first patch pixel center in the original image
+        first = (axis_slice.start + 0.5) / factor - 0.5
+        last = (axis_slice.stop - 0.5) / factor - 0.5
+        start = max(int(np.floor(first)) - 1, 0)
+        stop = min(int(np.ceil(last)) + 2, image_length)
+        window.append(slice(start, stop))
+        offsets.append(first - start)
+    window_data = inference.to_grayscale(image[tuple(window)], rgb)
+    patch_shape = tuple(axis_slice.stop - axis_slice.start for axis_slice in source)
+    return ndimage.affine_transform(window_data, [1 / factor for factor in factors], offset=offsets,
+                                    output_shape=patch_shape, order=1, mode="nearest")
+
+
+class Tiling:
+    """
+    The patches of an image, each one read and resampled on its own, with the part of the image it predicts.
+    """
+    def __init__(self, session, image, pixel_size, zoom_factor=1.0, overlap_value=(48, 48), rgb=False):
+        """
+        :param session: The ModelSession of the model to apply
+        :param image: The image data (numpy, zarr, dask or memory-mapped array)
+        :param pixel_size: The pixel size of the image, in micrometers
+        :param zoom_factor: Multiplicative constant applied to the pixel size before inference
+        :param overlap_value: Overlap between the patches, in pixels, for each axis
+        :param rgb: Whether the last axis of the image contains color channels
+        """
+        self.session = session
+        self.image = image
+        self.rgb = rgb
+        self.image_shape = get_image_shape(image, rgb)
+        resampling_factor = inference.get_resampling_factor(session, pixel_size, zoom_factor)
+        inference.check_image_size(self.image_shape, session.patch_shape, resampling_factor, zoom_factor)
+        self.model_shape = tuple(int(round(length * resampling_factor)) for length in self.image_shape)
+        self.model_indexes = [get_model_indexes(image_length, model_length)
+                              for image_length, model_length in zip(self.image_shape, self.model_shape)]
+        self.mean, std = compute_image_statistics(image, rgb)
+        self.std = std if std > 0 else 1.0
+        self.patches = inference.get_patches(self.model_shape, session.patch_shape, overlap_value)
+
+    def read_patch(self, patch):
+        """
+        :return: The normalized input of a patch
+        """
+        resampled_patch = read_resampled_patch(self.image, patch.source, self.model_shape, self.rgb)
+        return ((resampled_patch - self.mean) / self.std).astype(np.float32)
+
+    def get_destination(self, patch):
+        """
+        :return: The box of the image predicted by a patch (the pixels whose nearest resampled pixel is owned by the
+                 patch), and the indexes of those pixels in the patch, for each axis
+        :rtype: tuple
+        """
+        destination = []
+        patch_indexes = []
+        for axis in range(2):
+            owned = patch.destination[axis]
+            start = np.searchsorted(self.model_indexes[axis], owned.start, side="left")
+            stop = np.searchsorted(self.model_indexes[axis], owned.stop, side="left")
+            destination.append(slice(int(start), int(stop)))
+            patch_indexes.append(self.model_indexes[axis][start:stop] - patch.source[axis].start)
+        return tuple(destination), patch_indexes
+
+    def to_image_class_map(self, patch, class_map):
+        """
+        :param class_map: The class map predicted for a patch
+        :return: The box of the image predicted by the patch, and its class map at the resolution of the image
+        :rtype: tuple
+        """
+        destination, patch_indexes = self.get_destination(patch)
+        return destination, class_map[np.ix_(*patch_indexes)]
+
+
+def segment_tiled(session, image, axon_output, myelin_output, pixel_size, zoom_factor=1.0, overlap_value=(48, 48),
+                  rgb=False, progress_callback=None, class_output=None, n_workers=1):
+    """
+    Segments an image patch by patch, without loading it in memory.
+    :param session: The ModelSession of the model to apply
+    :param image: The image data (numpy, zarr, dask or memory-mapped array)
+    :param axon_output: Array receiving the axon mask, with the shape of the image. Can be None.
+    :param myelin_output: Array receiving the myelin mask, with the shape of the image. Can be None.
+    :param pixel_size: The pixel size of the image, in micrometers
+    :param zoom_factor: Multiplicative constant applied to the pixel size before inference
+    :param overlap_value: Overlap between the patches, in pixels, for each axis
+    :param rgb: Whether the last axis of the image contains color channels
+    :param progress_callback: Called with (number of patches done, total number of patches) after each patch
+    :param class_output: Array receiving the class map (0: background, 1: myelin, 2: axon), or None
+    :param n_workers: Number of patches predicted at the same time on the CPU
+    """
+    with profiling.stage("image statistics"):
+        tiling = Tiling(session, image, pixel_size, zoom_factor, overlap_value, rgb)
+    patches = tiling.patches
+    # The patches are predicted by the workers, and written to the outputs by this thread only
+    predictions = inference.predict_patch_class_maps(session, patches, tiling.read_patch, n_workers=n_workers)
+    stitching_time = 0.0
+    with profiling.stage("patch reading and inference"):
+        for patch_index, (patch, class_map) in enumerate(predictions):
+            start = time.perf_counter()
+            destination, patch_class_map = tiling.to_image_class_map(patch, class_map)
+            write_class_map(destination, patch_class_map, axon_output, myelin_output, class_output)
+            stitching_time += time.perf_counter() - start
+
+            if progress_callback is not None:
+                progress_callback(patch_index + 1, len(patches))
+        profiling.add_stage("stitching and writing", stitching_time)
+
+
+def write_class_map(box, class_map, axon_output=None, myelin_output=None, class_output=None):
+    """
+    Writes the class map of a box of the image to the outputs that are not None.
+    """
+    if class_output is not None:
+        class_output[box] = class_map
+    if axon_output is not None:
+        axon_output[box] = class_map == inference.AXON_LABEL
+    if myelin_output is not None:
+        myelin_output[box] = class_map == inference.MYELIN_LABEL